@@ -11,6 +11,7 @@ from app.models.base import get_db
 from app.models.user import User, APIKey
 from app.models.usage import UsageDaily
 from app.api.auth import get_current_user
+from app.services.cache_bus import CacheBus, ENTITY_API_KEY, ENTITY_USER
 from app.utils.logger import logger
 import secrets
 
@@ -95,6 +96,7 @@ class UpdateUserRequest(BaseModel):
     is_active: Optional[bool] = None
     monthly_quota_tokens: Optional[int] = None
     monthly_quota_amount: Optional[float] = None
+    max_concurrency: Optional[int] = None
 
 
 @router.patch("/users/{user_id}")
@@ -118,15 +120,19 @@ async def update_user(
         user.monthly_quota_tokens = request.monthly_quota_tokens
     if request.monthly_quota_amount is not None:
         user.monthly_quota_amount = request.monthly_quota_amount
+    if request.max_concurrency is not None:
+        user.max_concurrency = request.max_concurrency
     
     db.commit()
     db.refresh(user)
+    await CacheBus.publish(ENTITY_USER, entity_id=user.id)
     
     return {
         "id": user.id,
         "username": user.username,
         "is_active": user.is_active,
-        "monthly_quota_tokens": user.monthly_quota_tokens
+        "monthly_quota_tokens": user.monthly_quota_tokens,
+        "max_concurrency": user.max_concurrency
     }
 
 
@@ -198,6 +204,8 @@ async def create_api_key(
     db.add(api_key)
     db.commit()
     db.refresh(api_key)
+    # 清除可能存在的无效Key负缓存
+    await CacheBus.publish(ENTITY_API_KEY, entity_id=api_key.id, key=api_key.key)
     
     return {
         "id": api_key.id,
@@ -211,6 +219,8 @@ async def create_api_key(
 class UpdateKeyRequest(BaseModel):
     is_active: Optional[bool] = None
     name: Optional[str] = None
+    hedge_requests: Optional[bool] = None
+    max_concurrency: Optional[int] = None  # 仅管理员可修改
 
 
 @router.patch("/api-keys/{key_id}")
@@ -234,19 +244,31 @@ async def update_api_key(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Can only update your own keys"
         )
+    if request.max_concurrency is not None and not current_user.is_admin:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Only admins can change concurrency limits"
+        )
     
     if request.is_active is not None:
         api_key.is_active = request.is_active
     if request.name is not None:
         api_key.name = request.name
+    if request.hedge_requests is not None:
+        api_key.hedge_requests = request.hedge_requests
+    if request.max_concurrency is not None:
+        api_key.max_concurrency = request.max_concurrency
     
     db.commit()
     db.refresh(api_key)
+    await CacheBus.publish(ENTITY_API_KEY, entity_id=api_key.id, key=api_key.key)
     
     return {
         "id": api_key.id,
         "is_active": api_key.is_active,
-        "name": api_key.name
+        "name": api_key.name,
+        "hedge_requests": api_key.hedge_requests,
+        "max_concurrency": api_key.max_concurrency
     }
 
 
@@ -271,8 +293,10 @@ async def delete_api_key(
             detail="Can only delete your own keys"
         )
     
+    token = api_key.key
     db.delete(api_key)
     db.commit()
+    await CacheBus.publish(ENTITY_API_KEY, entity_id=key_id, key=token)
     
     return {"message": "API Key deleted"}
 
@@ -6,17 +6,16 @@ from fastapi import APIRouter, Depends, HTTPException, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel, EmailStr
 from sqlalchemy.orm import Session
-from passlib.context import CryptContext
 from jose import JWTError, jwt
 from datetime import datetime, timedelta
 from app.models.base import get_db
 from app.models.user import User
 from app.config import settings
 from app.utils.logger import logger
+from app.utils.password import PasswordHashBusyError, verify_password, get_password_hash
 
 router = APIRouter(prefix="/api")
 security = HTTPBearer()
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 
 class RegisterRequest(BaseModel):
@@ -44,14 +43,14 @@ class UserResponse(BaseModel):
         populate_by_name = True
 
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    """验证密码"""
-    return pwd_context.verify(plain_password, hashed_password)
-
-
-def get_password_hash(password: str) -> str:
-    """生成密码哈希"""
-    return pwd_context.hash(password)
+def password_busy_error() -> HTTPException:
+    """密码哈希排队已满时返回503（客户端稍后重试）"""
+    logger.warning("Password hashing queue is full, rejecting auth request")
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Too many authentication requests, please retry later",
+        headers={"Retry-After": "1"}
+    )
 
 
 def create_access_token(data: dict, expires_delta: timedelta = None):
@@ -116,10 +115,14 @@ async def register(request: RegisterRequest, db: Session = Depends(get_db)):
             )
     
     # 创建新用户
+    try:
+        password_hash = await get_password_hash(request.password)
+    except PasswordHashBusyError:
+        raise password_busy_error()
     user = User(
         username=request.username,
         email=request.email,
-        password_hash=get_password_hash(request.password),
+        password_hash=password_hash,
         is_active=True,
         is_admin=False,
         monthly_quota_tokens=settings.DEFAULT_MONTHLY_QUOTA_TOKENS,
@@ -149,7 +152,11 @@ async def login(request: LoginRequest, db: Session = Depends(get_db)):
             detail="Invalid username or password"
         )
     
-    if not verify_password(request.password, user.password_hash):
+    try:
+        password_ok = await verify_password(request.password, user.password_hash)
+    except PasswordHashBusyError:
+        raise password_busy_error()
+    if not password_ok:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid username or password"
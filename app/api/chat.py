@@ -1,18 +1,28 @@
 """
 Chat Completions API（兼容OpenAI）
 """
+import asyncio
 import json
 import time
+import anyio
 from fastapi import APIRouter, Request, Depends, HTTPException, status
 from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
 from pydantic import BaseModel, Field
 from typing import List, Optional, Dict, Any
-from sqlalchemy.orm import Session
-from app.models.base import get_db
+from app.models.upstream import UpstreamKey
 from app.middleware.auth import verify_api_key
 from app.services.key_pool import KeyPoolService
-from app.services.upstream_client import UpstreamClient, AzureUpstreamClient
+from app.services.concurrency_limiter import ConcurrencyLimiter, ConcurrencyPermit
+from app.services.admission_queue import AdmissionQueue
+from app.services.upstream_client import (
+    UpstreamClient, AzureUpstreamClient, StreamCompletionAccumulator, is_usage_only_event
+)
 from app.services.usage_tracker import UsageTracker
+from app.services.quota_counter import QuotaCounter
+from app.services.rate_limiter import TokenReservation
+from app.services.token_counter import TokenCounter
+from app.services.upstream_stats import UpstreamStats
 from app.config import settings
 from app.utils.logger import logger
 
@@ -37,13 +47,13 @@ class ChatCompletionRequest(BaseModel):
     presence_penalty: Optional[float] = None
     frequency_penalty: Optional[float] = None
     user: Optional[str] = None
+    stream_options: Optional[Dict[str, Any]] = None
 
 
 @router.post("/v1/chat/completions")
 async def chat_completions(
     request: Request,
     body: ChatCompletionRequest,
-    db: Session = Depends(get_db),
     _: tuple = Depends(verify_api_key)
 ):
     """
@@ -54,21 +64,32 @@ async def chat_completions(
     api_key = request.state.api_key
     
     # API Key限流检查（在鉴权之后）
-    from app.services.rate_limiter import RateLimiter
+    from app.services.rate_limiter import HybridRateLimiter
     from app.config import settings
-    estimated_tokens = sum(len(msg.content) * 0.25 for msg in body.messages) + (body.max_tokens or 1000)
-    estimated_tokens = int(estimated_tokens)
+    estimated_tokens = TokenCounter.estimate_request_tokens(body.messages, body.model, body.max_tokens)
+    reservation = TokenReservation(api_key.key, estimated_tokens, prefix="key")
     
     limit_rpm = api_key.rate_limit_rpm or settings.RATE_LIMIT_RPM
     limit_tpm = api_key.rate_limit_tpm or settings.RATE_LIMIT_TPM
     
-    is_allowed, info = RateLimiter.check_rate_limit(
-        identifier=api_key.key,
-        limit_rpm=limit_rpm,
-        limit_tpm=limit_tpm,
-        current_tokens=estimated_tokens,
-        prefix="key"
-    )
+    # 客户端通过 X-Queue-Timeout 指定愿意排队等待的秒数，容量不足时排队而不是立即拒绝
+    queue_deadline = AdmissionQueue.deadline_from_header(request.headers.get("X-Queue-Timeout"), start_time)
+    
+    async def check_key_rate_limit():
+        return await HybridRateLimiter.check_rate_limit(
+            identifier=api_key.key,
+            limit_rpm=limit_rpm,
+            limit_tpm=limit_tpm,
+            current_tokens=estimated_tokens,
+            prefix="key",
+            request_id=reservation.request_id
+        )
+    
+    is_allowed, info = await check_key_rate_limit()
+    if not is_allowed and queue_deadline:
+        queued = await AdmissionQueue.wait(user.id, queue_deadline, check_key_rate_limit)
+        if queued:
+            is_allowed, info = queued
     
     if not is_allowed:
         logger.warning(f"API key rate limit exceeded: {api_key.key[:10]}...")
@@ -83,67 +104,77 @@ async def chat_completions(
                 }
             }
         )
+    reservation.lease = info.pop("lease", None)
     
     # 检查模型是否允许
-    if api_key.allowed_models:
-        import json as json_lib
-        allowed = json_lib.loads(api_key.allowed_models) if isinstance(api_key.allowed_models, str) else api_key.allowed_models
-        if body.model not in allowed:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail=f"Model {body.model} is not allowed for this API key"
-            )
-    
-    # 估算token数（用于配额检查）
-    estimated_tokens = sum(len(msg.content) * 0.25 for msg in body.messages) + (body.max_tokens or 1000)
-    estimated_tokens = int(estimated_tokens)
+    allowed = request.state.allowed_models
+    if allowed and body.model not in allowed:
+        await reservation.cancel()
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Model {body.model} is not allowed for this API key"
+        )
     
-    # 检查配额
-    quota_ok, quota_error = UsageTracker.check_quota(db, user.id, estimated_tokens)
-    if not quota_ok:
+    # 检查配额并预占（沿用限流时的token估算，随限流预占一起按实际用量结算）
+    reservation.quota, quota_error = await QuotaCounter.reserve(user, estimated_tokens)
+    if reservation.quota is None:
+        await reservation.cancel()
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail=quota_error
         )
     
+    # 并发限制（许可在响应结束或客户端断开时释放）
+    async def acquire_permit():
+        return await ConcurrencyLimiter.acquire(
+            api_key.id, user.id, api_key.max_concurrency, user.max_concurrency
+        )
+    
+    permit, concurrency_info = await acquire_permit()
+    if permit is None and queue_deadline:
+        queued = await AdmissionQueue.wait(user.id, queue_deadline, acquire_permit)
+        if queued:
+            permit, concurrency_info = queued
+    if permit is None:
+        logger.warning(f"Concurrency limit exceeded ({concurrency_info['scope']}): {api_key.key[:10]}...")
+        await reservation.cancel()
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail={
+                "error": {
+                    "message": "Too many concurrent requests",
+                    "type": "rate_limit_error",
+                    "code": "concurrency_limit_exceeded",
+                    **concurrency_info
+                }
+            }
+        )
+    
     # 选择上游密钥
-    upstream_key = KeyPoolService.select_key(db, settings.UPSTREAM_TYPE)
+    async def acquire_upstream_key():
+        return await KeyPoolService.acquire_key(settings.UPSTREAM_TYPE), None
+    
+    upstream_key, _ = await acquire_upstream_key()
+    if not upstream_key and queue_deadline:
+        queued = await AdmissionQueue.wait(user.id, queue_deadline, acquire_upstream_key)
+        if queued:
+            upstream_key, _ = queued
     if not upstream_key:
+        await reservation.cancel()
+        await permit.release()
         raise HTTPException(
             status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
             detail="No healthy upstream keys available"
         )
     
-    # 获取解密后的密钥
-    try:
-        decrypted_key = KeyPoolService.get_decrypted_key(upstream_key)
-    except Exception as e:
-        logger.error(f"Failed to decrypt upstream key: {e}")
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="Internal server error"
-        )
-    
     # 创建上游客户端
-    if settings.UPSTREAM_TYPE == "azure":
-        if not upstream_key.azure_endpoint or not upstream_key.azure_deployment_name:
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail="Azure configuration incomplete"
-            )
-        client = AzureUpstreamClient(
-            endpoint=upstream_key.azure_endpoint,
-            api_key=decrypted_key,
-            deployment_name=upstream_key.azure_deployment_name,
-            api_version=upstream_key.azure_api_version or settings.AZURE_API_VERSION,
-            timeout=settings.UPSTREAM_TIMEOUT
-        )
-    else:
-        client = UpstreamClient(
-            base_url=settings.OPENAI_BASE_URL,
-            api_key=decrypted_key,
-            timeout=settings.UPSTREAM_TIMEOUT
-        )
+    try:
+        client = create_upstream_client(upstream_key)
+    except HTTPException:
+        await reservation.cancel()
+        await permit.release()
+        raise
+    attempt = UpstreamAttempt(upstream_key, client)
     
     # 准备请求体
     request_data = {
@@ -167,6 +198,15 @@ async def chat_completions(
         request_data["frequency_penalty"] = body.frequency_penalty
     if body.user is not None:
         request_data["user"] = body.user
+    # 要求上游在最后一个事件返回usage，用于按实际用量结算；客户端未请求时该事件不转发
+    strip_usage = False
+    if body.stream:
+        stream_options = dict(body.stream_options or {})
+        if settings.STREAM_INCLUDE_USAGE and not stream_options.get("include_usage"):
+            stream_options["include_usage"] = True
+            strip_usage = True
+        if stream_options:
+            request_data["stream_options"] = stream_options
     
     # 获取客户端IP和User-Agent
     client_ip = request.client.host if request.client else None
@@ -177,82 +217,327 @@ async def chat_completions(
     if settings.LOG_PROMPT_BODY:
         request_body_str = json.dumps(request_data, ensure_ascii=False)
     
+    # 对冲请求（按API Key配置或请求头开启，仅用于非流式）
+    hedge = bool(api_key.hedge_requests) or request.headers.get("X-Hedge-Request", "").lower() in ("1", "true")
+    
     try:
         if body.stream:
             # 流式响应
             return StreamingResponse(
                 stream_chat_completions(
-                    client,
+                    attempt,
                     request_data,
-                    db,
                     user.id,
                     api_key.id,
-                    upstream_key.id,
                     body.model,
                     client_ip,
                     user_agent,
                     request_body_str,
-                    start_time
+                    start_time,
+                    reservation,
+                    permit,
+                    TokenCounter.count_messages(body.messages, body.model),
+                    strip_usage
                 ),
                 media_type="text/event-stream",
                 headers={
                     "Cache-Control": "no-cache",
                     "Connection": "keep-alive",
                     "X-Accel-Buffering": "no"  # 禁用Nginx缓冲
-                }
+                },
+                # 客户端在生成器开始前断开时，生成器的finally不会执行
+                background=BackgroundTask(finish_stream, reservation, permit)
             )
         else:
             # 非流式响应
-            return await handle_non_streaming(
-                client,
-                request_data,
-                db,
-                user.id,
-                api_key.id,
-                upstream_key.id,
-                body.model,
-                client_ip,
-                user_agent,
-                request_body_str,
-                start_time
-            )
+            try:
+                return await handle_non_streaming(
+                    attempt,
+                    request_data,
+                    user.id,
+                    api_key.id,
+                    body.model,
+                    client_ip,
+                    user_agent,
+                    request_body_str,
+                    start_time,
+                    reservation,
+                    TokenCounter.count_messages(body.messages, body.model),
+                    hedge=hedge
+                )
+            finally:
+                await permit.release()
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Chat completion error: {e}")
-        KeyPoolService.record_failure(db, upstream_key.id, str(type(e).__name__))
+        await reservation.settle(0)
+        await permit.release()
+        await KeyPoolService.record_failure(attempt.upstream_key.id, str(type(e).__name__))
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Internal server error"
+        )
+
+
+# 可触发故障转移的上游状态码（无状态码表示连接错误，同样可重试）
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+
+class UpstreamAttempt:
+    """当前请求使用的上游密钥和客户端（故障转移时切换）"""
+    
+    def __init__(self, upstream_key: UpstreamKey, client: UpstreamClient):
+        self.upstream_key = upstream_key
+        self.client = client
+        self.tried_key_ids = [upstream_key.id]
+
+
+def create_upstream_client(upstream_key: UpstreamKey) -> UpstreamClient:
+    """根据上游密钥创建客户端"""
+    # 获取解密后的密钥
+    try:
+        decrypted_key = KeyPoolService.get_decrypted_key(upstream_key)
+    except Exception as e:
+        logger.error(f"Failed to decrypt upstream key: {e}")
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Internal server error"
         )
+    
+    if settings.UPSTREAM_TYPE == "azure":
+        if not upstream_key.azure_endpoint or not upstream_key.azure_deployment_name:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail="Azure configuration incomplete"
+            )
+        return AzureUpstreamClient(
+            endpoint=upstream_key.azure_endpoint,
+            api_key=decrypted_key,
+            deployment_name=upstream_key.azure_deployment_name,
+            api_version=upstream_key.azure_api_version or settings.AZURE_API_VERSION,
+            timeout=settings.UPSTREAM_TIMEOUT,
+            key_id=upstream_key.id
+        )
+    return UpstreamClient(
+        base_url=settings.OPENAI_BASE_URL,
+        api_key=decrypted_key,
+        timeout=settings.UPSTREAM_TIMEOUT,
+        key_id=upstream_key.id
+    )
+
+
+def is_retryable_error(event: Dict[str, Any]) -> bool:
+    """上游错误是否可以换Key重试"""
+    status_code = event.get("status_code")
+    return status_code is None or status_code in RETRYABLE_STATUS_CODES
+
+
+def get_retry_after(event: Dict[str, Any]) -> Optional[float]:
+    """上游返回429时的retry-after（秒），用于精确熔断"""
+    if event.get("status_code") == 429:
+        return event.get("retry_after")
+    return None
+
+
+async def switch_upstream_key(attempt: UpstreamAttempt, deadline: float) -> bool:
+    """
+    切换到另一个未尝试过的健康上游密钥
+    
+    Returns:
+        是否切换成功（超出尝试次数、截止时间或无可用Key时返回False）
+    """
+    while len(attempt.tried_key_ids) < settings.UPSTREAM_MAX_ATTEMPTS and time.time() < deadline:
+        upstream_key = await KeyPoolService.acquire_key(
+            settings.UPSTREAM_TYPE, exclude_ids=attempt.tried_key_ids
+        )
+        if not upstream_key:
+            return False
+        attempt.tried_key_ids.append(upstream_key.id)
+        try:
+            client = create_upstream_client(upstream_key)
+        except HTTPException:
+            await KeyPoolService.record_failure(upstream_key.id, "config_error")
+            continue
+        logger.info(f"Failing over from upstream key {attempt.upstream_key.id} to {upstream_key.id}")
+        attempt.upstream_key = upstream_key
+        attempt.client = client
+        return True
+    return False
+
+
+async def iter_upstream_events(
+    attempt: UpstreamAttempt,
+    request_data: dict,
+    start_time: float,
+    **client_kwargs
+):
+    """
+    调用上游并在必要时故障转移
+    
+    只有在尚未向下游产出任何事件时，遇到可重试错误才会切换Key重试；
+    最终失败的错误事件原样产出，由调用方处理。
+    """
+    deadline = start_time + settings.UPSTREAM_FAILOVER_DEADLINE_SECONDS
+    while True:
+        started = False
+        failed_event = None
+        events = attempt.client.chat_completions(**request_data, **client_kwargs)
+        try:
+            async for event in events:
+                if event["type"] == "error" and not started and is_retryable_error(event):
+                    failed_event = event
+                    break
+                started = True
+                yield event
+        finally:
+            # 及时释放上游连接和在途计数
+            await events.aclose()
+        
+        if failed_event is None:
+            return
+        
+        failed_key_id = attempt.upstream_key.id
+        if not await switch_upstream_key(attempt, deadline):
+            yield failed_event
+            return
+        await KeyPoolService.record_failure(
+            failed_key_id, "upstream_error", retry_after=get_retry_after(failed_event)
+        )
+
+
+async def collect_upstream_result(
+    attempt: UpstreamAttempt,
+    request_data: dict,
+    start_time: float
+) -> Dict[str, Any]:
+    """获取非流式请求的最终事件（complete或error）"""
+    result = {"type": "error", "error": "Empty upstream response"}
+    async for event in iter_upstream_events(attempt, request_data, start_time):
+        if event["type"] in ("complete", "error"):
+            result = event
+    return result
+
+
+async def hedged_upstream_result(
+    attempt: UpstreamAttempt,
+    request_data: dict,
+    start_time: float
+) -> tuple[UpstreamAttempt, Dict[str, Any]]:
+    """
+    对冲请求：首个上游在延迟阈值内未返回时，通过另一个Key再发一次
+    
+    Returns:
+        (胜出的attempt, 最终事件)，落败的请求会被取消
+    """
+    primary = asyncio.create_task(collect_upstream_result(attempt, request_data, start_time))
+    done, _ = await asyncio.wait({primary}, timeout=UpstreamStats.hedge_delay())
+    if done:
+        return attempt, primary.result()
+    
+    hedge_key = await KeyPoolService.acquire_key(settings.UPSTREAM_TYPE, exclude_ids=attempt.tried_key_ids)
+    if not hedge_key:
+        return attempt, await primary
+    try:
+        hedge_attempt = UpstreamAttempt(hedge_key, create_upstream_client(hedge_key))
+    except HTTPException:
+        return attempt, await primary
+    # 两路共享已尝试列表，故障转移时互不重复
+    attempt.tried_key_ids.append(hedge_key.id)
+    hedge_attempt.tried_key_ids = attempt.tried_key_ids
+    logger.info(f"Hedging upstream key {attempt.upstream_key.id} with {hedge_key.id}")
+    
+    hedge = asyncio.create_task(collect_upstream_result(hedge_attempt, request_data, start_time))
+    attempts = {primary: attempt, hedge: hedge_attempt}
+    pending = {primary, hedge}
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                event = task.result()
+                if event["type"] == "complete":
+                    return attempts[task], event
+        # 两路都失败，返回首个请求的错误
+        return attempt, primary.result()
     finally:
-        await client.close()
+        for task in pending:
+            task.cancel()
+
+
+def completion_text(result: Dict[str, Any]) -> str:
+    """非流式响应的输出文本"""
+    parts = []
+    for choice in result.get("choices") or ():
+        if isinstance(choice, dict):
+            content = (choice.get("message") or {}).get("content")
+            if isinstance(content, str):
+                parts.append(content)
+    return "".join(parts)
+
+
+async def finish_stream(reservation: TokenReservation, permit: ConcurrencyPermit):
+    """
+    流式响应结束后的兜底收尾（均为幂等操作）
+    
+    生成器正常执行时已按实际用量结算并释放许可，这里不再生效；
+    客户端在生成器开始前断开时请求未发往上游，撤销全部预占（含RPM请求数）并释放许可。
+    """
+    with anyio.CancelScope(shield=True):
+        await reservation.cancel()
+        await permit.release()
 
 
 async def stream_chat_completions(
-    client: UpstreamClient,
+    attempt: UpstreamAttempt,
     request_data: dict,
-    db: Session,
     user_id: int,
     api_key_id: int,
-    upstream_key_id: int,
     model: str,
     client_ip: Optional[str],
     user_agent: Optional[str],
     request_body_str: Optional[str],
-    start_time: float
+    start_time: float,
+    reservation: TokenReservation,
+    permit: ConcurrencyPermit,
+    estimated_prompt_tokens: int,
+    strip_usage: bool = False
 ):
-    """处理流式响应"""
+    """
+    处理流式响应（结束或客户端断开时释放并发许可）
+    
+    上游未返回usage（不支持include_usage或客户端中途断开）时，
+    按prompt估算值和已输出文本的本地计数记录用量并结算。
+    
+    Args:
+        strip_usage: usage由网关注入（客户端未请求），读取后不转发只携带usage的事件
+    """
+    completion = StreamCompletionAccumulator()
     prompt_tokens = 0
     completion_tokens = 0
     total_tokens = 0
-    error_occurred = False
+    error_event: Optional[Dict[str, Any]] = None  # 上游最终返回的错误事件
     error_type = None
     error_message = None
     response_status = 200
+    outcome = "disconnected"  # 正常结束时改为 success/error
     
     try:
-        async for event in client.chat_completions(**request_data):
-            if event["type"] == "error":
-                error_occurred = True
+        async for event in iter_upstream_events(
+            attempt, request_data, start_time,
+            passthrough=settings.STREAM_PASSTHROUGH, strip_usage=strip_usage
+        ):
+            if event["type"] == "raw":
+                # 透传模式：原样转发上游字节
+                completion.feed_raw(event["data"])
+                yield event["data"]
+            elif event["type"] == "end":
+                usage = event.get("usage") or {}
+                prompt_tokens = usage.get("prompt_tokens", 0)
+                completion_tokens = usage.get("completion_tokens", 0)
+                total_tokens = usage.get("total_tokens", 0)
+                break
+            elif event["type"] == "error":
+                error_event = event
                 response_status = event.get("status_code", 500)
                 error_type = "upstream_error"
                 error_message = str(event.get("error", "Unknown error"))
@@ -260,87 +545,95 @@ async def stream_chat_completions(
                 break
             elif event["type"] == "data":
                 data = event["data"]
-                # 提取token信息
-                if "usage" in data:
+                # 提取token信息（include_usage时其余事件的usage为null）
+                if data.get("usage"):
                     usage = data["usage"]
                     prompt_tokens = usage.get("prompt_tokens", 0)
                     completion_tokens = usage.get("completion_tokens", 0)
                     total_tokens = usage.get("total_tokens", 0)
+                completion.feed_event(data)
+                if strip_usage and is_usage_only_event(data):
+                    continue
                 # 转发SSE事件
                 yield f"data: {json.dumps(data)}\n\n"
             elif event["type"] == "done":
                 yield "data: [DONE]\n\n"
                 break
         
-        # 记录用量
-        response_time_ms = (time.time() - start_time) * 1000
-        UsageTracker.record_usage(
-            db=db,
-            user_id=user_id,
-            api_key_id=api_key_id,
-            upstream_key_id=upstream_key_id,
-            model=model,
-            prompt_tokens=prompt_tokens,
-            completion_tokens=completion_tokens,
-            total_tokens=total_tokens,
-            response_status=response_status,
-            response_time_ms=response_time_ms,
-            client_ip=client_ip,
-            user_agent=user_agent,
-            request_body=request_body_str,
-            error_type=error_type,
-            error_message=error_message
-        )
-        
-        # 更新上游密钥状态
-        if error_occurred:
-            KeyPoolService.record_failure(db, upstream_key_id, error_type or "unknown")
-        else:
-            KeyPoolService.record_success(db, upstream_key_id, total_tokens)
-            
+        outcome = "error" if error_event is not None else "success"
+    
     except Exception as e:
         logger.error(f"Stream error: {e}")
-        error_occurred = True
+        outcome = "error"
         error_type = "stream_error"
         error_message = str(e)
         response_status = 500
-        
-        # 记录错误
-        response_time_ms = (time.time() - start_time) * 1000
-        UsageTracker.record_usage(
-            db=db,
-            user_id=user_id,
-            api_key_id=api_key_id,
-            upstream_key_id=upstream_key_id,
-            model=model,
-            prompt_tokens=0,
-            completion_tokens=0,
-            total_tokens=0,
-            response_status=response_status,
-            response_time_ms=response_time_ms,
-            client_ip=client_ip,
-            user_agent=user_agent,
-            request_body=request_body_str,
-            error_type=error_type,
-            error_message=error_message
-        )
-        KeyPoolService.record_failure(db, upstream_key_id, error_type)
+        prompt_tokens = completion_tokens = total_tokens = 0
+        # 转发过程中断开的上游连接，与连接错误一样计入失败
+        error_event = {"type": "error", "error": error_message}
+    
+    finally:
+        # 客户端断开时生成器被取消/关闭，收尾操作需屏蔽取消，否则预占、用量和并发许可都不会结算
+        with anyio.CancelScope(shield=True):
+            if outcome == "disconnected":
+                error_type = "client_disconnected"
+                error_message = "Client disconnected"
+                response_status = 499
+            
+            if outcome != "error" and not total_tokens:
+                prompt_tokens = estimated_prompt_tokens
+                completion_tokens = TokenCounter.count_completion(completion.text(), model)
+                total_tokens = prompt_tokens + completion_tokens
+            
+            # 记录用量
+            response_time_ms = (time.time() - start_time) * 1000
+            await UsageTracker.record_usage(
+                user_id=user_id,
+                api_key_id=api_key_id,
+                upstream_key_id=attempt.upstream_key.id,
+                model=model,
+                prompt_tokens=prompt_tokens,
+                completion_tokens=completion_tokens,
+                total_tokens=total_tokens,
+                response_status=response_status,
+                response_time_ms=response_time_ms,
+                client_ip=client_ip,
+                user_agent=user_agent,
+                request_body=request_body_str,
+                error_type=error_type,
+                error_message=error_message
+            )
+            
+            # 按实际用量校正TPM窗口和配额
+            await reservation.settle(total_tokens)
+            
+            # 更新上游密钥状态（客户端断开和请求本身的错误（4xx）与上游密钥无关，不计入）
+            if outcome == "error":
+                if is_retryable_error(error_event):
+                    await KeyPoolService.record_failure(
+                        attempt.upstream_key.id, error_type or "unknown", retry_after=get_retry_after(error_event)
+                    )
+            elif outcome == "success":
+                await KeyPoolService.record_success(attempt.upstream_key.id, total_tokens)
+            
+            await permit.release()
 
 
 async def handle_non_streaming(
-    client: UpstreamClient,
+    attempt: UpstreamAttempt,
     request_data: dict,
-    db: Session,
     user_id: int,
     api_key_id: int,
-    upstream_key_id: int,
     model: str,
     client_ip: Optional[str],
     user_agent: Optional[str],
     request_body_str: Optional[str],
-    start_time: float
+    start_time: float,
+    reservation: TokenReservation,
+    estimated_prompt_tokens: int,
+    hedge: bool = False
 ):
-    """处理非流式响应"""
+    """处理非流式响应（上游未返回usage时按prompt估算值和输出文本的本地计数结算）"""
     prompt_tokens = 0
     completion_tokens = 0
     total_tokens = 0
@@ -350,30 +643,43 @@ async def handle_non_streaming(
     result = None
     
     try:
-        async for event in client.chat_completions(**request_data):
-            if event["type"] == "error":
-                response_status = event.get("status_code", 500)
-                error_type = "upstream_error"
-                error_message = str(event.get("error", "Unknown error"))
-                raise HTTPException(
-                    status_code=response_status,
-                    detail=error_message
+        if hedge:
+            # 只有胜出的请求会被计入用量
+            attempt, event = await hedged_upstream_result(attempt, request_data, start_time)
+        else:
+            event = await collect_upstream_result(attempt, request_data, start_time)
+        
+        if event["type"] == "error":
+            response_status = event.get("status_code", 500)
+            error_type = "upstream_error"
+            error_message = str(event.get("error", "Unknown error"))
+            if is_retryable_error(event):
+                await KeyPoolService.record_failure(
+                    attempt.upstream_key.id, error_type, retry_after=get_retry_after(event)
                 )
-            elif event["type"] == "complete":
-                result = event["data"]
-                if "usage" in result:
-                    usage = result["usage"]
-                    prompt_tokens = usage.get("prompt_tokens", 0)
-                    completion_tokens = usage.get("completion_tokens", 0)
-                    total_tokens = usage.get("total_tokens", 0)
+            await reservation.settle(0)
+            raise HTTPException(
+                status_code=response_status,
+                detail=error_message
+            )
+        
+        result = event["data"]
+        if result.get("usage"):
+            usage = result["usage"]
+            prompt_tokens = usage.get("prompt_tokens", 0)
+            completion_tokens = usage.get("completion_tokens", 0)
+            total_tokens = usage.get("total_tokens", 0)
+        if not total_tokens:
+            prompt_tokens = estimated_prompt_tokens
+            completion_tokens = TokenCounter.count_completion(completion_text(result), model)
+            total_tokens = prompt_tokens + completion_tokens
         
         # 记录用量
         response_time_ms = (time.time() - start_time) * 1000
-        UsageTracker.record_usage(
-            db=db,
+        await UsageTracker.record_usage(
             user_id=user_id,
             api_key_id=api_key_id,
-            upstream_key_id=upstream_key_id,
+            upstream_key_id=attempt.upstream_key.id,
             model=model,
             prompt_tokens=prompt_tokens,
             completion_tokens=completion_tokens,
@@ -387,11 +693,14 @@ async def handle_non_streaming(
             error_message=error_message
         )
         
+        # 按实际用量校正TPM窗口和配额
+        await reservation.settle(total_tokens)
+        
         # 更新上游密钥状态
-        KeyPoolService.record_success(db, upstream_key_id, total_tokens)
+        await KeyPoolService.record_success(attempt.upstream_key.id, total_tokens)
         
         return result
-        
+    
     except HTTPException:
         raise
     except Exception as e:
@@ -402,11 +711,10 @@ async def handle_non_streaming(
         
         # 记录错误
         response_time_ms = (time.time() - start_time) * 1000
-        UsageTracker.record_usage(
-            db=db,
+        await UsageTracker.record_usage(
             user_id=user_id,
             api_key_id=api_key_id,
-            upstream_key_id=upstream_key_id,
+            upstream_key_id=attempt.upstream_key.id,
             model=model,
             prompt_tokens=0,
             completion_tokens=0,
@@ -419,7 +727,8 @@ async def handle_non_streaming(
             error_type=error_type,
             error_message=error_message
         )
-        KeyPoolService.record_failure(db, upstream_key_id, error_type)
+        await reservation.settle(0)
+        await KeyPoolService.record_failure(attempt.upstream_key.id, error_type)
         raise HTTPException(
             status_code=500,
             detail="Internal server error"
@@ -2,7 +2,9 @@
 健康检查端点
 """
 from fastapi import APIRouter
-from app.services.rate_limiter import get_redis_client
+from app.services.rate_limiter import RedisHealth, get_async_redis_client
+from app.services.admission_queue import AdmissionQueue
+from app.services.usage_writer import UsageWriter
 from app.models.base import engine
 from sqlalchemy import text
 from app.utils.logger import logger
@@ -30,12 +32,21 @@ async def health_check():
     
     # 检查Redis
     try:
-        redis_cli = get_redis_client()
-        redis_cli.ping()
+        redis_cli = get_async_redis_client()
+        await redis_cli.ping()
         status["services"]["redis"] = "healthy"
     except Exception as e:
         logger.error(f"Redis health check failed: {e}")
         status["services"]["redis"] = "unhealthy"
         status["status"] = "degraded"
     
+    # 限流模式（Redis不可用期间退化为进程内限流）
+    status["services"]["rate_limiter"] = "redis" if RedisHealth.is_available() else "in_process"
+    
+    # 准入队列深度（本worker）
+    status["admission_queue"] = AdmissionQueue.stats()
+    
+    # 用量写入缓冲（本worker）
+    status["usage_writer"] = UsageWriter.stats()
+    
     return status
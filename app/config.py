@@ -2,7 +2,7 @@
 配置管理模块
 """
 from pydantic_settings import BaseSettings
-from typing import List, Optional
+from typing import List, Optional, Tuple
 from urllib.parse import quote_plus
 import os
 
@@ -31,11 +31,25 @@ class Settings(BaseSettings):
         password = quote_plus(self.POSTGRES_PASSWORD)
         return f"postgresql://{self.POSTGRES_USER}:{password}@{self.POSTGRES_HOST}:{self.POSTGRES_PORT}/{self.POSTGRES_DB}"
     
+    @property
+    def ASYNC_DATABASE_URL(self) -> str:
+        password = quote_plus(self.POSTGRES_PASSWORD)
+        return f"postgresql+asyncpg://{self.POSTGRES_USER}:{password}@{self.POSTGRES_HOST}:{self.POSTGRES_PORT}/{self.POSTGRES_DB}"
+    
+    # 异步连接池（代理请求热路径，每个worker）
+    DB_ASYNC_POOL_SIZE: int = 20
+    DB_ASYNC_MAX_OVERFLOW: int = 20
+    
     # Redis
     REDIS_HOST: str = "redis"
     REDIS_PORT: int = 6379
     REDIS_PASSWORD: Optional[str] = None
     REDIS_DB: int = 0
+    REDIS_MAX_CONNECTIONS: int = 100
+    REDIS_POOL_TIMEOUT_SECONDS: float = 5.0
+    # Redis故障后的恢复探测（期间限流退化为进程内限流）
+    REDIS_PROBE_INTERVAL_SECONDS: float = 2.0
+    REDIS_PROBE_TIMEOUT_SECONDS: float = 1.0
     
     @property
     def REDIS_URL(self) -> str:
@@ -75,29 +89,129 @@ class Settings(BaseSettings):
     RATE_LIMIT_IP_RPM: int = 30
     RATE_LIMIT_IP_TPM: int = 45000
     
+    # 两级限流（本地令牌桶 + Redis租约，用于高RPM的API Key）
+    # Redis不可用时进程内降级限流按该数量均分限额（所有副本的worker总数）
+    RATE_LIMIT_WORKER_COUNT: int = 1
+    RATE_LIMIT_HYBRID_ENABLED: bool = False
+    RATE_LIMIT_HYBRID_MIN_RPM: int = 600  # 仅对RPM不低于该值的Key启用
+    RATE_LIMIT_LEASE_FRACTION: float = 0.05  # 每次租用全局额度的比例（误差上限）
+    RATE_LIMIT_LEASE_TTL_SECONDS: float = 2.0
+    RATE_LIMIT_LEASE_LOW_WATERMARK: float = 0.2  # 余量低于该比例时后台续租
+    
+    # 并发限制（同时在途请求数，0表示不限制；API Key/用户可单独覆盖）
+    CONCURRENCY_LIMIT_ENABLED: bool = True
+    CONCURRENCY_LIMIT_PER_KEY: int = 20
+    CONCURRENCY_LIMIT_PER_USER: int = 50
+    CONCURRENCY_LIMIT_GLOBAL: int = 0
+    CONCURRENCY_LEASE_TTL_SECONDS: float = 30.0  # 许可租约时长，进程崩溃后最多占用该时长
+    
+    # 准入排队（请求头 X-Queue-Timeout 指定等待秒数，容量不足时排队而不是立即429）
+    ADMISSION_QUEUE_ENABLED: bool = False
+    ADMISSION_QUEUE_MAX_LENGTH: int = 1000  # 每个worker的最大排队请求数，超出时立即拒绝
+    ADMISSION_QUEUE_MAX_WAIT_SECONDS: float = 30.0
+    ADMISSION_QUEUE_RETRY_INTERVAL_SECONDS: float = 0.2
+    
     # 熔断
     CIRCUIT_BREAKER_FAILURE_THRESHOLD: int = 5
     CIRCUIT_BREAKER_COOLDOWN_SECONDS: int = 300
     CIRCUIT_BREAKER_RECOVERY_THRESHOLD: int = 2
+    CIRCUIT_BREAKER_HALF_OPEN_MAX_REQUESTS: int = 3
+    
+    # API Key鉴权缓存（无效Key使用较短的负缓存TTL；管理端修改通过Redis pub/sub即时失效）
+    AUTH_CACHE_TTL_SECONDS: float = 600.0
+    AUTH_CACHE_NEGATIVE_TTL_SECONDS: float = 30.0
+    AUTH_CACHE_SIZE: int = 10000
+    AUTH_CACHE_NEGATIVE_SIZE: int = 1000
+    
+    # Key池快照刷新间隔（秒）
+    KEY_POOL_REFRESH_SECONDS: float = 5.0
+    DECRYPTED_KEY_CACHE_SIZE: int = 1024
+    
+    # Key选择策略：weighted / round_robin / least_outstanding / ewma
+    KEY_SELECTION_STRATEGY: str = "weighted"
+    UPSTREAM_EWMA_ALPHA: float = 0.3
+    # 上游限额余量低于该比例时尽量避开该Key（x-ratelimit-* header）
+    UPSTREAM_RATE_LIMIT_HEADROOM: float = 0.05
+    
+    # Token计数（本地BPE词表目录，为空时使用tiktoken默认缓存目录）
+    TOKENIZER_VOCAB_DIR: str = ""
+    TOKEN_COUNT_CACHE_SIZE: int = 4096
     
     # 安全
     ENCRYPTION_KEY: str = ""
     JWT_SECRET_KEY: str = "your-jwt-secret-key-change-this"
     JWT_ALGORITHM: str = "HS256"
     
+    # 密码哈希线程池（bcrypt，登录/注册）
+    PASSWORD_HASH_WORKERS: int = 2
+    PASSWORD_HASH_QUEUE_SIZE: int = 32  # 排队上限，超出时返回503
+    
     # 日志
     LOG_LEVEL: str = "INFO"
     LOG_PROMPT_BODY: bool = False
     LOG_FILE_PATH: str = "/var/log/gpt_proxy/app.log"
     
+    # 用量记录批量写入（按间隔或条数批量落库，数据库不可用时溢出到本地文件）
+    USAGE_FLUSH_INTERVAL_MS: int = 500
+    USAGE_FLUSH_BATCH_SIZE: int = 500
+    USAGE_SPILL_PATH: str = "/var/lib/gpt_proxy/usage_spill.jsonl"
+    
+    # usage_records 月度分区（预建分区月数；保留月数，0表示不归档；超过保留期的分区导出到归档目录后删除）
+    USAGE_PARTITION_PREMAKE_MONTHS: int = 2
+    USAGE_RETENTION_MONTHS: int = 12
+    USAGE_ARCHIVE_DIR: str = "/var/lib/gpt_proxy/archive"
+    USAGE_PARTITION_CHECK_INTERVAL_SECONDS: float = 3600.0
+    
+    # 模型价格（美元/1K tokens，计入聚合表total_cost），格式：模型名前缀:输入价格:输出价格，逗号分隔
+    MODEL_PRICES: str = ""
+    
+    @property
+    def MODEL_PRICE_LIST(self) -> List[Tuple[str, float, float]]:
+        """按前缀长度降序（最长前缀优先匹配）"""
+        prices = []
+        for item in self.MODEL_PRICES.split(","):
+            parts = [p.strip() for p in item.split(":")]
+            if len(parts) != 3 or not parts[0]:
+                continue
+            try:
+                prices.append((parts[0].lower(), float(parts[1]), float(parts[2])))
+            except ValueError:
+                continue
+        return sorted(prices, key=lambda p: len(p[0]), reverse=True)
+    
     # 配额
     DEFAULT_MONTHLY_QUOTA_TOKENS: int = 1000000
     DEFAULT_MONTHLY_QUOTA_AMOUNT: float = 10.0
+    # Redis月度用量计数器有效期，过期后从usage_monthly重新初始化（修正进程崩溃等导致的偏差）
+    QUOTA_COUNTER_TTL_SECONDS: float = 3600.0
     
     # 超时
     UPSTREAM_TIMEOUT: int = 300
     UPSTREAM_CONNECT_TIMEOUT: int = 30
     
+    # 上游连接池
+    UPSTREAM_HTTP2: bool = True
+    UPSTREAM_MAX_CONNECTIONS: int = 200
+    UPSTREAM_MAX_KEEPALIVE_CONNECTIONS: int = 50
+    UPSTREAM_KEEPALIVE_EXPIRY: float = 30.0
+    
+    # 流式透传（原样转发上游SSE字节，仅扫描usage）
+    STREAM_PASSTHROUGH: bool = True
+    
+    # 流式请求向上游注入 stream_options.include_usage（最后一个事件携带usage，用于结算TPM和配额）
+    STREAM_INCLUDE_USAGE: bool = True
+    
+    # 上游故障转移（首字节发出前，429/5xx/连接错误换Key重试）
+    UPSTREAM_MAX_ATTEMPTS: int = 3
+    UPSTREAM_FAILOVER_DEADLINE_SECONDS: float = 30.0
+    
+    # 对冲请求（非流式，延迟阈值取近期上游延迟的分位数）
+    UPSTREAM_LATENCY_WINDOW: int = 500
+    HEDGE_PERCENTILE: float = 0.95
+    HEDGE_MIN_SAMPLES: int = 20
+    HEDGE_MIN_DELAY_SECONDS: float = 1.0
+    HEDGE_DEFAULT_DELAY_SECONDS: float = 5.0
+    
     # Nginx（仅用于 docker-compose，API 不使用）
     NGINX_WORKER_PROCESSES: str = "auto"
     NGINX_WORKER_CONNECTIONS: int = 1024
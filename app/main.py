@@ -1,6 +1,7 @@
 """
 FastAPI 应用主入口
 """
+import asyncio
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 from app.api import chat, health
@@ -31,7 +32,7 @@ async def middleware_stack(request: Request, call_next):
         from app.services.rate_limiter import RateLimiter
         from app.config import settings
         client_ip = request.client.host if request.client else "unknown"
-        is_allowed, _ = RateLimiter.check_rate_limit(
+        is_allowed, _ = await RateLimiter.check_rate_limit(
             identifier=client_ip,
             limit_rpm=settings.RATE_LIMIT_IP_RPM,
             limit_tpm=settings.RATE_LIMIT_IP_TPM,
@@ -60,12 +61,46 @@ app.include_router(admin.router)
 async def startup_event():
     """启动事件"""
     logger.info("GPT Proxy Service starting up...")
+    from app.services.upstream_client import init_http_clients
+    from app.services.key_pool import KeyPoolService
+    from app.services.rate_limiter import HybridRateLimiter
+    from app.services.token_counter import TokenCounter
+    from app.services.concurrency_limiter import ConcurrencyLimiter
+    from app.services.cache_bus import CacheBus
+    from app.services.usage_writer import UsageWriter
+    from app.services.usage_partitions import UsagePartitionManager
+    init_http_clients()
+    await asyncio.to_thread(TokenCounter.load)
+    KeyPoolService.start_refresher()
+    HybridRateLimiter.start()
+    ConcurrencyLimiter.start()
+    CacheBus.start()
+    await UsagePartitionManager.start()
+    UsageWriter.start()
 
 
 @app.on_event("shutdown")
 async def shutdown_event():
     """关闭事件"""
     logger.info("GPT Proxy Service shutting down...")
+    from app.services.upstream_client import close_http_clients
+    from app.services.key_pool import KeyPoolService
+    from app.services.rate_limiter import HybridRateLimiter, RedisHealth, close_async_redis_client
+    from app.services.concurrency_limiter import ConcurrencyLimiter
+    from app.services.cache_bus import CacheBus
+    from app.services.usage_writer import UsageWriter
+    from app.services.usage_partitions import UsagePartitionManager
+    from app.utils.password import shutdown_executor
+    await UsageWriter.stop()
+    await UsagePartitionManager.stop()
+    await CacheBus.stop()
+    await KeyPoolService.stop_refresher()
+    await HybridRateLimiter.stop()
+    await ConcurrencyLimiter.stop()
+    await RedisHealth.stop()
+    await close_http_clients()
+    await close_async_redis_client()
+    shutdown_executor()
 
 
 if __name__ == "__main__":
@@ -3,9 +3,8 @@
 """
 from fastapi import Request, HTTPException, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from sqlalchemy.orm import Session
 from app.models.user import APIKey, User
-from app.models.base import get_db
+from app.services.auth_cache import AuthCache
 from app.utils.logger import logger
 
 security = HTTPBearer()
@@ -30,34 +29,29 @@ async def verify_api_key(request: Request, credentials: HTTPAuthorizationCredent
     else:
         token = credentials.credentials
     
-    # 从数据库查询
-    from app.models.base import SessionLocal
-    db: Session = SessionLocal()
-    try:
-        api_key = db.query(APIKey).filter(
-            APIKey.key == token,
-            APIKey.is_active == True
-        ).first()
-        
-        if not api_key:
-            logger.warning(f"Invalid API key attempted: {token[:10]}...")
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Invalid API key"
-            )
-        
-        user = db.query(User).filter(User.id == api_key.user_id).first()
-        if not user or not user.is_active:
-            raise HTTPException(
-                status_code=status.HTTP_403_FORBIDDEN,
-                detail="User is inactive"
-            )
-        
-        # 将user和api_key存储到request.state
-        request.state.user = user
-        request.state.api_key = api_key
-        
-        return user, api_key
-        
-    finally:
-        db.close()
+    # 先查缓存（含无效Key的负缓存），未命中时查询数据库
+    entry = AuthCache.get(token)
+    if entry is None:
+        user, api_key = await AuthCache.lookup(token)
+        entry = AuthCache.put(token, user, api_key)
+    user, api_key = entry.user, entry.api_key
+    
+    if not api_key:
+        logger.warning(f"Invalid API key attempted: {token[:10]}...")
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid API key"
+        )
+    
+    if not user or not user.is_active:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="User is inactive"
+        )
+    
+    # 将user和api_key存储到request.state（缓存对象为只读，请勿修改）
+    request.state.user = user
+    request.state.api_key = api_key
+    request.state.allowed_models = entry.allowed_models
+    
+    return user, api_key
@@ -23,7 +23,7 @@ async def rate_limit_middleware(request: Request, call_next):
     if not api_key:
         # 如果没有API Key，只进行IP限流
         from app.config import settings
-        is_allowed, info = RateLimiter.check_rate_limit(
+        is_allowed, info = await RateLimiter.check_rate_limit(
             identifier=client_ip,
             limit_rpm=settings.RATE_LIMIT_IP_RPM,
             limit_tpm=settings.RATE_LIMIT_IP_TPM,
@@ -2,6 +2,7 @@
 数据库基础模型
 """
 from sqlalchemy import create_engine, Column, Integer, DateTime
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.sql import func
@@ -19,6 +20,19 @@ engine = create_engine(
 # 创建会话工厂
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# 异步引擎（asyncpg，用于代理请求热路径；同步引擎保留给管理接口和脚本）
+async_engine = create_async_engine(
+    settings.ASYNC_DATABASE_URL,
+    pool_size=settings.DB_ASYNC_POOL_SIZE,
+    max_overflow=settings.DB_ASYNC_MAX_OVERFLOW,
+    pool_pre_ping=True,
+    echo=settings.DEBUG
+)
+
+# 异步会话工厂（提交后不过期，对象在会话关闭后仍可读取）
+# 热路径上每次数据库操作使用独立的短会话，不在整个（流式）请求期间占用连接
+AsyncSessionLocal = async_sessionmaker(async_engine, expire_on_commit=False, autoflush=False)
+
 # 声明基类
 Base = declarative_base()
 
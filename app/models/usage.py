@@ -1,21 +1,26 @@
 """
 用量统计模型
 """
-from sqlalchemy import Column, String, Integer, Float, DateTime, Text, ForeignKey, Index
+from sqlalchemy import BigInteger, Column, String, Integer, Float, DateTime, Text, ForeignKey, Index
 from sqlalchemy.orm import relationship
+from sqlalchemy.sql import func
 from app.models.base import BaseModel
 
 
 class UsageRecord(BaseModel):
-    """请求记录表（审计日志）"""
+    """请求记录表（审计日志，按 created_at 月度分区，分区由 UsagePartitionManager 维护）"""
     __tablename__ = "usage_records"
     
-    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
+    # 分区表的主键必须包含分区键
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    created_at = Column(DateTime(timezone=True), primary_key=True, server_default=func.now())
+    
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     api_key_id = Column(Integer, ForeignKey("api_keys.id"), nullable=True, index=True)
-    upstream_key_id = Column(Integer, ForeignKey("upstream_keys.id"), nullable=True, index=True)
+    upstream_key_id = Column(Integer, ForeignKey("upstream_keys.id"), nullable=True)
     
     # 请求信息
-    model = Column(String(100), nullable=False, index=True)
+    model = Column(String(100), nullable=False)
     prompt_tokens = Column(Integer, default=0, nullable=False)
     completion_tokens = Column(Integer, default=0, nullable=False)
     total_tokens = Column(Integer, default=0, nullable=False)
@@ -26,7 +31,7 @@ class UsageRecord(BaseModel):
     response_time_ms = Column(Float, nullable=False)  # 响应时间（毫秒）
     
     # 客户端信息
-    client_ip = Column(String(50), nullable=True, index=True)
+    client_ip = Column(String(50), nullable=True)
     user_agent = Column(String(500), nullable=True)
     
     # 错误信息
@@ -37,10 +42,11 @@ class UsageRecord(BaseModel):
     user = relationship("User", back_populates="usage_records")
     api_key = relationship("APIKey", back_populates="usage_records")
     
-    # 索引
+    # 索引（只写表，索引越少写入越快；按时间的查询依赖分区裁剪 + BRIN）
     __table_args__ = (
         Index('idx_usage_user_date', 'user_id', 'created_at'),
-        Index('idx_usage_date', 'created_at'),
+        Index('idx_usage_date', 'created_at', postgresql_using='brin'),
+        {"postgresql_partition_by": "RANGE (created_at)"},
     )
 
 
@@ -21,6 +21,9 @@ class User(BaseModel):
     monthly_quota_tokens = Column(Integer, default=1000000, nullable=False)
     monthly_quota_amount = Column(Float, default=10.0, nullable=False)
     
+    # 并发限制（覆盖全局设置，0表示不限制）
+    max_concurrency = Column(Integer, nullable=True)
+    
     # 关联
     api_keys = relationship("APIKey", back_populates="user", cascade="all, delete-orphan")
     usage_records = relationship("UsageRecord", back_populates="user")
@@ -41,6 +44,10 @@ class APIKey(BaseModel):
     # 速率限制（覆盖全局设置）
     rate_limit_rpm = Column(Integer, nullable=True)
     rate_limit_tpm = Column(Integer, nullable=True)
+    max_concurrency = Column(Integer, nullable=True)  # 并发限制
+    
+    # 对冲请求（非流式请求慢时通过另一个上游Key并发重发）
+    hedge_requests = Column(Boolean, default=False, nullable=False)
     
     # 关联
     user = relationship("User", back_populates="api_keys")
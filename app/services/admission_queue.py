@@ -0,0 +1,150 @@
+"""
+准入排队（进程内）
+限流/并发/上游容量不足时，请求在客户端指定的截止时间内排队等待，而不是立即返回429。
+各用户的等待请求按FIFO排队，用户之间轮转，同一时刻只有一个排队请求尝试准入：
+准入成功立即轮到下一个，失败则间隔一段时间后再轮转，避免重试风暴。
+"""
+import asyncio
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, Tuple
+from app.config import settings
+
+# 准入尝试：返回 (准入结果, 附加信息)，准入结果为真值表示成功
+AdmissionAttempt = Callable[[], Awaitable[Tuple[Any, Any]]]
+
+
+class _Waiter:
+    """排队中的请求"""
+    
+    __slots__ = ("user_id", "turn")
+    
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self.turn = asyncio.Event()
+
+
+class AdmissionQueue:
+    """准入队列"""
+    
+    # 用户ID -> 该用户的等待队列
+    _queues: Dict[int, Deque[_Waiter]] = {}
+    
+    # 有等待请求的用户（轮转顺序）
+    _users: Deque[int] = deque()
+    
+    _depth = 0
+    _active: Optional[_Waiter] = None  # 当前正在尝试准入的请求
+    _timer: Optional[asyncio.TimerHandle] = None
+    
+    # 累计统计
+    _admitted = 0
+    _timed_out = 0
+    _rejected = 0
+    
+    @staticmethod
+    def deadline_from_header(value: Optional[str], start_time: float) -> Optional[float]:
+        """解析请求头 X-Queue-Timeout（秒），返回截止时间；未开启或未指定时返回None"""
+        if not settings.ADMISSION_QUEUE_ENABLED or not value:
+            return None
+        try:
+            timeout = float(value)
+        except ValueError:
+            return None
+        if timeout <= 0:
+            return None
+        return start_time + min(timeout, settings.ADMISSION_QUEUE_MAX_WAIT_SECONDS)
+    
+    @staticmethod
+    def _grant():
+        """把准入机会交给下一个用户的队首请求"""
+        AdmissionQueue._timer = None
+        if AdmissionQueue._active is not None:
+            return
+        users = AdmissionQueue._users
+        while users:
+            user_id = users[0]
+            users.rotate(-1)
+            queue = AdmissionQueue._queues.get(user_id)
+            if queue:
+                AdmissionQueue._active = queue[0]
+                queue[0].turn.set()
+                return
+    
+    @staticmethod
+    def _schedule(delay: float):
+        """安排下一次准入机会"""
+        if AdmissionQueue._active is not None or AdmissionQueue._timer is not None:
+            return
+        AdmissionQueue._timer = asyncio.get_running_loop().call_later(max(0.0, delay), AdmissionQueue._grant)
+    
+    @staticmethod
+    async def wait(user_id: int, deadline: float, attempt: AdmissionAttempt) -> Optional[Tuple[Any, Any]]:
+        """
+        排队等待准入
+        
+        Args:
+            deadline: 截止时间（time.time()）
+            attempt: 准入尝试，轮到该请求时调用
+        
+        Returns:
+            最后一次准入尝试的结果；队列已满时返回None，截止前从未轮到时返回None
+        """
+        if AdmissionQueue._depth >= settings.ADMISSION_QUEUE_MAX_LENGTH:
+            AdmissionQueue._rejected += 1
+            return None
+        
+        waiter = _Waiter(user_id)
+        queue = AdmissionQueue._queues.get(user_id)
+        if queue is None:
+            queue = AdmissionQueue._queues[user_id] = deque()
+            AdmissionQueue._users.append(user_id)
+        queue.append(waiter)
+        AdmissionQueue._depth += 1
+        retry_interval = settings.ADMISSION_QUEUE_RETRY_INTERVAL_SECONDS
+        AdmissionQueue._schedule(retry_interval)
+        
+        result = None
+        try:
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(waiter.turn.wait(), remaining)
+                except asyncio.TimeoutError:
+                    break
+                waiter.turn.clear()
+                
+                result = await attempt()
+                if result[0]:
+                    AdmissionQueue._admitted += 1
+                    return result
+                
+                # 仍无容量：交出机会，间隔后轮到下一个用户
+                AdmissionQueue._active = None
+                AdmissionQueue._schedule(retry_interval)
+            
+            AdmissionQueue._timed_out += 1
+            return result
+        finally:
+            queue.remove(waiter)
+            AdmissionQueue._depth -= 1
+            if not queue:
+                AdmissionQueue._queues.pop(user_id, None)
+                AdmissionQueue._users.remove(user_id)
+            if AdmissionQueue._active is waiter:
+                # 准入成功（或放弃时正持有机会）：立即交给下一个
+                AdmissionQueue._active = None
+                AdmissionQueue._schedule(0)
+    
+    @staticmethod
+    def stats() -> dict:
+        """队列指标（本进程）"""
+        return {
+            "depth": AdmissionQueue._depth,
+            "waiting_users": len(AdmissionQueue._users),
+            "admitted": AdmissionQueue._admitted,
+            "timed_out": AdmissionQueue._timed_out,
+            "rejected": AdmissionQueue._rejected
+        }
@@ -0,0 +1,115 @@
+"""
+API Key鉴权缓存（进程内LRU + TTL）
+缓存 API Key哈希 -> (用户, Key, 解析后的允许模型)，无效Key单独缓存（较短TTL、较小容量），
+命中时鉴权无需访问数据库
+"""
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+from sqlalchemy import select
+from app.config import settings
+from app.models.user import APIKey, User
+
+
+class AuthCacheEntry:
+    """鉴权结果（User和APIKey为已脱离会话的只读对象）"""
+    
+    __slots__ = ("user", "api_key", "allowed_models", "expires_at")
+    
+    def __init__(self, user: Optional[User], api_key: Optional[APIKey], ttl: float):
+        self.user = user
+        self.api_key = api_key
+        self.allowed_models: Optional[List[str]] = None
+        if api_key is not None and api_key.allowed_models:
+            allowed = api_key.allowed_models
+            self.allowed_models = json.loads(allowed) if isinstance(allowed, str) else allowed
+        self.expires_at = time.monotonic() + ttl
+
+
+class AuthCache:
+    """鉴权缓存"""
+    
+    # Key哈希 -> AuthCacheEntry（有效Key）
+    _entries: "OrderedDict[str, AuthCacheEntry]" = OrderedDict()
+    
+    # Key哈希 -> AuthCacheEntry（无效Key，单独限制容量，扫描大量无效Key时不会挤掉有效Key）
+    _negative: "OrderedDict[str, AuthCacheEntry]" = OrderedDict()
+    
+    @staticmethod
+    def hash_token(token: str) -> str:
+        """缓存键（内存中不保存明文Key）"""
+        return hashlib.sha256(token.encode("utf-8")).hexdigest()
+    
+    @staticmethod
+    def _get_from(cache: "OrderedDict[str, AuthCacheEntry]", key: str) -> Optional[AuthCacheEntry]:
+        """从指定缓存获取未过期的缓存项"""
+        entry = cache.get(key)
+        if entry is None:
+            return None
+        if entry.expires_at <= time.monotonic():
+            cache.pop(key, None)
+            return None
+        cache.move_to_end(key)
+        return entry
+    
+    @staticmethod
+    def get(token: str) -> Optional[AuthCacheEntry]:
+        """获取未过期的缓存项"""
+        key = AuthCache.hash_token(token)
+        return AuthCache._get_from(AuthCache._entries, key) or AuthCache._get_from(AuthCache._negative, key)
+    
+    @staticmethod
+    def put(token: str, user: Optional[User], api_key: Optional[APIKey]) -> AuthCacheEntry:
+        """写入鉴权结果（api_key为None时写入无效Key缓存）"""
+        key = AuthCache.hash_token(token)
+        if api_key is not None:
+            entry = AuthCacheEntry(user, api_key, settings.AUTH_CACHE_TTL_SECONDS)
+            cache, size = AuthCache._entries, settings.AUTH_CACHE_SIZE
+            AuthCache._negative.pop(key, None)
+        else:
+            entry = AuthCacheEntry(user, api_key, settings.AUTH_CACHE_NEGATIVE_TTL_SECONDS)
+            cache, size = AuthCache._negative, settings.AUTH_CACHE_NEGATIVE_SIZE
+            AuthCache._entries.pop(key, None)
+        cache[key] = entry
+        cache.move_to_end(key)
+        while len(cache) > size:
+            cache.popitem(last=False)
+        return entry
+    
+    @staticmethod
+    def invalidate(token: Optional[str] = None):
+        """失效指定Key（不指定时清空全部）"""
+        if token is None:
+            AuthCache._entries.clear()
+            AuthCache._negative.clear()
+        else:
+            AuthCache.invalidate_hash(AuthCache.hash_token(token))
+    
+    @staticmethod
+    def invalidate_hash(key: str):
+        """按Key哈希失效（缓存失效事件中只传递哈希）"""
+        AuthCache._entries.pop(key, None)
+        AuthCache._negative.pop(key, None)
+    
+    @staticmethod
+    def invalidate_user(user_id: int):
+        """失效指定用户的所有Key"""
+        for key, entry in list(AuthCache._entries.items()):
+            if entry.user is not None and entry.user.id == user_id:
+                AuthCache._entries.pop(key, None)
+    
+    @staticmethod
+    async def lookup(token: str) -> Tuple[Optional[User], Optional[APIKey]]:
+        """从数据库查询鉴权信息（异步，不阻塞事件循环；结果对象已脱离会话）"""
+        from app.models.base import AsyncSessionLocal
+        async with AsyncSessionLocal() as db:
+            api_key = (await db.execute(
+                select(APIKey).filter(APIKey.key == token, APIKey.is_active == True).limit(1)
+            )).scalar_one_or_none()
+            if not api_key:
+                return None, None
+            user = (await db.execute(select(User).filter(User.id == api_key.user_id))).scalar_one_or_none()
+            db.expunge_all()
+            return user, api_key
@@ -0,0 +1,118 @@
+"""
+缓存失效总线（Redis pub/sub）
+管理端修改用户/API Key/上游Key后发布变更事件，所有worker订阅并清除对应的进程内缓存
+"""
+import asyncio
+import json
+from typing import Optional
+from app.services.auth_cache import AuthCache
+from app.services.rate_limiter import get_async_redis_client, get_redis_client
+from app.utils.logger import logger
+
+CACHE_INVALIDATION_CHANNEL = "cache_invalidation"
+
+# 实体类型
+ENTITY_USER = "user"
+ENTITY_API_KEY = "api_key"
+ENTITY_UPSTREAM_KEY = "upstream_key"
+
+
+class CacheBus:
+    """缓存失效总线"""
+    
+    _subscriber_task: Optional[asyncio.Task] = None
+    
+    @staticmethod
+    def _build_event(entity: str, entity_id: Optional[int] = None, key: Optional[str] = None) -> dict:
+        """构造变更事件（API Key只传递哈希，不在Redis中广播明文）"""
+        return {"entity": entity, "id": entity_id, "key": AuthCache.hash_token(key) if key else None}
+    
+    @staticmethod
+    def apply(event: dict):
+        """按变更事件清除本进程缓存"""
+        entity = event.get("entity")
+        if entity == ENTITY_API_KEY:
+            if event.get("key"):
+                AuthCache.invalidate_hash(event["key"])
+            else:
+                AuthCache.invalidate()
+        elif entity == ENTITY_USER:
+            if event.get("id") is not None:
+                AuthCache.invalidate_user(event["id"])
+            else:
+                AuthCache.invalidate()
+        elif entity == ENTITY_UPSTREAM_KEY:
+            from app.services.key_pool import KeyPoolService
+            KeyPoolService.invalidate()
+    
+    @staticmethod
+    def invalidate_all():
+        """清除本进程全部缓存（订阅中断期间可能漏掉事件）"""
+        from app.services.key_pool import KeyPoolService
+        AuthCache.invalidate()
+        KeyPoolService.invalidate()
+    
+    @staticmethod
+    async def publish(entity: str, entity_id: Optional[int] = None, key: Optional[str] = None):
+        """发布变更事件（本进程立即生效，Redis不可用时其他worker在缓存TTL后生效）"""
+        event = CacheBus._build_event(entity, entity_id, key)
+        CacheBus.apply(event)
+        try:
+            await get_async_redis_client().publish(CACHE_INVALIDATION_CHANNEL, json.dumps(event))
+        except Exception as e:
+            logger.error(f"Failed to publish cache invalidation ({entity}): {e}")
+    
+    @staticmethod
+    def publish_sync(entity: str, entity_id: Optional[int] = None, key: Optional[str] = None):
+        """发布变更事件（同步版本，用于管理脚本）"""
+        event = CacheBus._build_event(entity, entity_id, key)
+        try:
+            get_redis_client().publish(CACHE_INVALIDATION_CHANNEL, json.dumps(event))
+        except Exception as e:
+            logger.error(f"Failed to publish cache invalidation ({entity}): {e}")
+    
+    @staticmethod
+    async def _subscribe_loop():
+        """订阅变更事件，断线后重连"""
+        while True:
+            pubsub = get_async_redis_client().pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.subscribe(CACHE_INVALIDATION_CHANNEL)
+                # 订阅建立前的事件收不到（包括首次订阅前启动期间写入的缓存），每次订阅成功后清空
+                CacheBus.invalidate_all()
+                while True:
+                    message = await pubsub.get_message(timeout=30.0)
+                    if message is None:
+                        continue
+                    try:
+                        CacheBus.apply(json.loads(message["data"]))
+                    except (ValueError, TypeError) as e:
+                        logger.warning(f"Ignored malformed cache invalidation message: {e}")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Cache invalidation subscriber disconnected: {e}")
+                await asyncio.sleep(1)
+            finally:
+                try:
+                    await pubsub.aclose()
+                except Exception:
+                    pass
+    
+    @staticmethod
+    def start():
+        """启动订阅任务"""
+        if CacheBus._subscriber_task is None:
+            CacheBus._subscriber_task = asyncio.create_task(CacheBus._subscribe_loop())
+    
+    @staticmethod
+    async def stop():
+        """停止订阅任务"""
+        task = CacheBus._subscriber_task
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+            CacheBus._subscriber_task = None
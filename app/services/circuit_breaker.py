@@ -0,0 +1,172 @@
+"""
+上游密钥熔断器（基于Redis，所有worker/副本共享状态）
+状态机：closed -> open -> half_open -> closed
+"""
+import time
+from typing import Optional
+from app.config import settings
+from app.services.rate_limiter import RedisHealth, get_async_redis_client
+from app.utils.logger import logger
+
+# 原子状态转换脚本
+# KEYS[1]: 熔断器key
+# ARGV: action, now_ms, failure_threshold, cooldown_ms, recovery_threshold, half_open_max_requests, ttl_seconds
+# 返回: {状态, 是否发生转换, 是否放行}
+CIRCUIT_BREAKER_SCRIPT = """
+local key = KEYS[1]
+local action = ARGV[1]
+local now = tonumber(ARGV[2])
+local failure_threshold = tonumber(ARGV[3])
+local cooldown = tonumber(ARGV[4])
+local recovery_threshold = tonumber(ARGV[5])
+local half_open_max = tonumber(ARGV[6])
+local ttl = tonumber(ARGV[7])
+
+local function num(field)
+    local value = redis.call('HGET', key, field)
+    if value then
+        return tonumber(value)
+    end
+    return 0
+end
+
+local state = redis.call('HGET', key, 'state') or 'closed'
+
+if action == 'allow' then
+    if state == 'closed' then
+        return {state, 0, 1}
+    end
+    local changed = 0
+    if state == 'open' then
+        if now < num('open_until') then
+            return {state, 0, 0}
+        end
+        redis.call('HSET', key, 'state', 'half_open', 'probes', 0, 'successes', 0, 'probe_until', now + cooldown)
+        redis.call('EXPIRE', key, ttl)
+        state = 'half_open'
+        changed = 1
+    end
+    -- half_open：只放行有限数量的探测请求，探测超时后重新放行
+    -- （成功数跨探测窗口累计，恢复阈值大于单个窗口的探测数时仍能关闭；任一探测失败即重新打开）
+    if num('probes') >= half_open_max then
+        if now < num('probe_until') then
+            return {state, changed, 0}
+        end
+        redis.call('HSET', key, 'probes', 0, 'probe_until', now + cooldown)
+    end
+    redis.call('HINCRBY', key, 'probes', 1)
+    return {state, changed, 1}
+end
+
+if action == 'success' then
+    if state == 'half_open' then
+        if redis.call('HINCRBY', key, 'successes', 1) >= recovery_threshold then
+            redis.call('DEL', key)
+            return {'closed', 1, 1}
+        end
+        return {state, 0, 1}
+    end
+    if state == 'closed' and num('failures') > 0 then
+        redis.call('HSET', key, 'failures', 0)
+    end
+    return {state, 0, 1}
+end
+
+if action == 'failure' then
+    if state == 'open' then
+        return {state, 0, 0}
+    end
+    if state == 'closed' and redis.call('HINCRBY', key, 'failures', 1) < failure_threshold then
+        redis.call('HSET', key, 'state', 'closed')
+        redis.call('EXPIRE', key, ttl)
+        return {state, 0, 1}
+    end
+    -- 连续失败达到阈值，或half_open探测失败：打开熔断
+    redis.call('HSET', key, 'state', 'open', 'open_until', now + cooldown, 'probes', 0, 'successes', 0)
+    redis.call('EXPIRE', key, ttl)
+    return {'open', 1, 0}
+end
+
+if action == 'trip' then
+    -- 按指定时长立即打开熔断（如上游429的retry-after），不缩短已有的熔断时间
+    local open_until = now + cooldown
+    if state == 'open' and num('open_until') >= open_until then
+        return {state, 0, 0}
+    end
+    redis.call('HSET', key, 'state', 'open', 'open_until', open_until, 'probes', 0, 'successes', 0)
+    redis.call('EXPIRE', key, ttl)
+    return {'open', 1, 0}
+end
+
+return {state, 0, 1}
+"""
+
+
+class CircuitBreaker:
+    """熔断器"""
+    
+    _script = None
+    
+    @staticmethod
+    def _get_key(key_id: int) -> str:
+        """生成Redis key"""
+        return f"circuit_breaker:upstream:{key_id}"
+    
+    @staticmethod
+    async def _run(action: str, key_id: int, cooldown_seconds: Optional[float] = None) -> Optional[tuple[str, bool, bool]]:
+        """执行状态转换脚本，Redis不可用时返回None"""
+        if not RedisHealth.is_available():
+            return None
+        try:
+            if CircuitBreaker._script is None:
+                CircuitBreaker._script = get_async_redis_client().register_script(CIRCUIT_BREAKER_SCRIPT)
+            cooldown = cooldown_seconds if cooldown_seconds is not None else settings.CIRCUIT_BREAKER_COOLDOWN_SECONDS
+            state, changed, allowed = await CircuitBreaker._script(
+                keys=[CircuitBreaker._get_key(key_id)],
+                args=[
+                    action,
+                    int(time.time() * 1000),
+                    settings.CIRCUIT_BREAKER_FAILURE_THRESHOLD,
+                    int(cooldown * 1000),
+                    settings.CIRCUIT_BREAKER_RECOVERY_THRESHOLD,
+                    settings.CIRCUIT_BREAKER_HALF_OPEN_MAX_REQUESTS,
+                    max(3600, int(cooldown) * 10)
+                ]
+            )
+            return state, bool(changed), bool(allowed)
+        except Exception as e:
+            logger.error(f"Circuit breaker {action} failed for upstream key {key_id}: {e}")
+            RedisHealth.record_error(e)
+            return None
+    
+    @staticmethod
+    async def allow_request(key_id: int) -> bool:
+        """是否允许向该密钥发送请求（Redis不可用时放行）"""
+        result = await CircuitBreaker._run("allow", key_id)
+        if result is None:
+            return True
+        state, changed, allowed = result
+        if changed:
+            logger.info(f"Upstream key {key_id} circuit half-open, admitting probe requests")
+        return allowed
+    
+    @staticmethod
+    async def record_success(key_id: int):
+        """记录成功请求（half_open下累计成功次数达到阈值后关闭熔断）"""
+        result = await CircuitBreaker._run("success", key_id)
+        if result and result[1]:
+            logger.info(f"Upstream key {key_id} circuit closed after successful probes")
+    
+    @staticmethod
+    async def record_failure(key_id: int, cooldown_seconds: Optional[float] = None):
+        """记录失败请求（连续失败达到阈值或探测失败时打开熔断）"""
+        result = await CircuitBreaker._run("failure", key_id, cooldown_seconds)
+        if result and result[1]:
+            logger.warning(f"Upstream key {key_id} circuit opened")
+    
+    @staticmethod
+    async def trip(key_id: int, cooldown_seconds: float):
+        """立即打开熔断指定时长（上游明确要求等待时使用）"""
+        result = await CircuitBreaker._run("trip", key_id, cooldown_seconds)
+        if result and result[1]:
+            logger.warning(f"Upstream key {key_id} circuit opened for {cooldown_seconds:.1f}s (retry-after)")
@@ -0,0 +1,179 @@
+"""
+并发限制（舱壁隔离，基于Redis，所有worker/副本共享）
+按API Key、用户和全局限制同时在途的请求数；许可以租约形式持有，
+持有期间后台定期续租，进程崩溃后租约到期自动释放
+"""
+import asyncio
+import time
+import anyio
+import uuid
+from typing import Dict, List, Optional, Tuple
+from app.config import settings
+from app.services.rate_limiter import RedisHealth, get_async_redis_client
+from app.utils.logger import logger
+
+# 原子获取许可（所有范围都有余量时才占用）
+# KEYS: 各范围的许可集合（zset，member为许可ID，score为租约到期时间）
+# ARGV: now_ms, expires_ms, permit_id, ttl_ms, limit_1, limit_2, ...
+# 返回: {被拒绝的范围序号（0表示获取成功）, 该范围当前在途数}
+ACQUIRE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local expires = tonumber(ARGV[2])
+local permit_id = ARGV[3]
+local ttl = tonumber(ARGV[4])
+
+for i, key in ipairs(KEYS) do
+    redis.call('ZREMRANGEBYSCORE', key, '-inf', now)
+    local in_flight = redis.call('ZCARD', key)
+    if in_flight >= tonumber(ARGV[4 + i]) then
+        return {i, in_flight}
+    end
+end
+
+for _, key in ipairs(KEYS) do
+    redis.call('ZADD', key, expires, permit_id)
+    redis.call('PEXPIRE', key, ttl)
+end
+return {0, 0}
+"""
+
+
+class ConcurrencyPermit:
+    """并发许可（请求结束时释放，可重复调用）"""
+    
+    def __init__(self, permit_id: str, keys: List[str]):
+        self.permit_id = permit_id
+        self.keys = keys
+        self.released = False
+    
+    async def release(self):
+        """释放许可（客户端断开导致的取消不会中断释放）"""
+        if self.released:
+            return
+        # 先停止续租；released 在ZREM完成后才置位，释放未完成时后续调用（如响应的后台任务）会再次释放
+        ConcurrencyLimiter._permits.pop(self.permit_id, None)
+        if not self.keys or not RedisHealth.is_available():
+            self.released = True
+            return
+        with anyio.CancelScope(shield=True):
+            try:
+                pipe = get_async_redis_client().pipeline(transaction=False)
+                for key in self.keys:
+                    pipe.zrem(key, self.permit_id)
+                await pipe.execute()
+            except Exception as e:
+                # 租约到期后自动释放
+                logger.error(f"Failed to release concurrency permit: {e}")
+                RedisHealth.record_error(e)
+            self.released = True
+
+
+class ConcurrencyLimiter:
+    """并发限制器"""
+    
+    _script = None
+    
+    # 本进程持有的许可（后台续租）
+    _permits: Dict[str, ConcurrencyPermit] = {}
+    _renew_task: Optional[asyncio.Task] = None
+    
+    @staticmethod
+    def _get_key(scope: str, identifier) -> str:
+        """生成Redis key"""
+        return f"concurrency:{scope}:{identifier}"
+    
+    @staticmethod
+    async def acquire(
+        api_key_id: int,
+        user_id: int,
+        key_limit: Optional[int] = None,
+        user_limit: Optional[int] = None
+    ) -> Tuple[Optional[ConcurrencyPermit], dict]:
+        """
+        获取并发许可
+        
+        Args:
+            key_limit/user_limit: API Key/用户级覆盖值，为空时使用全局配置（0表示不限制）
+        
+        Returns:
+            (许可, 信息)，超出限制时许可为None；Redis不可用时放行（不限制并发）
+        """
+        scopes = [
+            ("key", ConcurrencyLimiter._get_key("key", api_key_id),
+             key_limit if key_limit is not None else settings.CONCURRENCY_LIMIT_PER_KEY),
+            ("user", ConcurrencyLimiter._get_key("user", user_id),
+             user_limit if user_limit is not None else settings.CONCURRENCY_LIMIT_PER_USER),
+            ("global", ConcurrencyLimiter._get_key("global", "all"), settings.CONCURRENCY_LIMIT_GLOBAL),
+        ]
+        scopes = [scope for scope in scopes if scope[2] > 0]
+        if not settings.CONCURRENCY_LIMIT_ENABLED or not scopes or not RedisHealth.is_available():
+            return ConcurrencyPermit(uuid.uuid4().hex, []), {}
+        
+        permit = ConcurrencyPermit(uuid.uuid4().hex, [key for _, key, _ in scopes])
+        ttl_ms = int(settings.CONCURRENCY_LEASE_TTL_SECONDS * 1000)
+        now_ms = int(time.time() * 1000)
+        try:
+            if ConcurrencyLimiter._script is None:
+                ConcurrencyLimiter._script = get_async_redis_client().register_script(ACQUIRE_SCRIPT)
+            rejected, in_flight = await ConcurrencyLimiter._script(
+                keys=permit.keys,
+                args=[now_ms, now_ms + ttl_ms, permit.permit_id, ttl_ms] + [limit for _, _, limit in scopes]
+            )
+        except Exception as e:
+            logger.error(f"Concurrency limit check failed: {e}")
+            RedisHealth.record_error(e)
+            return ConcurrencyPermit(uuid.uuid4().hex, []), {}
+        
+        if rejected:
+            scope, _, limit = scopes[rejected - 1]
+            return None, {"scope": scope, "limit": limit, "in_flight": in_flight}
+        
+        ConcurrencyLimiter._permits[permit.permit_id] = permit
+        return permit, {}
+    
+    @staticmethod
+    async def _renew_all():
+        """续租本进程持有的所有许可"""
+        permits = list(ConcurrencyLimiter._permits.values())
+        if not permits or not RedisHealth.is_available():
+            return
+        ttl_ms = int(settings.CONCURRENCY_LEASE_TTL_SECONDS * 1000)
+        expires_ms = int(time.time() * 1000) + ttl_ms
+        pipe = get_async_redis_client().pipeline(transaction=False)
+        for permit in permits:
+            for key in permit.keys:
+                # 只续租仍存在的许可（已过期被清理的不再恢复）
+                pipe.zadd(key, {permit.permit_id: expires_ms}, xx=True)
+                pipe.pexpire(key, ttl_ms)
+        await pipe.execute()
+    
+    @staticmethod
+    async def _renew_loop():
+        """后台循环：每1/3租约时间续租一次"""
+        while True:
+            await asyncio.sleep(settings.CONCURRENCY_LEASE_TTL_SECONDS / 3)
+            try:
+                await ConcurrencyLimiter._renew_all()
+            except Exception as e:
+                logger.error(f"Failed to renew concurrency permits: {e}")
+                RedisHealth.record_error(e)
+    
+    @staticmethod
+    def start():
+        """启动后台续租任务"""
+        if settings.CONCURRENCY_LIMIT_ENABLED and ConcurrencyLimiter._renew_task is None:
+            ConcurrencyLimiter._renew_task = asyncio.create_task(ConcurrencyLimiter._renew_loop())
+    
+    @staticmethod
+    async def stop():
+        """停止后台任务并释放所有许可"""
+        task = ConcurrencyLimiter._renew_task
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+            ConcurrencyLimiter._renew_task = None
+        for permit in list(ConcurrencyLimiter._permits.values()):
+            await permit.release()
@@ -1,122 +1,323 @@
 """
 上游Key池管理服务
-支持轮询、权重、熔断
+支持轮询、权重、最少在途请求、延迟EWMA、熔断
 """
+from sqlalchemy import update
 from sqlalchemy.orm import Session
-from sqlalchemy import and_
-from datetime import datetime, timedelta
-from typing import Optional, List
+from datetime import datetime
+from typing import Optional, List, Dict, Iterator, Tuple
+from collections import OrderedDict
+from itertools import accumulate, count
+from bisect import bisect_right
+import asyncio
 import random
+from app.models.base import AsyncSessionLocal, SessionLocal
 from app.models.upstream import UpstreamKey, UpstreamKeyStatus
+from app.services.upstream_stats import UpstreamStats
+from app.services.circuit_breaker import CircuitBreaker
 from app.utils.encryption import decrypt_key
 from app.config import settings
 from app.utils.logger import logger
 
 
+class KeyPoolSnapshot:
+    """单个上游类型的Key池快照（预计算权重表）"""
+    
+    def __init__(self, keys: List[UpstreamKey]):
+        self.keys = keys
+        self.cumulative_weights = list(accumulate(max(k.weight, 0) for k in keys))
+        self.total_weight = self.cumulative_weights[-1] if keys else 0
+
+
 class KeyPoolService:
     """Key池服务"""
     
+    # 进程内快照：upstream_type -> KeyPoolSnapshot
+    _snapshots: Dict[str, KeyPoolSnapshot] = {}
+    _snapshot_loaded: bool = False
+    _refresh_event: Optional[asyncio.Event] = None
+    _refresh_task: Optional[asyncio.Task] = None
+    
+    # 轮询计数器：upstream_type -> count()
+    _round_robin_counters: Dict[str, Iterator[int]] = {}
+    
+    # 解密后的密钥缓存（LRU）：(key_id, 密文) -> 明文，密文变化即视为轮换
+    _decrypted_keys: "OrderedDict[Tuple[int, str], str]" = OrderedDict()
+    
     @staticmethod
-    def get_healthy_keys(db: Session, upstream_type: str) -> List[UpstreamKey]:
-        """获取健康的上游密钥"""
+    def refresh_snapshot(db: Session):
+        """从数据库重建Key池快照（同时恢复冷却期已结束的密钥）"""
         now = datetime.utcnow()
         
-        # 查询健康或需要检查恢复的密钥
-        keys = db.query(UpstreamKey).filter(
-            and_(
-                UpstreamKey.upstream_type == upstream_type,
-                UpstreamKey.status.in_([UpstreamKeyStatus.HEALTHY.value, UpstreamKeyStatus.COOLDOWN.value])
-            )
+        # 冷却期结束的密钥恢复为健康
+        cooldown_keys = db.query(UpstreamKey).filter(
+            UpstreamKey.status == UpstreamKeyStatus.COOLDOWN.value
         ).all()
+        recovered = False
+        for key in cooldown_keys:
+            if key.cooldown_until:
+                cooldown_time = datetime.fromisoformat(key.cooldown_until.replace('Z', '+00:00'))
+                if now < cooldown_time.replace(tzinfo=None):
+                    continue  # 仍在冷却期
+            key.status = UpstreamKeyStatus.HEALTHY.value
+            key.failure_count = 0
+            key.cooldown_until = None
+            recovered = True
+            logger.info(f"Upstream key {key.id} recovered from cooldown")
+        if recovered:
+            db.commit()
+        
+        keys = db.query(UpstreamKey).filter(
+            UpstreamKey.status == UpstreamKeyStatus.HEALTHY.value
+        ).order_by(UpstreamKey.id).all()
+        # 快照对象会在会话关闭后继续使用，不再关联会话
+        db.expunge_all()
         
-        healthy_keys = []
+        keys_by_type: Dict[str, List[UpstreamKey]] = {}
         for key in keys:
-            # 检查cooldown是否到期
-            if key.status == UpstreamKeyStatus.COOLDOWN.value:
-                if key.cooldown_until:
-                    cooldown_time = datetime.fromisoformat(key.cooldown_until.replace('Z', '+00:00'))
-                    if now < cooldown_time.replace(tzinfo=None):
-                        continue  # 仍在冷却期
-                    else:
-                        # 冷却期结束，尝试恢复
-                        key.status = UpstreamKeyStatus.HEALTHY.value
-                        key.failure_count = 0
-                        key.cooldown_until = None
-                        db.commit()
-                        logger.info(f"Upstream key {key.id} recovered from cooldown")
-            
-            if key.status == UpstreamKeyStatus.HEALTHY.value:
-                healthy_keys.append(key)
-        
-        return healthy_keys
-    
-    @staticmethod
-    def select_key(db: Session, upstream_type: str, strategy: str = "weighted") -> Optional[UpstreamKey]:
+            keys_by_type.setdefault(key.upstream_type, []).append(key)
+        
+        KeyPoolService._snapshots = {
+            upstream_type: KeyPoolSnapshot(type_keys)
+            for upstream_type, type_keys in keys_by_type.items()
+        }
+        KeyPoolService._snapshot_loaded = True
+        
+        # 清理已轮换或已下线密钥的解密缓存
+        current_versions = {(key.id, key.encrypted_key) for key in keys}
+        for cache_key in list(KeyPoolService._decrypted_keys):
+            if cache_key not in current_versions:
+                KeyPoolService._decrypted_keys.pop(cache_key, None)
+    
+    @staticmethod
+    def _refresh_with_new_session():
+        """使用独立会话刷新快照（在线程池中执行）"""
+        db = SessionLocal()
+        try:
+            KeyPoolService.refresh_snapshot(db)
+        finally:
+            db.close()
+    
+    @staticmethod
+    async def _refresh_loop():
+        """后台刷新循环：按间隔或失效通知刷新快照"""
+        while True:
+            try:
+                await asyncio.to_thread(KeyPoolService._refresh_with_new_session)
+            except Exception as e:
+                logger.error(f"Failed to refresh key pool snapshot: {e}")
+            try:
+                await asyncio.wait_for(
+                    KeyPoolService._refresh_event.wait(),
+                    timeout=settings.KEY_POOL_REFRESH_SECONDS
+                )
+            except asyncio.TimeoutError:
+                pass
+            KeyPoolService._refresh_event.clear()
+    
+    @staticmethod
+    def start_refresher():
+        """启动后台刷新任务"""
+        if KeyPoolService._refresh_task is None:
+            KeyPoolService._refresh_event = asyncio.Event()
+            KeyPoolService._refresh_task = asyncio.create_task(KeyPoolService._refresh_loop())
+    
+    @staticmethod
+    async def stop_refresher():
+        """停止后台刷新任务"""
+        task = KeyPoolService._refresh_task
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+            KeyPoolService._refresh_task = None
+    
+    @staticmethod
+    def invalidate():
+        """通知后台任务尽快刷新快照"""
+        if KeyPoolService._refresh_event is not None:
+            KeyPoolService._refresh_event.set()
+        else:
+            KeyPoolService._snapshot_loaded = False
+    
+    @staticmethod
+    async def ensure_snapshot():
+        """快照尚未加载时立即加载一次（在线程池中执行）"""
+        if not KeyPoolService._snapshot_loaded:
+            await asyncio.to_thread(KeyPoolService._refresh_with_new_session)
+    
+    @staticmethod
+    def get_snapshot(upstream_type: str) -> KeyPoolSnapshot:
+        """获取Key池快照"""
+        return KeyPoolService._snapshots.get(upstream_type) or KeyPoolSnapshot([])
+    
+    @staticmethod
+    def get_healthy_keys(upstream_type: str) -> List[UpstreamKey]:
+        """获取健康的上游密钥"""
+        return KeyPoolService.get_snapshot(upstream_type).keys
+    
+    @staticmethod
+    def select_key(
+        upstream_type: str,
+        strategy: Optional[str] = None,
+        exclude_ids: Optional[List[int]] = None
+    ) -> Optional[UpstreamKey]:
         """
-        选择上游密钥
+        选择上游密钥（纯内存，不访问数据库）
         
         Args:
-            strategy: "weighted" (权重轮询) 或 "round_robin" (轮询)
+            strategy: 选择策略，默认取 KEY_SELECTION_STRATEGY
+                "weighted" (权重随机), "round_robin" (轮询),
+                "least_outstanding" (最少在途请求), "ewma" (延迟EWMA + 二选一)
+            exclude_ids: 排除的密钥ID（故障转移时跳过已尝试的Key）
         """
-        healthy_keys = KeyPoolService.get_healthy_keys(db, upstream_type)
+        strategy = strategy or settings.KEY_SELECTION_STRATEGY
+        snapshot = KeyPoolService.get_snapshot(upstream_type)
+        healthy_keys = snapshot.keys
+        if exclude_ids:
+            healthy_keys = [k for k in healthy_keys if k.id not in exclude_ids]
         
         if not healthy_keys:
             logger.warning(f"No healthy upstream keys available for {upstream_type}")
             return None
         
-        if strategy == "weighted":
-            # 权重选择
-            total_weight = sum(k.weight for k in healthy_keys)
-            if total_weight == 0:
-                return random.choice(healthy_keys)
-            
-            rand = random.uniform(0, total_weight)
-            current = 0
-            for key in healthy_keys:
-                current += key.weight
-                if rand <= current:
-                    return key
-            return healthy_keys[0]
+        # 避开接近上游RPM/TPM上限的Key（全部接近时不过滤）
+        below_limit = [k for k in healthy_keys if not UpstreamStats.is_near_rate_limit(k.id)]
+        if below_limit and len(below_limit) < len(healthy_keys):
+            healthy_keys = below_limit
+        
+        if strategy == "round_robin":
+            return KeyPoolService._select_round_robin(upstream_type, healthy_keys)
+        if strategy == "least_outstanding":
+            return KeyPoolService._select_least_outstanding(healthy_keys)
+        if strategy == "ewma":
+            return KeyPoolService._select_ewma(healthy_keys)
+        
+        # 权重选择（无排除时直接使用预计算的累计权重表）
+        if healthy_keys is snapshot.keys:
+            cumulative_weights = snapshot.cumulative_weights
+            total_weight = snapshot.total_weight
         else:
-            # 简单轮询（可以改进为基于使用次数）
+            cumulative_weights = list(accumulate(max(k.weight, 0) for k in healthy_keys))
+            total_weight = cumulative_weights[-1]
+        if total_weight == 0:
             return random.choice(healthy_keys)
+        
+        index = bisect_right(cumulative_weights, random.uniform(0, total_weight))
+        return healthy_keys[min(index, len(healthy_keys) - 1)]
     
     @staticmethod
-    def record_success(db: Session, key_id: int, tokens: int = 0):
-        """记录成功请求"""
-        key = db.query(UpstreamKey).filter(UpstreamKey.id == key_id).first()
-        if key:
-            key.total_requests += 1
-            key.total_tokens += tokens
-            key.failure_count = 0  # 重置失败计数
-            db.commit()
+    def _select_round_robin(upstream_type: str, keys: List[UpstreamKey]) -> UpstreamKey:
+        """轮询：按类型维护计数器，快照刷新后继续"""
+        counter = KeyPoolService._round_robin_counters.setdefault(upstream_type, count())
+        return keys[next(counter) % len(keys)]
     
     @staticmethod
-    def record_failure(db: Session, key_id: int, error_type: str = "unknown"):
-        """记录失败请求，触发熔断"""
-        key = db.query(UpstreamKey).filter(UpstreamKey.id == key_id).first()
-        if not key:
-            return
+    def _select_least_outstanding(keys: List[UpstreamKey]) -> UpstreamKey:
+        """最少在途请求（按权重归一化，相同时随机）"""
+        return min(
+            keys,
+            key=lambda k: (UpstreamStats.in_flight(k.id) / max(k.weight, 1), random.random())
+        )
+    
+    @staticmethod
+    def _select_ewma(keys: List[UpstreamKey]) -> UpstreamKey:
+        """
+        延迟EWMA加权的二选一（power of two choices）
         
-        key.total_errors += 1
-        key.failure_count += 1
-        key.last_failure_at = datetime.utcnow().isoformat()
+        成本 = 延迟EWMA × (在途请求数 + 1)，无样本的Key成本为0，会被优先探测
+        """
+        if len(keys) == 1:
+            return keys[0]
         
-        # 检查是否需要熔断
-        if key.failure_count >= settings.CIRCUIT_BREAKER_FAILURE_THRESHOLD:
-            if key.status == UpstreamKeyStatus.HEALTHY.value:
-                cooldown_until = datetime.utcnow() + timedelta(seconds=settings.CIRCUIT_BREAKER_COOLDOWN_SECONDS)
-                key.status = UpstreamKeyStatus.COOLDOWN.value
-                key.cooldown_until = cooldown_until.isoformat()
-                logger.warning(f"Upstream key {key_id} entered cooldown after {key.failure_count} failures")
+        def cost(key: UpstreamKey) -> float:
+            latency = UpstreamStats.ewma_latency(key.id)
+            if latency is None:
+                return 0.0
+            return latency * (UpstreamStats.in_flight(key.id) + 1)
         
-        db.commit()
+        first, second = random.sample(keys, 2)
+        return first if cost(first) <= cost(second) else second
+    
+    @staticmethod
+    async def acquire_key(
+        upstream_type: str,
+        exclude_ids: Optional[List[int]] = None
+    ) -> Optional[UpstreamKey]:
+        """选择上游密钥，并通过熔断器检查（熔断中的Key会被跳过）"""
+        await KeyPoolService.ensure_snapshot()
+        excluded = list(exclude_ids or [])
+        while True:
+            key = KeyPoolService.select_key(upstream_type, exclude_ids=excluded)
+            if key is None:
+                return None
+            if await CircuitBreaker.allow_request(key.id):
+                return key
+            excluded.append(key.id)
+    
+    @staticmethod
+    async def record_success(key_id: int, tokens: int = 0):
+        """记录成功请求（独立的短会话，可在并发的对冲请求中调用）"""
+        try:
+            async with AsyncSessionLocal() as db:
+                await db.execute(
+                    update(UpstreamKey).where(UpstreamKey.id == key_id).values(
+                        total_requests=UpstreamKey.total_requests + 1,
+                        total_tokens=UpstreamKey.total_tokens + tokens
+                    )
+                )
+                await db.commit()
+        except Exception as e:
+            logger.error(f"Failed to record success for upstream key {key_id}: {e}")
+        await CircuitBreaker.record_success(key_id)
+    
+    @staticmethod
+    async def record_failure(
+        key_id: int,
+        error_type: str = "unknown",
+        retry_after: Optional[float] = None
+    ):
+        """
+        记录失败请求，触发熔断（熔断状态保存在Redis中）
+        
+        Args:
+            retry_after: 上游429返回的retry-after（秒），有值时立即按该时长熔断
+        """
+        try:
+            async with AsyncSessionLocal() as db:
+                await db.execute(
+                    update(UpstreamKey).where(UpstreamKey.id == key_id).values(
+                        total_errors=UpstreamKey.total_errors + 1,
+                        last_failure_at=datetime.utcnow().isoformat()
+                    )
+                )
+                await db.commit()
+        except Exception as e:
+            logger.error(f"Failed to record failure for upstream key {key_id}: {e}")
+        if retry_after is not None:
+            await CircuitBreaker.trip(key_id, retry_after)
+        else:
+            await CircuitBreaker.record_failure(key_id)
     
     @staticmethod
     def get_decrypted_key(upstream_key: UpstreamKey) -> str:
-        """获取解密后的密钥"""
+        """获取解密后的密钥（带缓存）"""
+        cache = KeyPoolService._decrypted_keys
+        cache_key = (upstream_key.id, upstream_key.encrypted_key)
+        plain_key = cache.get(cache_key)
+        if plain_key is not None:
+            cache.move_to_end(cache_key)
+            return plain_key
+        
         try:
-            return decrypt_key(upstream_key.encrypted_key)
+            plain_key = decrypt_key(upstream_key.encrypted_key)
         except Exception as e:
             logger.error(f"Failed to decrypt key {upstream_key.id}: {e}")
             raise
+        
+        cache[cache_key] = plain_key
+        while len(cache) > settings.DECRYPTED_KEY_CACHE_SIZE:
+            cache.popitem(last=False)
+        return plain_key
@@ -0,0 +1,170 @@
+"""
+月度配额计数（基于Redis，所有worker/副本共享）
+每个用户当月已用token（含在途请求的预占）保存在一个计数器中：
+请求开始时按估算值原子预占（超出配额则拒绝），结束时按实际用量结算差额。
+计数器缺失时从 usage_monthly 初始化，并定期过期后重新初始化以修正偏差；
+每次初始化生成新的代次，预占记录代次，结算时据此判断计数器是否仍包含本次预占。
+"""
+import uuid
+from datetime import datetime
+from typing import Optional, Tuple
+from app.config import settings
+from app.models.user import User
+from app.services.rate_limiter import RedisHealth, get_async_redis_client
+from app.utils.logger import logger
+
+# 计数器为hash：used（当月已用，含在途预占）, gen（初始化代次）
+
+# 原子预占
+# KEYS[1]: 计数器
+# ARGV: 月度配额, 预占token数
+# 返回: {1 成功 / 0 超出配额 / -1 计数器不存在, 当前已用, 代次}
+RESERVE_SCRIPT = """
+local used = redis.call('HGET', KEYS[1], 'used')
+if not used then
+    return {-1, 0, ''}
+end
+used = tonumber(used)
+local tokens = tonumber(ARGV[2])
+local gen = redis.call('HGET', KEYS[1], 'gen')
+if used + tokens > tonumber(ARGV[1]) then
+    return {0, used, gen}
+end
+return {1, redis.call('HINCRBY', KEYS[1], 'used', tokens), gen}
+"""
+
+# 初始化（多个worker同时初始化时只有第一个生效）
+# ARGV: 当月已用, 代次, 有效期（秒）
+SEED_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'used', ARGV[1], 'gen', ARGV[2])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return 1
+"""
+
+# 结算
+# ARGV: 预占时的代次, 差额（实际 - 预占）, 实际用量
+# 计数器已过期时跳过（重新初始化时以数据库为准）；
+# 已重新初始化时新计数器不含本次预占，结算差额会少计，只计入实际用量
+SETTLE_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+if redis.call('HGET', KEYS[1], 'gen') == ARGV[1] then
+    return redis.call('HINCRBY', KEYS[1], 'used', ARGV[2])
+end
+return redis.call('HINCRBY', KEYS[1], 'used', ARGV[3])
+"""
+
+SCRIPTS = {
+    "reserve": RESERVE_SCRIPT,
+    "seed": SEED_SCRIPT,
+    "settle": SETTLE_SCRIPT,
+}
+
+
+class QuotaReservation:
+    """一次请求预占的配额，请求结束后按实际用量结算"""
+    
+    def __init__(self, key: Optional[str], reserved_tokens: int, generation: Optional[str] = None):
+        self.key = key  # 为None表示未在Redis预占（Redis不可用时的数据库检查）
+        self.reserved_tokens = reserved_tokens
+        self.generation = generation  # 预占时计数器的初始化代次
+        self.settled = False
+    
+    async def settle(self, actual_tokens: int):
+        """结算（只生效一次）；请求失败或被拒绝时传0归还全部预占"""
+        if self.settled:
+            return
+        self.settled = True
+        if self.key is None or not RedisHealth.is_available():
+            return
+        try:
+            await QuotaCounter._get_script("settle")(
+                keys=[self.key], args=[self.generation, actual_tokens - self.reserved_tokens, actual_tokens]
+            )
+        except Exception as e:
+            logger.error(f"Failed to settle quota reservation: {e}")
+            RedisHealth.record_error(e)
+
+
+class QuotaCounter:
+    """月度配额计数器"""
+    
+    _scripts = {}
+    
+    @staticmethod
+    def _get_script(name: str):
+        """注册Lua脚本"""
+        script = QuotaCounter._scripts.get(name)
+        if script is None:
+            script = QuotaCounter._scripts[name] = get_async_redis_client().register_script(SCRIPTS[name])
+        return script
+    
+    @staticmethod
+    def _get_key(user_id: int, now: datetime) -> str:
+        """生成Redis key（按服务器本地年月，与 usage_monthly 一致）"""
+        return f"quota_counter:{user_id}:{now.year}{now.month:02d}"
+    
+    @staticmethod
+    async def _seed(key: str, user_id: int, now: datetime):
+        """从 usage_monthly 初始化计数器（多个worker同时初始化时只有第一个生效），每次初始化使用新的代次"""
+        from app.models.base import AsyncSessionLocal
+        from app.services.usage_tracker import UsageTracker
+        try:
+            async with AsyncSessionLocal() as db:
+                monthly = await UsageTracker.get_monthly_usage(db, user_id, now.year, now.month)
+        except Exception as e:
+            # 数据库不可用时不初始化，本次请求不做预占
+            logger.error(f"Failed to load monthly usage for quota counter: {e}")
+            return
+        used = monthly.total_tokens if monthly else 0
+        await QuotaCounter._get_script("seed")(
+            keys=[key], args=[used, uuid.uuid4().hex, int(settings.QUOTA_COUNTER_TTL_SECONDS)]
+        )
+    
+    @staticmethod
+    async def reserve(user: User, tokens: int) -> Tuple[Optional[QuotaReservation], Optional[str]]:
+        """
+        按估算值预占当月配额
+        
+        Args:
+            user: 鉴权时已加载的用户（已校验启用状态）
+        
+        Returns:
+            (预占, 错误信息)，超出配额时预占为None；Redis不可用时退化为数据库检查
+        """
+        if not RedisHealth.is_available():
+            return await QuotaCounter._reserve_from_db(user, tokens)
+        
+        now = datetime.now()
+        key = QuotaCounter._get_key(user.id, now)
+        quota = user.monthly_quota_tokens
+        try:
+            script = QuotaCounter._get_script("reserve")
+            ok, used, generation = await script(keys=[key], args=[quota, tokens])
+            if ok == -1:
+                await QuotaCounter._seed(key, user.id, now)
+                ok, used, generation = await script(keys=[key], args=[quota, tokens])
+        except Exception as e:
+            logger.error(f"Quota counter reserve failed: {e}")
+            RedisHealth.record_error(e)
+            return await QuotaCounter._reserve_from_db(user, tokens)
+        
+        if ok == 1:
+            return QuotaReservation(key, tokens, generation), None
+        if ok == 0:
+            return None, f"Monthly quota exceeded. Used: {used}/{quota}"
+        # 计数器未能初始化，本次不做预占
+        return QuotaReservation(None, tokens), None
+    
+    @staticmethod
+    async def _reserve_from_db(user: User, tokens: int) -> Tuple[Optional[QuotaReservation], Optional[str]]:
+        """Redis不可用时按数据库中的当月用量检查（不预占）"""
+        from app.services.usage_tracker import UsageTracker
+        quota_ok, quota_error = await UsageTracker.check_quota(user.id, tokens)
+        if not quota_ok:
+            return None, quota_error
+        return QuotaReservation(None, tokens), None
@@ -1,12 +1,22 @@
 """
-限流服务（基于Redis）
+限流服务（基于Redis，异步客户端，不阻塞事件循环）
 """
+import asyncio
+import math
+import time
+import uuid
 import redis
-from typing import Optional
+import redis.asyncio as aioredis
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
 from app.config import settings
 from app.utils.logger import logger
 
+# 连接池用尽时redis-py抛出的ConnectionError（BlockingConnectionPool / ConnectionPool）
+POOL_EXHAUSTED_ERRORS = ("No connection available.", "Too many connections")
+
 redis_client: Optional[redis.Redis] = None
+async_redis_client: Optional[aioredis.Redis] = None
 
 
 def get_redis_client() -> redis.Redis:
@@ -31,57 +41,273 @@ def get_redis_client() -> redis.Redis:
     return redis_client
 
 
+def get_async_redis_client() -> aioredis.Redis:
+    """获取异步Redis客户端（进程内共享连接池，连接用尽时排队等待而不是立即报错）"""
+    global async_redis_client
+    if async_redis_client is None:
+        pool = aioredis.BlockingConnectionPool(
+            host=settings.REDIS_HOST,
+            port=settings.REDIS_PORT,
+            password=settings.REDIS_PASSWORD,
+            db=settings.REDIS_DB,
+            decode_responses=True,
+            socket_connect_timeout=5,
+            socket_timeout=5,
+            max_connections=settings.REDIS_MAX_CONNECTIONS,
+            timeout=settings.REDIS_POOL_TIMEOUT_SECONDS
+        )
+        async_redis_client = aioredis.Redis(connection_pool=pool)
+    return async_redis_client
+
+
+async def close_async_redis_client():
+    """关闭异步Redis客户端"""
+    global async_redis_client
+    if async_redis_client is not None:
+        await async_redis_client.aclose()
+        async_redis_client = None
+
+
+class RedisHealth:
+    """
+    Redis可用性（进程内熔断）
+    
+    Redis连接失败或超时后标记为不可用，后续请求不再访问Redis（避免每个请求都等待socket超时），
+    限流退化为进程内限流；后台定期探测，恢复后切回Redis。
+    """
+    
+    _available = True
+    _probe_task: Optional[asyncio.Task] = None
+    
+    @staticmethod
+    def is_available() -> bool:
+        """Redis是否可用"""
+        return RedisHealth._available
+    
+    @staticmethod
+    def ensure_available():
+        """Redis不可用时直接抛出连接错误（不发起网络请求）"""
+        if not RedisHealth._available:
+            raise redis.exceptions.ConnectionError("Redis unavailable (degraded mode)")
+    
+    @staticmethod
+    def record_error(error: Exception):
+        """记录Redis调用异常，连接/超时类错误时切换到降级模式"""
+        if not isinstance(error, (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError, asyncio.TimeoutError, OSError)):
+            return
+        if isinstance(error, redis.exceptions.ConnectionError) and str(error) in POOL_EXHAUSTED_ERRORS:
+            # 连接池用尽是本进程负载过高，不是Redis故障，不能切换到（更宽松的）进程内限流
+            logger.warning(f"Redis connection pool exhausted: {error}")
+            return
+        if not RedisHealth._available:
+            return
+        RedisHealth._available = False
+        logger.error(f"Redis unavailable, switching to degraded in-process rate limiting: {error}")
+        if RedisHealth._probe_task is None:
+            RedisHealth._probe_task = asyncio.create_task(RedisHealth._probe_loop())
+    
+    @staticmethod
+    async def _probe_loop():
+        """后台探测Redis，恢复后切回"""
+        try:
+            while True:
+                await asyncio.sleep(settings.REDIS_PROBE_INTERVAL_SECONDS)
+                try:
+                    await asyncio.wait_for(get_async_redis_client().ping(), settings.REDIS_PROBE_TIMEOUT_SECONDS)
+                except Exception:
+                    continue
+                LocalRateLimiter.clear()
+                RedisHealth._available = True
+                logger.info("Redis recovered, rate limiting switched back to Redis")
+                return
+        finally:
+            RedisHealth._probe_task = None
+    
+    @staticmethod
+    async def stop():
+        """停止后台探测"""
+        task = RedisHealth._probe_task
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+
+# 滑动窗口限流脚本（RPM和TPM一次往返、原子检查并更新）
+# 窗口内每次放行记录为有序集合中的一个成员（score=时间戳，member=id:请求数:token数），
+# 另用一个hash保存窗口内的请求总数和token总数；被拒绝的请求不占用额度
+# KEYS[1]: 请求日志(zset), KEYS[2]: 窗口总量(hash: requests, tokens)
+# ARGV: window_ms, limit_rpm, limit_tpm, requests, tokens, member_id, partial
+#   partial=1 时按剩余额度部分授予（用于本地令牌桶租约）
+# 返回: {授予请求数, 授予token数, 当前请求数, 当前token数, 重置/重试等待毫秒数}
+SLIDING_WINDOW_SCRIPT = """
+local log_key = KEYS[1]
+local totals_key = KEYS[2]
+local window = tonumber(ARGV[1])
+local limit_rpm = tonumber(ARGV[2])
+local limit_tpm = tonumber(ARGV[3])
+local requests = tonumber(ARGV[4])
+local tokens = tonumber(ARGV[5])
+local partial = ARGV[7] == '1'
+
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+
+-- 移出窗口外的记录，并归还其额度
+local expired = redis.call('ZRANGEBYSCORE', log_key, '-inf', now - window)
+if #expired > 0 then
+    local freed_requests = 0
+    local freed_tokens = 0
+    for _, member in ipairs(expired) do
+        local r, t = string.match(member, ':(%d+):(-?%d+)$')
+        freed_requests = freed_requests + tonumber(r)
+        freed_tokens = freed_tokens + tonumber(t)
+    end
+    redis.call('ZREMRANGEBYSCORE', log_key, '-inf', now - window)
+    redis.call('HINCRBY', totals_key, 'requests', -freed_requests)
+    redis.call('HINCRBY', totals_key, 'tokens', -freed_tokens)
+end
+
+local count = tonumber(redis.call('HGET', totals_key, 'requests') or '0')
+local used = tonumber(redis.call('HGET', totals_key, 'tokens') or '0')
+
+local granted_requests = 0
+local granted_tokens = 0
+if partial then
+    granted_requests = math.min(requests, limit_rpm - count)
+    granted_tokens = math.max(0, math.min(tokens, limit_tpm - used))
+    if granted_requests <= 0 then
+        granted_requests = 0
+        granted_tokens = 0
+    end
+elseif count + requests <= limit_rpm and used + tokens <= limit_tpm then
+    granted_requests = requests
+    granted_tokens = tokens
+end
+
+local wait = 0
+if granted_requests > 0 then
+    redis.call('ZADD', log_key, now, ARGV[6] .. ':' .. granted_requests .. ':' .. granted_tokens)
+    redis.call('HINCRBY', totals_key, 'requests', granted_requests)
+    redis.call('HINCRBY', totals_key, 'tokens', granted_tokens)
+    count = count + granted_requests
+    used = used + granted_tokens
+    -- 放行时返回最早记录移出窗口的时间
+    local oldest = redis.call('ZRANGE', log_key, 0, 0, 'WITHSCORES')
+    if oldest[2] then
+        wait = tonumber(oldest[2]) + window - now
+    end
+elseif requests > limit_rpm or tokens > limit_tpm then
+    wait = window
+else
+    -- 拒绝时计算需要等待多少条最早记录移出窗口，才能同时满足RPM和TPM
+    -- 只扫描最早的 max_scan 条记录（限流时拒绝量很大，不能每次遍历整个窗口），仍不满足时按整个窗口返回
+    local max_scan = 64
+    local need_requests = count + requests - limit_rpm
+    local need_tokens = used + tokens - limit_tpm
+    local entries = redis.call('ZRANGE', log_key, 0, max_scan - 1, 'WITHSCORES')
+    local freed_requests = 0
+    local freed_tokens = 0
+    wait = window
+    for i = 1, #entries, 2 do
+        local r, t = string.match(entries[i], ':(%d+):(-?%d+)$')
+        freed_requests = freed_requests + tonumber(r)
+        freed_tokens = freed_tokens + tonumber(t)
+        if freed_requests >= need_requests and freed_tokens >= need_tokens then
+            wait = tonumber(entries[i + 1]) + window - now
+            break
+        end
+    end
+end
+
+if count > 0 then
+    redis.call('PEXPIRE', log_key, window)
+    redis.call('PEXPIRE', totals_key, window)
+end
+return {granted_requests, granted_tokens, count, used, wait}
+"""
+
+# 结算脚本：把窗口中的记录替换为实际使用量（租约归还未用完的额度，或按实际token数修正单次请求）
+# KEYS[1]: 请求日志(zset), KEYS[2]: 窗口总量(hash)
+# ARGV: member, new_member_id, used_requests, used_tokens（租约并入之前请求的修正时可为负）
+SETTLE_SCRIPT = """
+local log_key = KEYS[1]
+local totals_key = KEYS[2]
+local score = redis.call('ZSCORE', log_key, ARGV[1])
+if not score then
+    return 0
+end
+local r, t = string.match(ARGV[1], ':(%d+):(-?%d+)$')
+local used_requests = tonumber(ARGV[3])
+local used_tokens = tonumber(ARGV[4])
+redis.call('ZREM', log_key, ARGV[1])
+redis.call('HINCRBY', totals_key, 'requests', used_requests - tonumber(r))
+redis.call('HINCRBY', totals_key, 'tokens', used_tokens - tonumber(t))
+if used_requests > 0 or used_tokens ~= 0 then
+    redis.call('ZADD', log_key, score, ARGV[2] .. ':' .. used_requests .. ':' .. used_tokens)
+end
+return 1
+"""
+
+# 修正脚本：写入一条不占请求数的token修正记录（随窗口移出），用于没有租约可并入的累计修正
+# KEYS[1]: 请求日志(zset), KEYS[2]: 窗口总量(hash)
+# ARGV: window_ms, 修正记录ID, token差额（可为负）
+ADJUST_SCRIPT = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+redis.call('ZADD', KEYS[1], now, ARGV[2] .. ':0:' .. ARGV[3])
+redis.call('HINCRBY', KEYS[2], 'tokens', tonumber(ARGV[3]))
+redis.call('PEXPIRE', KEYS[1], ARGV[1])
+redis.call('PEXPIRE', KEYS[2], ARGV[1])
+return 1
+"""
+
+# 限流窗口（毫秒）
+RATE_LIMIT_WINDOW_MS = 60000
+
+
 class RateLimiter:
     """限流器"""
     
+    _script = None
+    _settle_script = None
+    _adjust_script = None
+    
     @staticmethod
     def _get_key(prefix: str, identifier: str, window: str = "minute") -> str:
         """生成Redis key"""
         return f"rate_limit:{prefix}:{identifier}:{window}"
     
     @staticmethod
-    def check_rate_limit(
+    async def check_rate_limit(
         identifier: str,
         limit_rpm: int,
         limit_tpm: int,
         current_tokens: int = 0,
-        prefix: str = "key"
+        prefix: str = "key",
+        request_id: Optional[str] = None
     ) -> tuple[bool, dict]:
         """
-        检查限流
+        检查限流（滑动窗口，RPM和TPM在一次Redis往返中原子检查并计数）
+        
+        Args:
+            request_id: 请求ID，用于请求结束后按实际token数结算（见 reconcile_tokens）
         
         Returns:
             (is_allowed, info_dict)
             info_dict包含: remaining_requests, remaining_tokens, reset_time
+            reset_time: 放行时为最早请求移出窗口的秒数，拒绝时为可重试的秒数
         """
-        redis_cli = get_redis_client()
-        
-        key_rpm = RateLimiter._get_key(prefix, identifier, "rpm")
-        key_tpm = RateLimiter._get_key(prefix, identifier, "tpm")
-        
+        if not RedisHealth.is_available():
+            return LocalRateLimiter.check_rate_limit(
+                identifier, limit_rpm, limit_tpm, current_tokens, prefix, request_id
+            )
         try:
-            # 使用滑动窗口计数
-            pipe = redis_cli.pipeline()
-            
-            # RPM检查
-            current_rpm = redis_cli.incr(key_rpm)
-            if current_rpm == 1:
-                redis_cli.expire(key_rpm, 60)  # 60秒过期
-            
-            # TPM检查
-            if current_tokens > 0:
-                current_tpm = redis_cli.incrby(key_tpm, current_tokens)
-                if current_tpm == current_tokens:
-                    redis_cli.expire(key_tpm, 60)
-            else:
-                current_tpm = redis_cli.get(key_tpm) or 0
-                current_tpm = int(current_tpm)
-            
-            # 检查是否超限
-            rpm_exceeded = current_rpm > limit_rpm
-            tpm_exceeded = current_tpm > limit_tpm
-            
-            is_allowed = not (rpm_exceeded or tpm_exceeded)
+            granted_requests, _, current_rpm, current_tpm, wait_ms = await RateLimiter.acquire(
+                identifier, limit_rpm, limit_tpm, 1, current_tokens, prefix, member_id=request_id
+            )
             
             info = {
                 "remaining_requests": max(0, limit_rpm - current_rpm),
@@ -90,20 +316,513 @@ class RateLimiter:
                 "current_tokens": current_tpm,
                 "limit_rpm": limit_rpm,
                 "limit_tpm": limit_tpm,
-                "reset_time": 60  # 60秒后重置
+                "reset_time": math.ceil(wait_ms / 1000)
             }
             
-            return is_allowed, info
-            
+            return granted_requests > 0, info
+        
         except Exception as e:
             logger.error(f"Rate limit check failed: {e}")
-            # 失败时允许通过（fail-open策略）
+            if not RedisHealth.is_available():
+                # Redis已判定不可用：退化为进程内限流
+                return LocalRateLimiter.check_rate_limit(
+                    identifier, limit_rpm, limit_tpm, current_tokens, prefix, request_id
+                )
+            # 其他错误允许通过（fail-open策略）
             return True, {"error": str(e)}
     
     @staticmethod
-    def reset_rate_limit(identifier: str, prefix: str = "key"):
+    async def acquire(
+        identifier: str,
+        limit_rpm: int,
+        limit_tpm: int,
+        requests: int,
+        tokens: int,
+        prefix: str = "key",
+        member_id: Optional[str] = None,
+        partial: bool = False
+    ) -> tuple[int, int, int, int, int]:
+        """
+        在滑动窗口中申请额度（异常由调用方处理）
+        
+        Returns:
+            (授予请求数, 授予token数, 当前请求数, 当前token数, 等待毫秒数)
+        """
+        RedisHealth.ensure_available()
+        if RateLimiter._script is None:
+            RateLimiter._script = get_async_redis_client().register_script(SLIDING_WINDOW_SCRIPT)
+        try:
+            result = await RateLimiter._script(
+                keys=[RateLimiter._get_key(prefix, identifier, "log"), RateLimiter._get_key(prefix, identifier, "totals")],
+                args=[
+                    RATE_LIMIT_WINDOW_MS,
+                    limit_rpm,
+                    limit_tpm,
+                    requests,
+                    tokens,
+                    member_id or uuid.uuid4().hex,
+                    1 if partial else 0
+                ]
+            )
+        except Exception as e:
+            RedisHealth.record_error(e)
+            raise
+        return tuple(int(v) for v in result)
+    
+    @staticmethod
+    async def settle_record(
+        identifier: str,
+        member: str,
+        used_requests: int,
+        used_tokens: int,
+        prefix: str = "key"
+    ):
+        """结算窗口中的一条记录：只保留实际使用的额度（异常由调用方处理）"""
+        RedisHealth.ensure_available()
+        if RateLimiter._settle_script is None:
+            RateLimiter._settle_script = get_async_redis_client().register_script(SETTLE_SCRIPT)
+        try:
+            await RateLimiter._settle_script(
+                keys=[RateLimiter._get_key(prefix, identifier, "log"), RateLimiter._get_key(prefix, identifier, "totals")],
+                args=[member, uuid.uuid4().hex, used_requests, used_tokens]
+            )
+        except Exception as e:
+            RedisHealth.record_error(e)
+            raise
+    
+    @staticmethod
+    async def adjust_tokens(identifier: str, delta_tokens: int, prefix: str = "key"):
+        """在窗口中写入一条token修正（异常由调用方处理）"""
+        RedisHealth.ensure_available()
+        if RateLimiter._adjust_script is None:
+            RateLimiter._adjust_script = get_async_redis_client().register_script(ADJUST_SCRIPT)
+        try:
+            await RateLimiter._adjust_script(
+                keys=[RateLimiter._get_key(prefix, identifier, "log"), RateLimiter._get_key(prefix, identifier, "totals")],
+                args=[RATE_LIMIT_WINDOW_MS, uuid.uuid4().hex, delta_tokens]
+            )
+        except Exception as e:
+            RedisHealth.record_error(e)
+            raise
+    
+    @staticmethod
+    async def reconcile_tokens(
+        identifier: str,
+        request_id: str,
+        estimated_tokens: int,
+        actual_tokens: int,
+        prefix: str = "key",
+        used_requests: int = 1
+    ):
+        """按实际用量修正已放行请求在TPM窗口中的token数（used_requests为0时连同请求数一起撤销）"""
+        if not RedisHealth.is_available():
+            LocalRateLimiter.reconcile_tokens(identifier, request_id, actual_tokens, prefix, used_requests)
+            return
+        try:
+            await RateLimiter.settle_record(
+                identifier, f"{request_id}:1:{estimated_tokens}", used_requests, max(0, actual_tokens), prefix
+            )
+        except Exception as e:
+            logger.error(f"Failed to reconcile rate limit tokens: {e}")
+    
+    @staticmethod
+    async def reset_rate_limit(identifier: str, prefix: str = "key"):
         """重置限流计数（用于测试或手动重置）"""
-        redis_cli = get_redis_client()
-        key_rpm = RateLimiter._get_key(prefix, identifier, "rpm")
-        key_tpm = RateLimiter._get_key(prefix, identifier, "tpm")
-        redis_cli.delete(key_rpm, key_tpm)
+        redis_cli = get_async_redis_client()
+        key_log = RateLimiter._get_key(prefix, identifier, "log")
+        key_totals = RateLimiter._get_key(prefix, identifier, "totals")
+        await redis_cli.delete(key_log, key_totals)
+
+
+class LocalWindow:
+    """进程内滑动窗口（Redis不可用时使用）"""
+    
+    __slots__ = ("records", "requests", "tokens")
+    
+    def __init__(self):
+        # 请求ID -> [放行时间, token数]（按放行时间排序）
+        self.records: "OrderedDict[str, list]" = OrderedDict()
+        self.requests = 0
+        self.tokens = 0
+    
+    def evict(self, now: float):
+        """移出窗口外的记录"""
+        window = RATE_LIMIT_WINDOW_MS / 1000
+        while self.records:
+            request_id, (admitted_at, tokens) = next(iter(self.records.items()))
+            if admitted_at > now - window:
+                break
+            self.records.popitem(last=False)
+            self.requests -= 1
+            self.tokens -= tokens
+
+
+class LocalRateLimiter:
+    """
+    进程内降级限流（Redis不可用时）
+    
+    每个worker只能看到自己的流量，限额按 RATE_LIMIT_WORKER_COUNT 均分，
+    总体放行量与全局限额大致相当
+    """
+    
+    # (prefix, identifier) -> LocalWindow
+    _windows: Dict[Tuple[str, str], LocalWindow] = {}
+    _pruned_at = 0.0
+    
+    @staticmethod
+    def _prune(now: float):
+        """每个窗口周期清理一次已空闲的窗口（Redis长时间不可用时标识数量不会无限增长）"""
+        if now - LocalRateLimiter._pruned_at < RATE_LIMIT_WINDOW_MS / 1000:
+            return
+        LocalRateLimiter._pruned_at = now
+        for key, window in list(LocalRateLimiter._windows.items()):
+            window.evict(now)
+            if not window.records:
+                del LocalRateLimiter._windows[key]
+    
+    @staticmethod
+    def check_rate_limit(
+        identifier: str,
+        limit_rpm: int,
+        limit_tpm: int,
+        current_tokens: int = 0,
+        prefix: str = "key",
+        request_id: Optional[str] = None
+    ) -> tuple[bool, dict]:
+        """检查限流，返回值与 RateLimiter.check_rate_limit 相同（info中带degraded标记）"""
+        workers = max(1, settings.RATE_LIMIT_WORKER_COUNT)
+        local_rpm = max(1, limit_rpm // workers)
+        local_tpm = max(1, limit_tpm // workers)
+        now = time.time()
+        LocalRateLimiter._prune(now)
+        
+        window = LocalRateLimiter._windows.setdefault((prefix, identifier), LocalWindow())
+        window.evict(now)
+        allowed = window.requests + 1 <= local_rpm and window.tokens + current_tokens <= local_tpm
+        if allowed:
+            window.records[request_id or uuid.uuid4().hex] = [now, current_tokens]
+            window.requests += 1
+            window.tokens += current_tokens
+        
+        reset_time = RATE_LIMIT_WINDOW_MS / 1000
+        if window.records:
+            oldest_at = next(iter(window.records.values()))[0]
+            reset_time = oldest_at + RATE_LIMIT_WINDOW_MS / 1000 - now
+        
+        return allowed, {
+            "remaining_requests": max(0, local_rpm - window.requests),
+            "remaining_tokens": max(0, local_tpm - window.tokens),
+            "current_requests": window.requests,
+            "current_tokens": window.tokens,
+            "limit_rpm": limit_rpm,
+            "limit_tpm": limit_tpm,
+            "reset_time": max(0, math.ceil(reset_time)),
+            "degraded": True
+        }
+    
+    @staticmethod
+    def reconcile_tokens(
+        identifier: str, request_id: str, actual_tokens: int, prefix: str = "key", used_requests: int = 1
+    ):
+        """按实际用量修正token数（used_requests为0时撤销整条记录）"""
+        window = LocalRateLimiter._windows.get((prefix, identifier))
+        record = window.records.get(request_id) if window else None
+        if record is None:
+            return
+        if used_requests == 0:
+            del window.records[request_id]
+            window.requests -= 1
+            window.tokens -= record[1]
+            return
+        actual_tokens = max(0, actual_tokens)
+        window.tokens += actual_tokens - record[1]
+        record[1] = actual_tokens
+    
+    @staticmethod
+    def clear():
+        """清空进程内窗口（Redis恢复后调用）"""
+        LocalRateLimiter._windows.clear()
+
+
+class LeaseBucket:
+    """本地令牌桶（持有从Redis租来的一段额度）"""
+    
+    def __init__(self):
+        self.lease_member: Optional[str] = None
+        self.granted_requests = 0
+        self.granted_tokens = 0
+        self.used_requests = 0
+        self.used_tokens = 0
+        self.expires_at = 0.0
+        self.renewing: Optional[asyncio.Task] = None
+        self.limit_rpm = 0
+        self.limit_tpm = 0
+    
+    def has_capacity(self, tokens: int) -> bool:
+        """租约内是否还能放行一个请求"""
+        return (
+            time.time() < self.expires_at
+            and self.used_requests < self.granted_requests
+            and self.used_tokens + tokens <= self.granted_tokens
+        )
+    
+    def is_low(self) -> bool:
+        """余量是否低于续租水位"""
+        watermark = settings.RATE_LIMIT_LEASE_LOW_WATERMARK
+        return (
+            self.granted_requests - self.used_requests <= self.granted_requests * watermark
+            or self.granted_tokens - self.used_tokens <= self.granted_tokens * watermark
+            or self.expires_at - time.time() <= settings.RATE_LIMIT_LEASE_TTL_SECONDS * watermark
+        )
+
+
+class HybridRateLimiter:
+    """
+    两级限流器（可选，用于高RPM的API Key）
+    
+    每个worker从Redis的全局滑动窗口中按块租用额度（RATE_LIMIT_LEASE_FRACTION），
+    在本地令牌桶中做放行决策，余量不足时异步续租，租约到期或续租时归还未用完的额度。
+    全局额度不会被超发；误差上限为 worker数 × 租约块大小（同一租约内的请求按租约时间计入窗口）。
+    """
+    
+    # (prefix, identifier) -> LeaseBucket
+    _buckets: Dict[Tuple[str, str], LeaseBucket] = {}
+    
+    # (prefix, identifier) -> 累计的token修正（放行请求的租约已结算后才结束的请求），并入下一次租约结算
+    _carried: Dict[Tuple[str, str], int] = {}
+    _sweeper_task: Optional[asyncio.Task] = None
+    
+    @staticmethod
+    async def check_rate_limit(
+        identifier: str,
+        limit_rpm: int,
+        limit_tpm: int,
+        current_tokens: int = 0,
+        prefix: str = "key",
+        request_id: Optional[str] = None
+    ) -> tuple[bool, dict]:
+        """检查限流，接口与 RateLimiter.check_rate_limit 相同"""
+        if (
+            not settings.RATE_LIMIT_HYBRID_ENABLED
+            or limit_rpm < settings.RATE_LIMIT_HYBRID_MIN_RPM
+            or not RedisHealth.is_available()
+        ):
+            return await RateLimiter.check_rate_limit(
+                identifier, limit_rpm, limit_tpm, current_tokens, prefix, request_id
+            )
+        
+        bucket = HybridRateLimiter._buckets.setdefault((prefix, identifier), LeaseBucket())
+        if bucket.limit_rpm != limit_rpm or bucket.limit_tpm != limit_tpm:
+            # 限额变更后立即按新限额续租
+            bucket.expires_at = 0.0
+            bucket.limit_rpm = limit_rpm
+            bucket.limit_tpm = limit_tpm
+        
+        if not bucket.has_capacity(current_tokens):
+            # 本地余量不足：同步续租（已有续租在进行时等待其完成）
+            if bucket.renewing is None:
+                bucket.renewing = asyncio.create_task(
+                    HybridRateLimiter._renew(bucket, identifier, current_tokens, prefix)
+                )
+            try:
+                await asyncio.shield(bucket.renewing)
+            except Exception as e:
+                logger.error(f"Rate limit lease renewal failed: {e}")
+                return await RateLimiter.check_rate_limit(
+                    identifier, limit_rpm, limit_tpm, current_tokens, prefix, request_id
+                )
+            if not bucket.has_capacity(current_tokens):
+                # 全局额度不足，由滑动窗口给出准确的拒绝信息（不占用额度）
+                return await RateLimiter.check_rate_limit(
+                    identifier, limit_rpm, limit_tpm, current_tokens, prefix, request_id
+                )
+        
+        bucket.used_requests += 1
+        bucket.used_tokens += current_tokens
+        
+        if bucket.is_low() and bucket.renewing is None:
+            # 余量低于水位：后台续租，不阻塞当前请求
+            bucket.renewing = asyncio.create_task(
+                HybridRateLimiter._renew(bucket, identifier, 0, prefix)
+            )
+        
+        return True, {
+            "remaining_requests": bucket.granted_requests - bucket.used_requests,
+            "remaining_tokens": bucket.granted_tokens - bucket.used_tokens,
+            "limit_rpm": limit_rpm,
+            "limit_tpm": limit_tpm,
+            "reset_time": max(0, math.ceil(bucket.expires_at - time.time())),
+            "lease": bucket.lease_member
+        }
+    
+    @staticmethod
+    async def reconcile_tokens(
+        identifier: str,
+        request_id: str,
+        estimated_tokens: int,
+        actual_tokens: int,
+        prefix: str = "key",
+        lease: Optional[str] = None,
+        used_requests: int = 1
+    ):
+        """
+        按实际用量修正token数
+        
+        Args:
+            lease: 放行该请求的租约；仍是当前租约时直接修正本地用量，
+                   已续租或归还时在本地累计，并入下一次租约结算（不为单个请求访问Redis）
+            used_requests: 为0时同时归还该请求占用的请求数（仅限租约仍是当前租约时，
+                           已结算的租约只修正token）
+        """
+        if lease is None:
+            await RateLimiter.reconcile_tokens(
+                identifier, request_id, estimated_tokens, actual_tokens, prefix, used_requests
+            )
+            return
+        delta = actual_tokens - estimated_tokens
+        bucket = HybridRateLimiter._buckets.get((prefix, identifier))
+        if bucket is not None and bucket.lease_member == lease:
+            bucket.used_tokens += delta
+            bucket.used_requests -= 1 - used_requests
+            return
+        carried = HybridRateLimiter._carried
+        carried[(prefix, identifier)] = carried.get((prefix, identifier), 0) + delta
+    
+    @staticmethod
+    async def _settle_lease(identifier: str, lease: str, used_requests: int, used_tokens: int, prefix: str):
+        """结算租约，并入累计的token修正"""
+        used_tokens += HybridRateLimiter._carried.pop((prefix, identifier), 0)
+        await RateLimiter.settle_record(identifier, lease, used_requests, used_tokens, prefix)
+    
+    @staticmethod
+    async def _flush_carried():
+        """没有租约可并入的累计修正（标识已无活跃租约）批量写入Redis"""
+        carried = HybridRateLimiter._carried
+        for key in [key for key in carried if key not in HybridRateLimiter._buckets]:
+            prefix, identifier = key
+            delta = carried.pop(key)
+            if delta == 0 or not RedisHealth.is_available():
+                continue
+            try:
+                await RateLimiter.adjust_tokens(identifier, delta, prefix)
+            except Exception as e:
+                logger.error(f"Failed to reconcile rate limit tokens: {e}")
+    
+    @staticmethod
+    async def _renew(bucket: LeaseBucket, identifier: str, min_tokens: int, prefix: str):
+        """续租：申请新的额度块，再结算旧租约"""
+        try:
+            fraction = settings.RATE_LIMIT_LEASE_FRACTION
+            request_chunk = max(1, math.ceil(bucket.limit_rpm * fraction))
+            token_chunk = max(min_tokens, math.ceil(bucket.limit_tpm * fraction))
+            member_id = uuid.uuid4().hex
+            granted_requests, granted_tokens, _, _, _ = await RateLimiter.acquire(
+                identifier, bucket.limit_rpm, bucket.limit_tpm, request_chunk, token_chunk,
+                prefix, member_id=member_id, partial=True
+            )
+            
+            # 切换到新租约（单线程内原子完成），旧租约按最终用量结算
+            old_member, old_used_requests, old_used_tokens = (
+                bucket.lease_member, bucket.used_requests, bucket.used_tokens
+            )
+            if granted_requests > 0:
+                bucket.lease_member = f"{member_id}:{granted_requests}:{granted_tokens}"
+                bucket.granted_requests = granted_requests
+                bucket.granted_tokens = granted_tokens
+                bucket.expires_at = time.time() + settings.RATE_LIMIT_LEASE_TTL_SECONDS
+            else:
+                bucket.lease_member = None
+                bucket.granted_requests = 0
+                bucket.granted_tokens = 0
+                bucket.expires_at = 0.0
+            bucket.used_requests = 0
+            bucket.used_tokens = 0
+            
+            if old_member:
+                await HybridRateLimiter._settle_lease(identifier, old_member, old_used_requests, old_used_tokens, prefix)
+        finally:
+            bucket.renewing = None
+    
+    @staticmethod
+    async def _release_expired():
+        """归还已过期且空闲的租约"""
+        now = time.time()
+        for (prefix, identifier), bucket in list(HybridRateLimiter._buckets.items()):
+            if bucket.renewing is not None or now < bucket.expires_at:
+                continue
+            HybridRateLimiter._buckets.pop((prefix, identifier), None)
+            if bucket.lease_member:
+                try:
+                    await HybridRateLimiter._settle_lease(
+                        identifier, bucket.lease_member, bucket.used_requests, bucket.used_tokens, prefix
+                    )
+                except Exception as e:
+                    logger.error(f"Failed to release rate limit lease: {e}")
+        await HybridRateLimiter._flush_carried()
+    
+    @staticmethod
+    async def _sweep_loop():
+        """后台循环：定期归还过期租约"""
+        while True:
+            await asyncio.sleep(settings.RATE_LIMIT_LEASE_TTL_SECONDS)
+            await HybridRateLimiter._release_expired()
+    
+    @staticmethod
+    def start():
+        """启动后台租约回收任务"""
+        if settings.RATE_LIMIT_HYBRID_ENABLED and HybridRateLimiter._sweeper_task is None:
+            HybridRateLimiter._sweeper_task = asyncio.create_task(HybridRateLimiter._sweep_loop())
+    
+    @staticmethod
+    async def stop():
+        """停止后台任务并归还所有租约"""
+        task = HybridRateLimiter._sweeper_task
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+            HybridRateLimiter._sweeper_task = None
+        for bucket in HybridRateLimiter._buckets.values():
+            bucket.expires_at = 0.0
+        await HybridRateLimiter._release_expired()
+
+
+class TokenReservation:
+    """一次请求在限流窗口中按估算值预占的token，请求结束后按实际用量结算"""
+    
+    def __init__(self, identifier: str, estimated_tokens: int, prefix: str = "key"):
+        self.identifier = identifier
+        self.estimated_tokens = estimated_tokens
+        self.prefix = prefix
+        self.request_id = uuid.uuid4().hex
+        self.lease: Optional[str] = None  # 放行该请求的本地租约（HybridRateLimiter返回的info中带lease）
+        self.quota = None  # 同一估算值的月度配额预占（QuotaReservation），随本预占一起结算
+        self.settled = False
+    
+    async def settle(self, actual_tokens: int):
+        """
+        结算（只生效一次）
+        
+        请求已发往上游但失败时传0，归还预占的token和配额；该请求仍计入RPM。
+        请求未发往上游即被拒绝时使用 cancel()。
+        """
+        await self._settle(actual_tokens, 1)
+    
+    async def cancel(self):
+        """撤销（只生效一次）：请求未发往上游时归还预占的token、配额和RPM请求数"""
+        await self._settle(0, 0)
+    
+    async def _settle(self, actual_tokens: int, used_requests: int):
+        if self.settled:
+            return
+        self.settled = True
+        if self.quota is not None:
+            await self.quota.settle(actual_tokens)
+        if actual_tokens == self.estimated_tokens and used_requests == 1:
+            return
+        await HybridRateLimiter.reconcile_tokens(
+            self.identifier, self.request_id, self.estimated_tokens, actual_tokens,
+            self.prefix, self.lease, used_requests
+        )
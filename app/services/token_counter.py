@@ -0,0 +1,143 @@
+"""
+Token计数（用于限流和配额的准入估算，以及流式响应缺少usage时的用量计算）
+使用本地BPE词表（tiktoken）按模型系列选择编码，未安装或词表不可用时退化为按字符估算
+"""
+import hashlib
+import os
+import re
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, Tuple
+from app.config import settings
+from app.utils.logger import logger
+
+# 模型名前缀 -> 编码（按顺序匹配，未匹配的模型使用默认编码）
+MODEL_ENCODINGS = [
+    ("gpt-4o", "o200k_base"),
+    ("gpt-4.1", "o200k_base"),
+    ("gpt-4.5", "o200k_base"),
+    ("o1", "o200k_base"),
+    ("o3", "o200k_base"),
+    ("o4", "o200k_base"),
+    ("gpt-4", "cl100k_base"),
+    ("gpt-3.5", "cl100k_base"),
+    ("gpt-35", "cl100k_base"),  # Azure部署名
+]
+DEFAULT_ENCODING = "cl100k_base"
+
+# tiktoken词表地址；缓存目录中的文件名为该地址的sha1（与tiktoken的缓存规则一致）
+VOCAB_URL = "https://openaipublic.blob.core.windows.net/encodings/{name}.tiktoken"
+
+# 每条消息的格式开销，以及回复起始的固定开销（与OpenAI计费方式一致）
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_NAME = 1
+TOKENS_REPLY_PRIMING = 3
+
+# 中日韩字符（退化估算时每个字符约计1个token）
+_CJK_PATTERN = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]")
+
+
+class TokenCounter:
+    """Token计数器"""
+    
+    # 编码名 -> tiktoken.Encoding（启动时加载）
+    _encodings: Dict[str, object] = {}
+    
+    # (编码名, 内容哈希) -> token数（LRU，系统提示词等重复内容只编码一次）
+    _cache: "OrderedDict[Tuple[str, bytes], int]" = OrderedDict()
+    
+    @staticmethod
+    def vocab_path(name: str) -> str:
+        """编码在 TOKENIZER_VOCAB_DIR 中的词表文件路径"""
+        cache_key = hashlib.sha1(VOCAB_URL.format(name=name).encode()).hexdigest()
+        return os.path.join(settings.TOKENIZER_VOCAB_DIR, cache_key)
+    
+    @staticmethod
+    def load():
+        """加载本地词表（阻塞，启动时在线程中调用；词表缺失时tiktoken会联网下载，只从 TOKENIZER_VOCAB_DIR 加载）"""
+        if not settings.TOKENIZER_VOCAB_DIR:
+            logger.warning("TOKENIZER_VOCAB_DIR is not set, token counts fall back to character estimation")
+            return
+        os.environ["TIKTOKEN_CACHE_DIR"] = settings.TOKENIZER_VOCAB_DIR
+        try:
+            import tiktoken
+        except ImportError:
+            logger.warning("tiktoken is not installed, token counts fall back to character estimation")
+            return
+        for name in {encoding for _, encoding in MODEL_ENCODINGS} | {DEFAULT_ENCODING}:
+            if not os.path.exists(TokenCounter.vocab_path(name)):
+                logger.warning(
+                    f"Tokenizer vocabulary {name} not found in {settings.TOKENIZER_VOCAB_DIR}, "
+                    f"falling back to character estimation"
+                )
+                continue
+            try:
+                TokenCounter._encodings[name] = tiktoken.get_encoding(name)
+            except Exception as e:
+                logger.warning(f"Failed to load tokenizer {name}, falling back to character estimation: {e}")
+        logger.info(f"Loaded tokenizers: {sorted(TokenCounter._encodings)}")
+    
+    @staticmethod
+    def encoding_for_model(model: str) -> str:
+        """获取模型对应的编码名（模型名由客户端传入，不按模型名缓存）"""
+        lowered = model.lower()
+        return next(
+            (encoding for prefix, encoding in MODEL_ENCODINGS if lowered.startswith(prefix)),
+            DEFAULT_ENCODING
+        )
+    
+    @staticmethod
+    def _estimate(text: str) -> int:
+        """按字符估算（中日韩字符约1个token，其余约4个字符1个token）"""
+        cjk = len(_CJK_PATTERN.findall(text))
+        return cjk + (len(text) - cjk + 3) // 4
+    
+    @staticmethod
+    def _count(text: str, name: str) -> int:
+        """按编码计算token数（词表不可用时按字符估算）"""
+        encoding = TokenCounter._encodings.get(name)
+        if encoding is None:
+            return TokenCounter._estimate(text)
+        return len(encoding.encode(text, disallowed_special=()))
+    
+    @staticmethod
+    def count_text(text: str, model: str) -> int:
+        """计算一段文本的token数（带缓存）"""
+        if not text:
+            return 0
+        name = TokenCounter.encoding_for_model(model)
+        cache_key = (name, hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest())
+        cache = TokenCounter._cache
+        count = cache.get(cache_key)
+        if count is not None:
+            cache.move_to_end(cache_key)
+            return count
+    
+        count = TokenCounter._count(text, name)
+        cache[cache_key] = count
+        if len(cache) > settings.TOKEN_COUNT_CACHE_SIZE:
+            cache.popitem(last=False)
+        return count
+    
+    @staticmethod
+    def count_completion(text: str, model: str) -> int:
+        """计算模型输出的token数（不缓存，输出几乎不会重复）"""
+        if not text:
+            return 0
+        return TokenCounter._count(text, TokenCounter.encoding_for_model(model))
+    
+    @staticmethod
+    def count_messages(messages: Iterable, model: str) -> int:
+        """计算chat消息的prompt token数（含消息格式开销）"""
+        total = TOKENS_REPLY_PRIMING
+        for message in messages:
+            total += TOKENS_PER_MESSAGE
+            total += TokenCounter.count_text(message.role, model)
+            total += TokenCounter.count_text(message.content, model)
+            if message.name:
+                total += TOKENS_PER_NAME + TokenCounter.count_text(message.name, model)
+        return total
+    
+    @staticmethod
+    def estimate_request_tokens(messages: Iterable, model: str, max_tokens: Optional[int]) -> int:
+        """估算一次请求的总token数（prompt + 最大输出）"""
+        return TokenCounter.count_messages(messages, model) + (max_tokens or 1000)
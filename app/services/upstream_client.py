@@ -3,51 +3,341 @@
 """
 import httpx
 import json
-from typing import AsyncGenerator, Optional, Dict, Any
+import re
+import time
+from typing import AsyncGenerator, Optional, Dict, Any, List
 from app.config import settings
+from app.services.upstream_stats import UpstreamStats
 from app.utils.logger import logger
 
+# 进程级连接池注册表：按上游地址（scheme://host:port）复用 httpx.AsyncClient
+http_clients: Dict[str, httpx.AsyncClient] = {}
+
+
+def _pool_key(base_url: str) -> str:
+    """生成连接池key（同一主机共用一个连接池）"""
+    url = httpx.URL(base_url)
+    port = f":{url.port}" if url.port else ""
+    return f"{url.scheme}://{url.host}{port}"
+
+
+def _http2_available() -> bool:
+    """检查是否安装了HTTP/2支持（h2）"""
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def get_http_client(base_url: str) -> httpx.AsyncClient:
+    """获取（或创建）指定上游的长连接客户端"""
+    key = _pool_key(base_url)
+    client = http_clients.get(key)
+    if client is None or client.is_closed:
+        http2 = settings.UPSTREAM_HTTP2 and _http2_available()
+        if settings.UPSTREAM_HTTP2 and not http2:
+            logger.warning("h2 is not installed, upstream connections fall back to HTTP/1.1")
+        client = httpx.AsyncClient(
+            timeout=httpx.Timeout(settings.UPSTREAM_TIMEOUT, connect=settings.UPSTREAM_CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=settings.UPSTREAM_MAX_CONNECTIONS,
+                max_keepalive_connections=settings.UPSTREAM_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=settings.UPSTREAM_KEEPALIVE_EXPIRY
+            ),
+            http2=http2
+        )
+        http_clients[key] = client
+        logger.info(f"Created upstream connection pool for {key} (http2={http2})")
+    return client
+
+
+def init_http_clients():
+    """启动时预创建默认上游的连接池"""
+    if settings.UPSTREAM_TYPE == "azure":
+        if settings.AZURE_ENDPOINT:
+            get_http_client(settings.AZURE_ENDPOINT)
+    else:
+        get_http_client(settings.OPENAI_BASE_URL)
+
+
+async def close_http_clients():
+    """关闭时释放所有连接池"""
+    for key, client in list(http_clients.items()):
+        try:
+            await client.aclose()
+        except Exception as e:
+            logger.error(f"Failed to close upstream connection pool {key}: {e}")
+    http_clients.clear()
+
+
+def _parse_duration(value: Optional[str]) -> Optional[float]:
+    """解析上游返回的重置时间（如 "1s"、"6m0s"、"20ms"、"1h2m3.5s"），单位秒"""
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    seconds = 0.0
+    for amount, unit in re.findall(r"([\d.]+)(ms|h|m|s)", value):
+        seconds += float(amount) * {"ms": 0.001, "h": 3600, "m": 60, "s": 1}[unit]
+    return seconds
+
+
+def _parse_int(value: Optional[str]) -> Optional[int]:
+    """解析整数header"""
+    try:
+        return int(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+def parse_retry_after(headers: httpx.Headers) -> Optional[float]:
+    """解析 retry-after-ms / retry-after，单位秒"""
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+    return _parse_duration(headers.get("retry-after"))
+
+
+def parse_rate_limit_headers(headers: httpx.Headers) -> Optional[Dict[str, Any]]:
+    """解析上游限额header（x-ratelimit-*），不存在时返回None"""
+    remaining_requests = _parse_int(headers.get("x-ratelimit-remaining-requests"))
+    remaining_tokens = _parse_int(headers.get("x-ratelimit-remaining-tokens"))
+    if remaining_requests is None and remaining_tokens is None:
+        return None
+    return {
+        "remaining_requests": remaining_requests,
+        "remaining_tokens": remaining_tokens,
+        "limit_requests": _parse_int(headers.get("x-ratelimit-limit-requests")),
+        "limit_tokens": _parse_int(headers.get("x-ratelimit-limit-tokens")),
+        "reset_requests": _parse_duration(headers.get("x-ratelimit-reset-requests")),
+        "reset_tokens": _parse_duration(headers.get("x-ratelimit-reset-tokens")),
+    }
+
+
+class SSEUsageScanner:
+    """
+    透传模式下的usage扫描器
+    
+    不解析每个SSE事件，只对包含 "usage" 字段的事件行做一次JSON解析
+    """
+    
+    def __init__(self):
+        self._tail = b""
+        self.usage: Optional[Dict[str, Any]] = None
+    
+    def feed(self, chunk: bytes):
+        """输入一段上游字节"""
+        data = self._tail + chunk
+        last_newline = data.rfind(b"\n")
+        if last_newline < 0:
+            self._tail = data
+            return
+        self._tail = data[last_newline + 1:]
+        
+        # 快速字节查找，绝大多数token事件在此直接跳过
+        if b'"usage"' not in data:
+            return
+        for line in data[:last_newline].split(b"\n"):
+            if b'"usage"' not in line or b'"usage":null' in line:
+                continue
+            line = line.strip()
+            if not line.startswith(b"data:"):
+                continue
+            try:
+                event_data = json.loads(line[5:])
+            except ValueError:
+                continue
+            if isinstance(event_data, dict) and event_data.get("usage"):
+                self.usage = event_data["usage"]
+
+
+def is_usage_only_event(event_data: Any) -> bool:
+    """是否为只携带usage的SSE事件（include_usage时上游最后发送，choices为空）"""
+    return isinstance(event_data, dict) and bool(event_data.get("usage")) and not event_data.get("choices")
+
+
+class SSEUsageFilter:
+    """
+    透传模式下去掉只携带usage的SSE事件（客户端未请求include_usage、由网关注入时不转发）
+    
+    按行转发，未结束的行留到下一段字节再处理；去掉事件时连同其后的空行（事件分隔符）一起去掉
+    """
+    
+    def __init__(self):
+        self._tail = b""
+        self._dropped = False  # 上一行是被去掉的usage事件
+    
+    @staticmethod
+    def _keep(line: bytes) -> bool:
+        """该行是否需要转发"""
+        if b'"usage"' not in line:
+            return True
+        stripped = line.strip()
+        if not stripped.startswith(b"data:"):
+            return True
+        try:
+            return not is_usage_only_event(json.loads(stripped[5:]))
+        except ValueError:
+            return True
+    
+    def feed(self, chunk: bytes) -> bytes:
+        """输入一段上游字节，返回需要转发的字节"""
+        data = self._tail + chunk
+        last_newline = data.rfind(b"\n")
+        if last_newline < 0:
+            self._tail = data
+            return b""
+        self._tail = data[last_newline + 1:]
+        data = data[:last_newline + 1]
+        if b'"usage"' not in data and not self._dropped:
+            return data
+        kept = []
+        for line in data.splitlines(keepends=True):
+            if self._dropped and not line.strip():
+                self._dropped = False
+                continue
+            self._dropped = not self._keep(line)
+            if not self._dropped:
+                kept.append(line)
+        return b"".join(kept)
+    
+    def flush(self) -> bytes:
+        """流结束时返回剩余字节"""
+        data, self._tail = self._tail, b""
+        return data if self._keep(data) else b""
+
+
+class StreamCompletionAccumulator:
+    """
+    累积流式响应的输出文本（上游未返回usage时用于本地计算completion token数）
+    
+    透传模式下只保存原始字节，需要时才解析
+    """
+    
+    def __init__(self):
+        self._raw: List[bytes] = []
+        self._parts: List[str] = []
+    
+    def feed_raw(self, chunk: bytes):
+        """输入一段透传的上游字节"""
+        self._raw.append(chunk)
+    
+    def feed_event(self, event_data: Dict[str, Any]):
+        """输入一个已解析的SSE事件"""
+        for choice in event_data.get("choices") or ():
+            if not isinstance(choice, dict):
+                continue
+            content = (choice.get("delta") or {}).get("content")
+            if content:
+                self._parts.append(content)
+    
+    def text(self) -> str:
+        """已输出的文本"""
+        if self._raw:
+            raw = b"".join(self._raw)
+            self._raw = []
+            for line in raw.split(b"\n"):
+                line = line.strip()
+                if not line.startswith(b"data:") or b'"content"' not in line:
+                    continue
+                try:
+                    event_data = json.loads(line[5:])
+                except ValueError:
+                    continue
+                if isinstance(event_data, dict):
+                    self.feed_event(event_data)
+        return "".join(self._parts)
+
 
 class UpstreamClient:
-    """上游API客户端"""
+    """上游API客户端（轻量对象，连接池由注册表统一管理，API Key按请求传递）"""
     
-    def __init__(self, base_url: str, api_key: str, timeout: int = 300):
+    def __init__(self, base_url: str, api_key: str, timeout: int = 300, key_id: Optional[int] = None):
         self.base_url = base_url.rstrip('/')
         self.api_key = api_key
+        self.key_id = key_id  # 上游密钥ID，用于统计在途请求和延迟
         self.timeout = httpx.Timeout(timeout, connect=settings.UPSTREAM_CONNECT_TIMEOUT)
-        self.client = httpx.AsyncClient(timeout=self.timeout)
+        self.client = get_http_client(self.base_url)
+    
+    def _build_request(self, model: str, messages: list, stream: bool, **kwargs) -> Dict[str, Any]:
+        """构造上游请求参数"""
+        return {
+            "url": f"{self.base_url}/chat/completions",
+            "headers": {
+                "Authorization": f"Bearer {self.api_key}",
+                "Content-Type": "application/json"
+            },
+            "json": {
+                "model": model,
+                "messages": messages,
+                "stream": stream,
+                **kwargs
+            }
+        }
     
     async def chat_completions(
         self,
         model: str,
         messages: list,
         stream: bool = False,
+        passthrough: bool = False,
+        strip_usage: bool = False,
         **kwargs
     ) -> AsyncGenerator[Dict[str, Any], None]:
         """
         调用chat completions接口
         
+        Args:
+            passthrough: 流式透传模式，原样转发上游字节，不逐事件解析
+            strip_usage: 透传时去掉只携带usage的事件（usage仍会扫描并在结束事件中返回）
+        
         Yields:
             dict: SSE事件数据或完整响应
+            透传模式下为 {"type": "raw", "data": bytes}，结束时 {"type": "end", "usage": dict|None}
         """
-        url = f"{self.base_url}/chat/completions"
-        headers = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json"
-        }
-        
-        data = {
-            "model": model,
-            "messages": messages,
-            "stream": stream,
-            **kwargs
-        }
+        request_kwargs = self._build_request(model, messages, stream, **kwargs)
+        started_at = time.time()
+        UpstreamStats.start_request(self.key_id)
         
         try:
-            async with self.client.stream("POST", url, headers=headers, json=data) as response:
-                response.raise_for_status()
+            async with self.client.stream("POST", timeout=self.timeout, **request_kwargs) as response:
+                UpstreamStats.record_rate_limits(self.key_id, parse_rate_limit_headers(response.headers))
+                if response.is_error:
+                    # 错误响应体必须在流关闭前读取
+                    body = await response.aread()
+                    yield {
+                        "type": "error",
+                        "status_code": response.status_code,
+                        "error": body.decode("utf-8", errors="replace"),
+                        "retry_after": parse_retry_after(response.headers)
+                    }
+                    return
+                UpstreamStats.record_response_latency(self.key_id, time.time() - started_at)
                 
-                if stream:
+                if stream and passthrough:
+                    # SSE透传：原样转发，仅扫描usage
+                    scanner = SSEUsageScanner()
+                    usage_filter = SSEUsageFilter() if strip_usage else None
+                    async for chunk in response.aiter_bytes():
+                        scanner.feed(chunk)
+                        if usage_filter is not None:
+                            chunk = usage_filter.feed(chunk)
+                            if not chunk:
+                                continue
+                        yield {"type": "raw", "data": chunk}
+                    if usage_filter is not None:
+                        rest = usage_filter.flush()
+                        if rest:
+                            yield {"type": "raw", "data": rest}
+                    scanner.feed(b"\n")
+                    yield {"type": "end", "usage": scanner.usage}
+                elif stream:
                     # SSE流式响应
                     async for line in response.aiter_lines():
                         if not line:
@@ -64,87 +354,48 @@ class UpstreamClient:
                                 continue
                 else:
                     # 非流式响应
-                    result = await response.json()
-                    yield {"type": "complete", "data": result}
+                    await response.aread()
+                    UpstreamStats.record_latency(time.time() - started_at)
+                    yield {"type": "complete", "data": response.json()}
                     
-        except httpx.HTTPStatusError as e:
-            error_data = {
-                "type": "error",
-                "status_code": e.response.status_code,
-                "error": await e.response.aread() if hasattr(e.response, 'aread') else str(e)
-            }
-            yield error_data
         except Exception as e:
-            logger.error(f"Upstream request failed: {e}")
+            logger.error(f"Upstream request failed ({self.base_url}): {e}")
             yield {"type": "error", "error": str(e)}
-    
-    async def close(self):
-        """关闭客户端"""
-        await self.client.aclose()
+        finally:
+            UpstreamStats.end_request(self.key_id)
 
 
 class AzureUpstreamClient(UpstreamClient):
     """Azure OpenAI客户端"""
     
-    def __init__(self, endpoint: str, api_key: str, deployment_name: str, api_version: str, timeout: int = 300):
+    def __init__(
+        self,
+        endpoint: str,
+        api_key: str,
+        deployment_name: str,
+        api_version: str,
+        timeout: int = 300,
+        key_id: Optional[int] = None
+    ):
         # Azure OpenAI的URL格式
         base_url = f"{endpoint.rstrip('/')}/openai/deployments/{deployment_name}"
-        super().__init__(base_url, api_key, timeout)
+        super().__init__(base_url, api_key, timeout, key_id)
         self.api_version = api_version
     
-    async def chat_completions(
-        self,
-        model: str,  # 在Azure中，model参数会被忽略，使用deployment_name
-        messages: list,
-        stream: bool = False,
-        **kwargs
-    ) -> AsyncGenerator[Dict[str, Any], None]:
-        """Azure OpenAI的chat completions"""
-        url = f"{self.base_url}/chat/completions"
-        headers = {
-            "api-key": self.api_key,  # Azure使用api-key而不是Authorization
-            "Content-Type": "application/json"
-        }
-        
-        params = {
-            "api-version": self.api_version
-        }
-        
-        data = {
-            "messages": messages,
-            "stream": stream,
-            **kwargs
-        }
-        
-        try:
-            async with self.client.stream("POST", url, headers=headers, params=params, json=data) as response:
-                response.raise_for_status()
-                
-                if stream:
-                    async for line in response.aiter_lines():
-                        if not line:
-                            continue
-                        if line.startswith("data: "):
-                            data_str = line[6:]
-                            if data_str == "[DONE]":
-                                yield {"type": "done"}
-                                break
-                            try:
-                                event_data = json.loads(data_str)
-                                yield {"type": "data", "data": event_data}
-                            except json.JSONDecodeError:
-                                continue
-                else:
-                    result = await response.json()
-                    yield {"type": "complete", "data": result}
-                    
-        except httpx.HTTPStatusError as e:
-            error_data = {
-                "type": "error",
-                "status_code": e.response.status_code,
-                "error": await e.response.aread() if hasattr(e.response, 'aread') else str(e)
+    def _build_request(self, model: str, messages: list, stream: bool, **kwargs) -> Dict[str, Any]:
+        """构造Azure请求参数（model参数会被忽略，使用deployment_name）"""
+        return {
+            "url": f"{self.base_url}/chat/completions",
+            "headers": {
+                "api-key": self.api_key,  # Azure使用api-key而不是Authorization
+                "Content-Type": "application/json"
+            },
+            "params": {
+                "api-version": self.api_version
+            },
+            "json": {
+                "messages": messages,
+                "stream": stream,
+                **kwargs
             }
-            yield error_data
-        except Exception as e:
-            logger.error(f"Azure upstream request failed: {e}")
-            yield {"type": "error", "error": str(e)}
+        }
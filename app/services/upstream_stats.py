@@ -0,0 +1,115 @@
+"""
+上游请求统计（进程内）
+记录各Key的在途请求数、响应延迟EWMA、上游返回的限额余量，
+以及近期整体延迟分布（用于推导对冲请求的等待时间）
+"""
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Optional
+from app.config import settings
+
+
+class UpstreamStats:
+    """上游统计"""
+    
+    # 最近的非流式请求延迟（秒），所有Key共用一个窗口
+    _latencies: Deque[float] = deque(maxlen=settings.UPSTREAM_LATENCY_WINDOW)
+    
+    # 各Key的在途请求数
+    _in_flight: Dict[int, int] = {}
+    
+    # 各Key的响应延迟EWMA（秒，从发出请求到收到响应头）
+    _ewma_latency: Dict[int, float] = {}
+    
+    # 各Key最近一次上游返回的限额余量（x-ratelimit-* header）
+    _rate_limits: Dict[int, Dict[str, Any]] = {}
+    
+    @staticmethod
+    def start_request(key_id: Optional[int]):
+        """请求开始"""
+        if key_id is not None:
+            UpstreamStats._in_flight[key_id] = UpstreamStats._in_flight.get(key_id, 0) + 1
+    
+    @staticmethod
+    def end_request(key_id: Optional[int]):
+        """请求结束"""
+        if key_id is not None:
+            UpstreamStats._in_flight[key_id] = max(0, UpstreamStats._in_flight.get(key_id, 0) - 1)
+    
+    @staticmethod
+    def in_flight(key_id: int) -> int:
+        """获取Key的在途请求数"""
+        return UpstreamStats._in_flight.get(key_id, 0)
+    
+    @staticmethod
+    def record_response_latency(key_id: Optional[int], seconds: float):
+        """记录Key收到响应头的延迟（更新EWMA）"""
+        if key_id is None:
+            return
+        previous = UpstreamStats._ewma_latency.get(key_id)
+        if previous is None:
+            UpstreamStats._ewma_latency[key_id] = seconds
+        else:
+            alpha = settings.UPSTREAM_EWMA_ALPHA
+            UpstreamStats._ewma_latency[key_id] = alpha * seconds + (1 - alpha) * previous
+    
+    @staticmethod
+    def ewma_latency(key_id: int) -> Optional[float]:
+        """获取Key的延迟EWMA（无样本时返回None）"""
+        return UpstreamStats._ewma_latency.get(key_id)
+    
+    @staticmethod
+    def record_rate_limits(key_id: Optional[int], rate_limits: Optional[Dict[str, Any]]):
+        """记录上游返回的限额余量"""
+        if key_id is None or not rate_limits:
+            return
+        now = time.time()
+        UpstreamStats._rate_limits[key_id] = {
+            **rate_limits,
+            "requests_reset_at": now + (rate_limits.get("reset_requests") or 60),
+            "tokens_reset_at": now + (rate_limits.get("reset_tokens") or 60),
+        }
+    
+    @staticmethod
+    def is_near_rate_limit(key_id: int) -> bool:
+        """Key是否接近上游RPM/TPM上限（重置时间到达后不再视为接近）"""
+        info = UpstreamStats._rate_limits.get(key_id)
+        if not info:
+            return False
+        now = time.time()
+        headroom = settings.UPSTREAM_RATE_LIMIT_HEADROOM
+        
+        def near(remaining: Optional[int], limit: Optional[int], reset_at: float) -> bool:
+            if remaining is None or now >= reset_at:
+                return False
+            if limit:
+                return remaining <= limit * headroom
+            return remaining <= 0
+        
+        return (
+            near(info["remaining_requests"], info["limit_requests"], info["requests_reset_at"])
+            or near(info["remaining_tokens"], info["limit_tokens"], info["tokens_reset_at"])
+        )
+    
+    @staticmethod
+    def record_latency(seconds: float):
+        """记录一次成功的非流式请求延迟"""
+        UpstreamStats._latencies.append(seconds)
+    
+    @staticmethod
+    def latency_percentile(percentile: float) -> Optional[float]:
+        """获取延迟分位数（样本不足时返回None）"""
+        samples = list(UpstreamStats._latencies)
+        if len(samples) < settings.HEDGE_MIN_SAMPLES:
+            return None
+        samples.sort()
+        index = min(len(samples) - 1, int(len(samples) * percentile))
+        return samples[index]
+    
+    @staticmethod
+    def hedge_delay() -> float:
+        """对冲请求的等待时间（由延迟分位数推导）"""
+        delay = UpstreamStats.latency_percentile(settings.HEDGE_PERCENTILE)
+        if delay is None:
+            return settings.HEDGE_DEFAULT_DELAY_SECONDS
+        return max(settings.HEDGE_MIN_DELAY_SECONDS, delay)
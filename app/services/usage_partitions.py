@@ -0,0 +1,196 @@
+"""
+usage_records 按月分区维护
+- 预先创建当前及未来若干个月的分区（按UTC月份划分 created_at）
+- 超过保留期的分区先从主表分离，导出为 gzip 压缩的 NDJSON 归档文件，再删除
+所有worker都会定期执行，通过 PostgreSQL advisory lock 保证同一时刻只有一个在维护。
+"""
+import asyncio
+import gzip
+import json
+import os
+import re
+from datetime import datetime, timezone
+from typing import List, Optional, Tuple
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+from app.config import settings
+from app.models.base import engine
+from app.utils.logger import logger
+
+PARENT_TABLE = "usage_records"
+
+# 分区表名：usage_records_p202610
+PARTITION_NAME_RE = re.compile(rf"^{PARENT_TABLE}_p(\d{{4}})(\d{{2}})$")
+
+# advisory lock ID（任意固定值，避免多个worker同时维护）
+MAINTENANCE_LOCK_ID = 7320250
+
+
+def add_months(year: int, month: int, months: int) -> Tuple[int, int]:
+    """年月加减"""
+    index = year * 12 + (month - 1) + months
+    return index // 12, index % 12 + 1
+
+
+def partition_name(year: int, month: int) -> str:
+    """分区表名"""
+    return f"{PARENT_TABLE}_p{year}{month:02d}"
+
+
+class UsagePartitionManager:
+    """usage_records 分区维护"""
+    
+    _task: Optional[asyncio.Task] = None
+    
+    @staticmethod
+    def is_partitioned(conn: Connection) -> bool:
+        """usage_records 是否为分区表（未执行迁移脚本时为普通表，跳过维护）"""
+        return conn.execute(text("""
+            SELECT 1 FROM pg_partitioned_table p
+            JOIN pg_class c ON c.oid = p.partrelid
+            WHERE c.relname = :name AND c.relnamespace = current_schema()::regnamespace
+        """), {"name": PARENT_TABLE}).first() is not None
+    
+    @staticmethod
+    def ensure_partitions(conn: Connection, now: Optional[datetime] = None) -> List[str]:
+        """创建当前月及未来 USAGE_PARTITION_PREMAKE_MONTHS 个月的分区，返回新建的分区名"""
+        now = now or datetime.now(timezone.utc)
+        created = []
+        for offset in range(settings.USAGE_PARTITION_PREMAKE_MONTHS + 1):
+            year, month = add_months(now.year, now.month, offset)
+            if UsagePartitionManager.create_partition(conn, year, month):
+                created.append(partition_name(year, month))
+        return created
+    
+    @staticmethod
+    def create_partition(conn: Connection, year: int, month: int) -> bool:
+        """创建指定月份的分区，已存在时返回False"""
+        name = partition_name(year, month)
+        if conn.execute(text("SELECT to_regclass(:name)"), {"name": name}).scalar():
+            return False
+        next_year, next_month = add_months(year, month, 1)
+        conn.execute(text(f"""
+            CREATE TABLE {name} PARTITION OF {PARENT_TABLE}
+            FOR VALUES FROM ('{year}-{month:02d}-01 00:00:00+00') TO ('{next_year}-{next_month:02d}-01 00:00:00+00')
+        """))
+        return True
+    
+    @staticmethod
+    def _expired_partitions(conn: Connection, now: datetime) -> List[Tuple[str, bool]]:
+        """
+        超过保留期的分区
+        
+        Returns:
+            [(分区名, 是否仍挂在主表上)]，已分离但未删除的表（上次归档失败）也会返回
+        """
+        cutoff = add_months(now.year, now.month, -settings.USAGE_RETENTION_MONTHS)
+        rows = conn.execute(text("""
+            SELECT c.relname, EXISTS (
+                SELECT 1 FROM pg_inherits i
+                JOIN pg_class p ON p.oid = i.inhparent
+                WHERE i.inhrelid = c.oid AND p.relname = :parent
+            )
+            FROM pg_class c
+            WHERE c.relkind IN ('r', 'p') AND c.relnamespace = current_schema()::regnamespace
+              AND c.relname LIKE :pattern
+        """), {"parent": PARENT_TABLE, "pattern": f"{PARENT_TABLE}\\_p%"}).all()
+        expired = []
+        for name, attached in rows:
+            match = PARTITION_NAME_RE.match(name)
+            if match and (int(match.group(1)), int(match.group(2))) < cutoff:
+                expired.append((name, attached))
+        return sorted(expired)
+    
+    @staticmethod
+    def export_partition(name: str) -> str:
+        """导出分区为 gzip 压缩的 NDJSON 文件，返回文件路径（先写临时文件，完成后改名）"""
+        os.makedirs(settings.USAGE_ARCHIVE_DIR, exist_ok=True)
+        path = os.path.join(settings.USAGE_ARCHIVE_DIR, f"{name}.ndjson.gz")
+        tmp = f"{path}.tmp"
+        count = 0
+        # 服务端游标需要在事务中使用，单独开一个连接（维护连接为自动提交模式）
+        with engine.connect() as conn:
+            result = conn.execution_options(yield_per=5000).execute(
+                text(f"SELECT * FROM {name} ORDER BY id")
+            )
+            with gzip.open(tmp, "wt", encoding="utf-8") as f:
+                for row in result.mappings():
+                    f.write(json.dumps(dict(row), ensure_ascii=False, default=str))
+                    f.write("\n")
+                    count += 1
+        os.replace(tmp, path)
+        logger.info(f"Archived {count} usage records from {name} to {path}")
+        return path
+    
+    @staticmethod
+    def archive_expired(conn: Connection, now: Optional[datetime] = None) -> List[str]:
+        """分离、归档并删除超过保留期的分区（USAGE_RETENTION_MONTHS为0时不处理），返回已归档的分区名"""
+        if settings.USAGE_RETENTION_MONTHS <= 0:
+            return []
+        now = now or datetime.now(timezone.utc)
+        archived = []
+        for name, attached in UsagePartitionManager._expired_partitions(conn, now):
+            if attached:
+                # DETACH需要主表的排他锁，拿不到时放弃本轮，避免阻塞写入
+                conn.execute(text("SET lock_timeout = '5s'"))
+                try:
+                    conn.execute(text(f"ALTER TABLE {PARENT_TABLE} DETACH PARTITION {name}"))
+                finally:
+                    conn.execute(text("RESET lock_timeout"))
+                logger.info(f"Detached usage partition {name}")
+            UsagePartitionManager.export_partition(name)
+            conn.execute(text(f"DROP TABLE {name}"))
+            archived.append(name)
+        return archived
+    
+    @staticmethod
+    def run_maintenance() -> bool:
+        """执行一次分区维护（阻塞，在线程中调用），其他worker正在维护时跳过；返回是否执行"""
+        with engine.connect() as conn:
+            conn = conn.execution_options(isolation_level="AUTOCOMMIT")
+            if not UsagePartitionManager.is_partitioned(conn):
+                logger.warning(f"{PARENT_TABLE} is not partitioned, run scripts/partition_usage_records.py")
+                return False
+            if not conn.execute(text("SELECT pg_try_advisory_lock(:id)"), {"id": MAINTENANCE_LOCK_ID}).scalar():
+                return False
+            try:
+                created = UsagePartitionManager.ensure_partitions(conn)
+                if created:
+                    logger.info(f"Created usage partitions: {created}")
+                UsagePartitionManager.archive_expired(conn)
+            finally:
+                conn.execute(text("SELECT pg_advisory_unlock(:id)"), {"id": MAINTENANCE_LOCK_ID})
+        return True
+    
+    @staticmethod
+    async def _maintenance_loop():
+        """定期维护"""
+        while True:
+            await asyncio.sleep(settings.USAGE_PARTITION_CHECK_INTERVAL_SECONDS)
+            try:
+                await asyncio.to_thread(UsagePartitionManager.run_maintenance)
+            except Exception as e:
+                logger.error(f"Usage partition maintenance failed: {e}")
+    
+    @staticmethod
+    async def start():
+        """启动时先确保当月分区存在，再启动定期维护任务"""
+        try:
+            await asyncio.to_thread(UsagePartitionManager.run_maintenance)
+        except Exception as e:
+            # 分区缺失时写入失败的用量记录会溢出到本地文件，之后重放
+            logger.error(f"Usage partition maintenance failed: {e}")
+        if UsagePartitionManager._task is None:
+            UsagePartitionManager._task = asyncio.create_task(UsagePartitionManager._maintenance_loop())
+    
+    @staticmethod
+    async def stop():
+        """停止定期维护任务"""
+        task = UsagePartitionManager._task
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+            UsagePartitionManager._task = None
@@ -1,21 +1,22 @@
 """
-用量统计服务
+用量统计服务（异步数据库会话，不阻塞事件循环；请求记录经 UsageWriter 批量写入）
 """
-from sqlalchemy.orm import Session
-from sqlalchemy import func, and_
-from datetime import datetime, date
-from typing import Optional
-from app.models.usage import UsageRecord, UsageDaily, UsageMonthly
+from sqlalchemy import select, and_, func
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+from app.models.base import AsyncSessionLocal
+from app.models.usage import UsageDaily, UsageMonthly
 from app.models.user import User
-from app.utils.logger import logger
+from app.services.usage_writer import AGGREGATE_COLUMNS, UsageWriter
 
 
 class UsageTracker:
     """用量统计器"""
     
     @staticmethod
-    def record_usage(
-        db: Session,
+    async def record_usage(
         user_id: int,
         api_key_id: Optional[int],
         upstream_key_id: Optional[int],
@@ -31,122 +32,109 @@ class UsageTracker:
         error_type: Optional[str] = None,
         error_message: Optional[str] = None
     ):
-        """记录单次请求"""
-        try:
-            record = UsageRecord(
-                user_id=user_id,
-                api_key_id=api_key_id,
-                upstream_key_id=upstream_key_id,
-                model=model,
-                prompt_tokens=prompt_tokens,
-                completion_tokens=completion_tokens,
-                total_tokens=total_tokens,
-                response_status=response_status,
-                response_time_ms=response_time_ms,
-                client_ip=client_ip,
-                user_agent=user_agent,
-                request_body=request_body,
-                error_type=error_type,
-                error_message=error_message
-            )
-            db.add(record)
-            db.commit()
-            
-            # 异步更新聚合表（可以改为后台任务）
-            UsageTracker._update_aggregates(db, user_id, total_tokens)
-            
-        except Exception as e:
-            logger.error(f"Failed to record usage: {e}")
-            db.rollback()
+        """记录单次请求（写入缓冲区，由 UsageWriter 批量落库）"""
+        UsageWriter.enqueue({
+            "user_id": user_id,
+            "api_key_id": api_key_id,
+            "upstream_key_id": upstream_key_id,
+            "model": model,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": total_tokens,
+            "response_status": response_status,
+            "response_time_ms": response_time_ms,
+            "client_ip": client_ip,
+            "user_agent": user_agent,
+            "request_body": request_body,
+            "error_type": error_type,
+            "error_message": error_message
+        })
     
     @staticmethod
-    def _update_aggregates(db: Session, user_id: int, tokens: int):
-        """更新聚合统计"""
-        try:
-            today = date.today()
-            today_str = today.strftime("%Y-%m-%d")
-            
-            # 更新每日统计
-            daily = db.query(UsageDaily).filter(
-                and_(
-                    UsageDaily.user_id == user_id,
-                    UsageDaily.date == today_str
-                )
-            ).first()
-            
-            if daily:
-                daily.total_requests += 1
-                daily.total_tokens += tokens
-            else:
-                daily = UsageDaily(
-                    user_id=user_id,
-                    date=today_str,
-                    total_requests=1,
-                    total_tokens=tokens
-                )
-                db.add(daily)
-            
-            # 更新每月统计
-            now = datetime.now()
-            monthly = db.query(UsageMonthly).filter(
-                and_(
-                    UsageMonthly.user_id == user_id,
-                    UsageMonthly.year == now.year,
-                    UsageMonthly.month == now.month
-                )
-            ).first()
-            
-            if monthly:
-                monthly.total_requests += 1
-                monthly.total_tokens += tokens
-            else:
-                monthly = UsageMonthly(
-                    user_id=user_id,
-                    year=now.year,
-                    month=now.month,
-                    total_requests=1,
-                    total_tokens=tokens
-                )
-                db.add(monthly)
-            
-            db.commit()
-            
-        except Exception as e:
-            logger.error(f"Failed to update aggregates: {e}")
-            db.rollback()
+    async def apply_aggregates(
+        db: AsyncSession,
+        daily: Dict[Tuple[int, str], dict],
+        monthly: Dict[Tuple[int, int, int], dict]
+    ):
+        """
+        累加聚合统计（INSERT ... ON CONFLICT DO UPDATE，并发写入不丢增量，由调用方提交）
+        
+        Args:
+            daily: (用户ID, 日期YYYY-MM-DD) -> 各累加列的增量
+            monthly: (用户ID, 年, 月) -> 各累加列的增量
+        """
+        # 按唯一键排序，多个worker同时更新同一批用户时加锁顺序一致，避免死锁
+        if daily:
+            stmt = pg_insert(UsageDaily).values([
+                {"user_id": user_id, "date": day, **delta}
+                for (user_id, day), delta in sorted(daily.items())
+            ])
+            await db.execute(UsageTracker._accumulate(stmt, UsageDaily, ["user_id", "date"]))
+        
+        if monthly:
+            stmt = pg_insert(UsageMonthly).values([
+                {"user_id": user_id, "year": year, "month": month, **delta}
+                for (user_id, year, month), delta in sorted(monthly.items())
+            ])
+            await db.execute(UsageTracker._accumulate(stmt, UsageMonthly, ["user_id", "year", "month"]))
+    
+    @staticmethod
+    def _accumulate(stmt, model, index_elements: List[str]):
+        """冲突时把增量累加到已有行"""
+        columns = {
+            name: getattr(model, name) + getattr(stmt.excluded, name)
+            for name in AGGREGATE_COLUMNS
+        }
+        columns["updated_at"] = func.now()
+        return stmt.on_conflict_do_update(index_elements=index_elements, set_=columns)
     
     @staticmethod
-    def get_monthly_usage(db: Session, user_id: int, year: int, month: int) -> Optional[UsageMonthly]:
+    async def get_monthly_usage(db: AsyncSession, user_id: int, year: int, month: int) -> Optional[UsageMonthly]:
         """获取月度用量"""
-        return db.query(UsageMonthly).filter(
-            and_(
-                UsageMonthly.user_id == user_id,
-                UsageMonthly.year == year,
-                UsageMonthly.month == month
+        result = await db.execute(
+            select(UsageMonthly).filter(
+                and_(
+                    UsageMonthly.user_id == user_id,
+                    UsageMonthly.year == year,
+                    UsageMonthly.month == month
+                )
             )
-        ).first()
+        )
+        return result.scalars().first()
     
     @staticmethod
-    def check_quota(db: Session, user_id: int, tokens: int) -> tuple[bool, Optional[str]]:
+    async def check_quota(user_id: int, tokens: int) -> tuple[bool, Optional[str]]:
         """
-        检查配额
+        检查配额（用户状态和当月用量一次查询；请求热路径使用 QuotaCounter，Redis不可用时才回退到这里）
         
         Returns:
             (is_allowed, error_message)
         """
-        user = db.query(User).filter(User.id == user_id).first()
-        if not user:
+        now = datetime.now()
+        async with AsyncSessionLocal() as db:
+            row = (await db.execute(
+                select(User.is_active, User.monthly_quota_tokens, UsageMonthly.total_tokens)
+                .outerjoin(
+                    UsageMonthly,
+                    and_(
+                        UsageMonthly.user_id == User.id,
+                        UsageMonthly.year == now.year,
+                        UsageMonthly.month == now.month
+                    )
+                )
+                .filter(User.id == user_id)
+            )).first()
+        
+        if not row:
             return False, "User not found"
         
-        if not user.is_active:
+        is_active, quota_tokens, current_usage = row
+        if not is_active:
             return False, "User is inactive"
         
         # 检查月度配额
-        now = datetime.now()
-        monthly = UsageTracker.get_monthly_usage(db, user_id, now.year, now.month)
-        
-        current_usage = monthly.total_tokens if monthly else 0
-        if current_usage + tokens > user.monthly_quota_tokens:
-            return False, f"Monthly quota exceeded. Used: {current_usage}/{user.monthly_quota_tokens}"
+        current_usage = current_usage or 0
+        if current_usage + tokens > quota_tokens:
+            return False, f"Monthly quota exceeded. Used: {current_usage}/{quota_tokens}"
         
         return True, None
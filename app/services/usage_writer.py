@@ -0,0 +1,405 @@
+"""
+用量记录批量写入（write-behind）
+请求结束时只把记录放入进程内缓冲区，后台任务按时间间隔或条数批量写入数据库
+（多行INSERT + 每批按用户合并后的聚合UPSERT），审计写入不再计入请求耗时。
+数据库不可用时整批追加到本地溢出文件（JSON Lines），恢复后自动重放；
+个别记录本身无法写入（超长字段、外键失效等）时逐条重试，这些记录转存到 .rejected 文件，不影响其余记录。
+"""
+import asyncio
+import fcntl
+import json
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy import String, insert
+from app.config import settings
+from app.models.base import AsyncSessionLocal
+from app.models.usage import UsageRecord
+from app.utils.logger import logger
+
+# 写入失败后，至少间隔该时长再重放溢出文件
+REPLAY_RETRY_SECONDS = 5.0
+
+# 字符串列的最大长度（客户端可控的字段超长时截断，避免整批写入失败）
+STRING_COLUMN_LIMITS = {
+    column.name: column.type.length
+    for column in UsageRecord.__table__.columns
+    if isinstance(column.type, String) and column.type.length
+}
+
+# 记录本身导致的写入错误（SQLSTATE）：数据异常（22xxx）、非空约束、外键约束；其他错误视为数据库暂时不可用
+RECORD_ERROR_CODES = ("23502", "23503")
+
+# 聚合表（usage_daily / usage_monthly）的累加列
+AGGREGATE_COLUMNS = (
+    "total_requests",
+    "total_prompt_tokens",
+    "total_completion_tokens",
+    "total_tokens",
+    "total_cost",
+)
+
+
+class UsageWriter:
+    """用量记录写入器"""
+    
+    _buffer: List[dict] = []
+    _wakeup: Optional[asyncio.Event] = None
+    _flusher_task: Optional[asyncio.Task] = None
+    _lock: Optional[asyncio.Lock] = None
+    _stopping = False
+    _replay_after = 0.0  # time.monotonic()
+    
+    # 解析后的 MODEL_PRICES（按前缀匹配，不按客户端传入的模型名缓存）
+    _price_list: Optional[List[Tuple[str, float, float]]] = None
+    
+    # 累计统计
+    _written = 0
+    _spilled = 0
+    _replayed = 0
+    _rejected = 0
+    _last_error: Optional[str] = None
+    
+    @staticmethod
+    def enqueue(record: dict):
+        """放入缓冲区（不访问数据库）"""
+        record.setdefault("created_at", datetime.now(timezone.utc))
+        for name, limit in STRING_COLUMN_LIMITS.items():
+            value = record.get(name)
+            if value is not None and len(value) > limit:
+                record[name] = value[:limit]
+        UsageWriter._buffer.append(record)
+        if len(UsageWriter._buffer) >= settings.USAGE_FLUSH_BATCH_SIZE and UsageWriter._wakeup is not None:
+            UsageWriter._wakeup.set()
+    
+    @staticmethod
+    def _cost(model: str, prompt_tokens: int, completion_tokens: int) -> float:
+        """按 MODEL_PRICES 计算成本（美元），未配置价格的模型记为0"""
+        if UsageWriter._price_list is None:
+            UsageWriter._price_list = settings.MODEL_PRICE_LIST
+        lowered = model.lower()
+        prompt_price, completion_price = next(
+            ((p, c) for prefix, p, c in UsageWriter._price_list if lowered.startswith(prefix)),
+            (0.0, 0.0)
+        )
+        return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000
+    
+    @staticmethod
+    def _aggregate(records: List[dict]) -> Tuple[Dict[Tuple[int, str], dict], Dict[Tuple[int, int, int], dict]]:
+        """
+        在内存中合并一批记录的增量
+        
+        Returns:
+            ((用户ID, 日期) -> 增量, (用户ID, 年, 月) -> 增量)，增量的键为聚合表列名
+        """
+        daily: Dict[Tuple[int, str], dict] = defaultdict(lambda: dict.fromkeys(AGGREGATE_COLUMNS, 0))
+        monthly: Dict[Tuple[int, int, int], dict] = defaultdict(lambda: dict.fromkeys(AGGREGATE_COLUMNS, 0))
+        for record in records:
+            # 聚合表按服务器本地日期统计（与原逐条写入一致）
+            day = record["created_at"].astimezone().date()
+            prompt_tokens = record["prompt_tokens"] or 0
+            completion_tokens = record["completion_tokens"] or 0
+            cost = UsageWriter._cost(record["model"], prompt_tokens, completion_tokens)
+            user_id = record["user_id"]
+            for delta in (daily[(user_id, day.strftime("%Y-%m-%d"))], monthly[(user_id, day.year, day.month)]):
+                delta["total_requests"] += 1
+                delta["total_prompt_tokens"] += prompt_tokens
+                delta["total_completion_tokens"] += completion_tokens
+                delta["total_tokens"] += record["total_tokens"] or 0
+                delta["total_cost"] += cost
+        return daily, monthly
+    
+    @staticmethod
+    async def _write(records: List[dict]):
+        """一个事务写入一批记录及聚合"""
+        from app.services.usage_tracker import UsageTracker
+        daily, monthly = UsageWriter._aggregate(records)
+        async with AsyncSessionLocal() as db:
+            try:
+                await db.execute(insert(UsageRecord), records)
+                await UsageTracker.apply_aggregates(db, daily, monthly)
+                await db.commit()
+            except Exception:
+                await db.rollback()
+                raise
+    
+    @staticmethod
+    def _dump(f, records: List[dict]):
+        """按JSON Lines写出记录"""
+        for record in records:
+            f.write(json.dumps(dict(record, created_at=record["created_at"].isoformat()), ensure_ascii=False))
+            f.write("\n")
+    
+    @staticmethod
+    @contextmanager
+    def _append_lock():
+        """
+        溢出文件的追加锁（多个worker共用溢出文件）
+        
+        追加整批记录、以及重放前改名都持有该锁：不同worker的批次不会交错，
+        改名时也没有worker仍打开着旧文件（否则之后的追加会写进已读取的重放文件）
+        """
+        path = settings.USAGE_SPILL_PATH
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(f"{path}.append.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+    
+    @staticmethod
+    def _spill(records: List[dict]):
+        """追加到本地溢出文件（在线程池中执行）"""
+        with UsageWriter._append_lock():
+            with open(settings.USAGE_SPILL_PATH, "a", encoding="utf-8") as f:
+                UsageWriter._dump(f, records)
+    
+    @staticmethod
+    def _take_spill() -> List[dict]:
+        """取出溢出文件中的全部记录（改名后读取，读取期间的新溢出写入新文件）"""
+        path = settings.USAGE_SPILL_PATH
+        replaying = f"{path}.replaying"
+        if not os.path.exists(replaying):
+            with UsageWriter._append_lock():
+                if not os.path.exists(path):
+                    return []
+                os.replace(path, replaying)
+        records = []
+        with open(replaying, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                    record["created_at"] = datetime.fromisoformat(record["created_at"])
+                    records.append(record)
+                except (ValueError, KeyError) as e:
+                    logger.warning(f"Skipped malformed spilled usage record: {e}")
+        return records
+    
+    @staticmethod
+    def _finish_replay():
+        """重放成功后删除溢出文件"""
+        try:
+            os.remove(f"{settings.USAGE_SPILL_PATH}.replaying")
+        except FileNotFoundError:
+            pass
+    
+    @staticmethod
+    def _is_record_error(error: Exception) -> bool:
+        """是否为记录本身导致的错误（重试也不会成功）"""
+        code = getattr(getattr(error, "orig", None), "pgcode", None) or ""
+        return code.startswith("22") or code in RECORD_ERROR_CODES
+    
+    @staticmethod
+    def _reject(record: dict, error: Exception):
+        """转存无法写入的记录（在线程池中执行）"""
+        path = f"{settings.USAGE_SPILL_PATH}.rejected"
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, "a", encoding="utf-8") as f:
+            UsageWriter._dump(f, [dict(record, _error=str(error)[:500])])
+    
+    @staticmethod
+    async def _write_batch(records: List[dict]) -> Tuple[int, List[dict]]:
+        """
+        写入一批记录；整批失败且原因是个别记录时逐条重试，无法写入的记录转存到 .rejected 文件
+        
+        Returns:
+            (写入条数, 因数据库不可用而未写入的记录)
+        """
+        try:
+            await UsageWriter._write(records)
+            return len(records), []
+        except Exception as e:
+            if not UsageWriter._is_record_error(e):
+                UsageWriter._mark_unavailable(e)
+                return 0, records
+        
+        written = 0
+        for i, record in enumerate(records):
+            try:
+                await UsageWriter._write([record])
+                written += 1
+            except Exception as e:
+                if not UsageWriter._is_record_error(e):
+                    UsageWriter._mark_unavailable(e)
+                    return written, records[i:]
+                await UsageWriter._reject_record(record, e)
+        return written, []
+    
+    @staticmethod
+    async def _reject_record(record: dict, error: Exception):
+        """记录无法写入的记录"""
+        UsageWriter._rejected += 1
+        logger.error(f"Rejected usage record (user {record.get('user_id')}): {error}")
+        try:
+            await asyncio.to_thread(UsageWriter._reject, record, error)
+        except Exception as e:
+            logger.error(f"Failed to save rejected usage record, dropped: {e}")
+    
+    @staticmethod
+    def _mark_unavailable(error: Exception):
+        """数据库写入失败：推迟重放"""
+        UsageWriter._last_error = str(error)
+        UsageWriter._replay_after = time.monotonic() + REPLAY_RETRY_SECONDS
+    
+    @staticmethod
+    async def _store(records: List[dict]) -> bool:
+        """写入数据库，数据库不可用时未写入的记录溢出到本地文件；返回数据库是否可用"""
+        written, remaining = await UsageWriter._write_batch(records)
+        UsageWriter._written += written
+        if not remaining:
+            UsageWriter._last_error = None
+            return True
+        logger.error(
+            f"Failed to write {len(remaining)} usage records, spilling to {settings.USAGE_SPILL_PATH}: "
+            f"{UsageWriter._last_error}"
+        )
+        try:
+            await asyncio.to_thread(UsageWriter._spill, remaining)
+            UsageWriter._spilled += len(remaining)
+        except Exception as e:
+            logger.error(f"Failed to spill {len(remaining)} usage records, dropped: {e}")
+        return False
+    
+    @staticmethod
+    def _lock_spill():
+        """获取重放文件锁（多个worker共用溢出文件，同一时刻只有一个重放）；已被占用时返回None"""
+        path = f"{settings.USAGE_SPILL_PATH}.lock"
+        f = open(path, "w")
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            f.close()
+            return None
+        return f
+    
+    @staticmethod
+    async def _replay():
+        """重放溢出文件（数据库恢复后）"""
+        try:
+            lock = await asyncio.to_thread(UsageWriter._lock_spill)
+        except Exception as e:
+            logger.error(f"Failed to lock spilled usage records: {e}")
+            return
+        if lock is None:
+            return
+        try:
+            await UsageWriter._replay_locked()
+        finally:
+            lock.close()
+    
+    @staticmethod
+    async def _replay_locked():
+        """重放溢出文件（持有文件锁）"""
+        try:
+            records = await asyncio.to_thread(UsageWriter._take_spill)
+        except Exception as e:
+            logger.error(f"Failed to read spilled usage records: {e}")
+            return
+        batch_size = settings.USAGE_FLUSH_BATCH_SIZE
+        for i in range(0, len(records), batch_size):
+            batch = records[i:i + batch_size]
+            written, remaining = await UsageWriter._write_batch(batch)
+            UsageWriter._replayed += written
+            if remaining:
+                # 只保留未写入的记录，下次继续重放
+                logger.error(f"Failed to replay spilled usage records: {UsageWriter._last_error}")
+                unwritten = remaining + records[i + batch_size:]
+                if len(unwritten) < len(records):
+                    await asyncio.to_thread(UsageWriter._rewrite_replay, unwritten)
+                return
+        await asyncio.to_thread(UsageWriter._finish_replay)
+        UsageWriter._last_error = None
+        if records:
+            logger.info(f"Replayed {len(records)} spilled usage records")
+    
+    @staticmethod
+    def _rewrite_replay(records: List[dict]):
+        """重放中断时只保留未写入的记录"""
+        replaying = f"{settings.USAGE_SPILL_PATH}.replaying"
+        tmp = f"{replaying}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            UsageWriter._dump(f, records)
+        os.replace(tmp, replaying)
+    
+    @staticmethod
+    async def flush():
+        """写出缓冲区中的全部记录"""
+        if UsageWriter._lock is None:
+            UsageWriter._lock = asyncio.Lock()
+        async with UsageWriter._lock:
+            batch_size = settings.USAGE_FLUSH_BATCH_SIZE
+            healthy = True
+            while UsageWriter._buffer:
+                batch = UsageWriter._buffer[:batch_size]
+                del UsageWriter._buffer[:batch_size]
+                if healthy:
+                    healthy = await UsageWriter._store(batch)
+                else:
+                    # 本轮数据库已失败，剩余记录直接溢出
+                    try:
+                        await asyncio.to_thread(UsageWriter._spill, batch)
+                        UsageWriter._spilled += len(batch)
+                    except Exception as e:
+                        logger.error(f"Failed to spill {len(batch)} usage records, dropped: {e}")
+            if healthy and time.monotonic() >= UsageWriter._replay_after and UsageWriter._has_spill():
+                await UsageWriter._replay()
+    
+    @staticmethod
+    def _has_spill() -> bool:
+        """是否有待重放的溢出记录"""
+        path = settings.USAGE_SPILL_PATH
+        return os.path.exists(path) or os.path.exists(f"{path}.replaying")
+    
+    @staticmethod
+    async def _flush_loop():
+        """按间隔或条数触发写入"""
+        interval = settings.USAGE_FLUSH_INTERVAL_MS / 1000
+        while not UsageWriter._stopping:
+            try:
+                await asyncio.wait_for(UsageWriter._wakeup.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+            UsageWriter._wakeup.clear()
+            try:
+                await UsageWriter.flush()
+            except Exception as e:
+                logger.error(f"Usage flush failed: {e}")
+    
+    @staticmethod
+    def start():
+        """启动后台写入任务"""
+        if UsageWriter._flusher_task is None:
+            UsageWriter._stopping = False
+            UsageWriter._wakeup = asyncio.Event()
+            UsageWriter._flusher_task = asyncio.create_task(UsageWriter._flush_loop())
+    
+    @staticmethod
+    async def stop():
+        """停止后台任务并写出剩余记录（不取消进行中的写入，避免丢失已取出的批次）"""
+        task = UsageWriter._flusher_task
+        if task is not None:
+            UsageWriter._stopping = True
+            UsageWriter._wakeup.set()
+            await task
+            UsageWriter._flusher_task = None
+        await UsageWriter.flush()
+    
+    @staticmethod
+    def stats() -> dict:
+        """写入指标（本进程）"""
+        return {
+            "buffered": len(UsageWriter._buffer),
+            "written": UsageWriter._written,
+            "spilled": UsageWriter._spilled,
+            "replayed": UsageWriter._replayed,
+            "rejected": UsageWriter._rejected,
+            "last_error": UsageWriter._last_error
+        }
@@ -4,9 +4,13 @@
 """
 from cryptography.fernet import Fernet
 from app.config import settings
+from typing import Optional
 import base64
 import hashlib
 
+# 进程内复用的Fernet实例（密钥派生只做一次）
+_fernet: Optional[Fernet] = None
+
 
 def get_encryption_key() -> bytes:
     """从配置获取或生成加密密钥"""
@@ -19,15 +23,21 @@ def get_encryption_key() -> bytes:
     return base64.urlsafe_b64encode(key_hash)
 
 
+def get_fernet() -> Fernet:
+    """获取Fernet实例"""
+    global _fernet
+    if _fernet is None:
+        _fernet = Fernet(get_encryption_key())
+    return _fernet
+
+
 def encrypt_key(plain_key: str) -> str:
     """加密密钥"""
-    f = Fernet(get_encryption_key())
-    encrypted = f.encrypt(plain_key.encode())
+    encrypted = get_fernet().encrypt(plain_key.encode())
     return encrypted.decode()
 
 
 def decrypt_key(encrypted_key: str) -> str:
     """解密密钥"""
-    f = Fernet(get_encryption_key())
-    decrypted = f.decrypt(encrypted_key.encode())
+    decrypted = get_fernet().decrypt(encrypted_key.encode())
     return decrypted.decode()
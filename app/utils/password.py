@@ -0,0 +1,64 @@
+"""
+密码哈希工具
+bcrypt计算在独立线程池中执行（bcrypt计算期间释放GIL），并限制排队数量，
+登录洪峰不会占用处理代理请求的事件循环
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+from passlib.context import CryptContext
+from app.config import settings
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+# 密码哈希专用线程池（不与默认线程池共享，避免影响Key池刷新等任务）
+_executor: Optional[ThreadPoolExecutor] = None
+
+# 已提交（执行中+排队中）的任务数
+_pending = 0
+
+
+class PasswordHashBusyError(Exception):
+    """密码哈希任务排队已满"""
+    pass
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """获取密码哈希线程池"""
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=settings.PASSWORD_HASH_WORKERS,
+            thread_name_prefix="password-hash"
+        )
+    return _executor
+
+
+def shutdown_executor():
+    """关闭线程池"""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+async def _run(func, *args):
+    """在线程池中执行，超过排队上限时抛出 PasswordHashBusyError"""
+    global _pending
+    if _pending >= settings.PASSWORD_HASH_WORKERS + settings.PASSWORD_HASH_QUEUE_SIZE:
+        raise PasswordHashBusyError()
+    _pending += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(get_executor(), func, *args)
+    finally:
+        _pending -= 1
+
+
+async def verify_password(plain_password: str, hashed_password: str) -> bool:
+    """验证密码"""
+    return await _run(pwd_context.verify, plain_password, hashed_password)
+
+
+async def get_password_hash(password: str) -> str:
+    """生成密码哈希"""
+    return await _run(pwd_context.hash, password)
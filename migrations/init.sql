@@ -14,6 +14,7 @@ CREATE TABLE IF NOT EXISTS users (
     notes TEXT,
     monthly_quota_tokens INTEGER NOT NULL DEFAULT 1000000,
     monthly_quota_amount FLOAT NOT NULL DEFAULT 10.0,
+    max_concurrency INTEGER,
     created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
     updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
 );
@@ -31,6 +32,8 @@ CREATE TABLE IF NOT EXISTS api_keys (
     allowed_models TEXT,  -- JSON 格式，如 ["gpt-3.5-turbo", "gpt-4"]
     rate_limit_rpm INTEGER,
     rate_limit_tpm INTEGER,
+    max_concurrency INTEGER,
+    hedge_requests BOOLEAN NOT NULL DEFAULT FALSE,
     created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
     updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
 );
@@ -62,8 +65,9 @@ CREATE TABLE IF NOT EXISTS upstream_keys (
 CREATE INDEX idx_upstream_keys_type_status ON upstream_keys(upstream_type, status);
 
 -- ==================== 请求记录表 ====================
+-- 按 created_at 月度分区（UTC），分区由服务启动时及之后定期自动创建，超过保留期的分区归档后删除
 CREATE TABLE IF NOT EXISTS usage_records (
-    id SERIAL PRIMARY KEY,
+    id BIGSERIAL,
     user_id INTEGER NOT NULL REFERENCES users(id),
     api_key_id INTEGER REFERENCES api_keys(id),
     upstream_key_id INTEGER REFERENCES upstream_keys(id),
@@ -78,17 +82,14 @@ CREATE TABLE IF NOT EXISTS usage_records (
     user_agent VARCHAR(500),
     error_type VARCHAR(100),
     error_message TEXT,
-    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
-    updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
-);
+    created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
 
-CREATE INDEX idx_usage_records_user_id ON usage_records(user_id);
 CREATE INDEX idx_usage_records_api_key_id ON usage_records(api_key_id);
-CREATE INDEX idx_usage_records_upstream_key_id ON usage_records(upstream_key_id);
-CREATE INDEX idx_usage_records_model ON usage_records(model);
-CREATE INDEX idx_usage_records_client_ip ON usage_records(client_ip);
 CREATE INDEX idx_usage_records_user_date ON usage_records(user_id, created_at);
-CREATE INDEX idx_usage_records_date ON usage_records(created_at);
+CREATE INDEX idx_usage_records_date ON usage_records USING brin (created_at);
 
 -- ==================== 每日用量聚合表 ====================
 CREATE TABLE IF NOT EXISTS usage_daily (
@@ -145,9 +146,6 @@ CREATE TRIGGER update_api_keys_updated_at BEFORE UPDATE ON api_keys
 CREATE TRIGGER update_upstream_keys_updated_at BEFORE UPDATE ON upstream_keys
     FOR EACH ROW EXECUTE FUNCTION update_updated_at_column();
 
-CREATE TRIGGER update_usage_records_updated_at BEFORE UPDATE ON usage_records
-    FOR EACH ROW EXECUTE FUNCTION update_updated_at_column();
-
 CREATE TRIGGER update_usage_daily_updated_at BEFORE UPDATE ON usage_daily
     FOR EACH ROW EXECUTE FUNCTION update_updated_at_column();
 
@@ -0,0 +1,39 @@
+"""
+添加hedge_requests字段到api_keys表（如果不存在）
+"""
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from sqlalchemy import text
+from app.models.base import engine
+from app.utils.logger import logger
+
+def add_hedge_requests_field():
+    """添加hedge_requests字段"""
+    try:
+        with engine.connect() as conn:
+            # 检查字段是否已存在
+            result = conn.execute(text("""
+                SELECT column_name 
+                FROM information_schema.columns 
+                WHERE table_name='api_keys' AND column_name='hedge_requests'
+            """))
+            
+            if result.fetchone():
+                logger.info("hedge_requests field already exists")
+                return
+            
+            # 添加字段
+            conn.execute(text("""
+                ALTER TABLE api_keys 
+                ADD COLUMN hedge_requests BOOLEAN NOT NULL DEFAULT FALSE
+            """))
+            conn.commit()
+            logger.info("hedge_requests field added successfully")
+    except Exception as e:
+        logger.error(f"Failed to add hedge_requests field: {e}")
+        raise
+
+if __name__ == "__main__":
+    add_hedge_requests_field()
@@ -0,0 +1,40 @@
+"""
+添加max_concurrency字段到users和api_keys表（如果不存在）
+"""
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from sqlalchemy import text
+from app.models.base import engine
+from app.utils.logger import logger
+
+def add_max_concurrency_field():
+    """添加max_concurrency字段"""
+    try:
+        with engine.connect() as conn:
+            for table in ("users", "api_keys"):
+                # 检查字段是否已存在
+                result = conn.execute(text("""
+                    SELECT column_name
+                    FROM information_schema.columns
+                    WHERE table_name=:table AND column_name='max_concurrency'
+                """), {"table": table})
+                
+                if result.fetchone():
+                    logger.info(f"{table}.max_concurrency field already exists")
+                    continue
+                
+                # 添加字段
+                conn.execute(text(f"""
+                    ALTER TABLE {table}
+                    ADD COLUMN max_concurrency INTEGER
+                """))
+                logger.info(f"{table}.max_concurrency field added successfully")
+            conn.commit()
+    except Exception as e:
+        logger.error(f"Failed to add max_concurrency field: {e}")
+        raise
+
+if __name__ == "__main__":
+    add_max_concurrency_field()
@@ -9,6 +9,7 @@ from sqlalchemy.orm import Session
 from app.models.base import SessionLocal
 from app.models.upstream import UpstreamKey, UpstreamKeyStatus
 from app.utils.encryption import encrypt_key
+from app.services.cache_bus import CacheBus, ENTITY_UPSTREAM_KEY
 from app.config import settings
 from app.utils.logger import logger
 
@@ -73,6 +74,9 @@ def init_upstream_keys():
         db.commit()
         logger.info("Upstream keys initialized successfully!")
         
+        # 通知运行中的服务刷新Key池
+        CacheBus.publish_sync(ENTITY_UPSTREAM_KEY)
+        
     except Exception as e:
         logger.error(f"Failed to init upstream keys: {e}")
         db.rollback()
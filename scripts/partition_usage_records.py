@@ -0,0 +1,87 @@
+"""
+将usage_records迁移为按月分区表（如果尚未分区）
+原表改名为usage_records_legacy，为其数据覆盖的每个月份建分区并复制数据后删除；整个迁移在一个事务中执行。
+迁移期间请停止API服务（写入的用量记录会溢出到本地文件，服务恢复后自动重放）
+"""
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from datetime import datetime, timezone
+from sqlalchemy import text
+from app.models.base import engine
+from app.models.usage import UsageRecord
+from app.services.usage_partitions import PARENT_TABLE, UsagePartitionManager, add_months
+from app.utils.logger import logger
+
+LEGACY_TABLE = f"{PARENT_TABLE}_legacy"
+
+
+def partition_usage_records():
+    """迁移usage_records为分区表"""
+    try:
+        with engine.begin() as conn:
+            if conn.execute(text("SELECT to_regclass(:name)"), {"name": PARENT_TABLE}).scalar() is None:
+                # 表不存在：直接按模型创建分区表
+                UsageRecord.__table__.create(conn)
+                UsagePartitionManager.ensure_partitions(conn)
+                logger.info(f"{PARENT_TABLE} created as a partitioned table")
+                return
+            
+            if UsagePartitionManager.is_partitioned(conn):
+                logger.info(f"{PARENT_TABLE} is already partitioned")
+                return
+            
+            # 原表及其约束、索引、序列改名，释放名称给新表
+            conn.execute(text(f"ALTER TABLE {PARENT_TABLE} RENAME TO {LEGACY_TABLE}"))
+            constraints = conn.execute(text("""
+                SELECT conname FROM pg_constraint
+                WHERE conrelid = to_regclass(:table) AND contype IN ('p', 'f', 'u', 'c')
+            """), {"table": LEGACY_TABLE}).scalars().all()
+            for name in constraints:
+                conn.execute(text(f'ALTER TABLE {LEGACY_TABLE} RENAME CONSTRAINT "{name}" TO "legacy_{name}"'))
+            indexes = conn.execute(text("""
+                SELECT indexname FROM pg_indexes
+                WHERE tablename = :table AND schemaname = current_schema()
+            """), {"table": LEGACY_TABLE}).scalars().all()
+            for name in indexes:
+                conn.execute(text(f'ALTER INDEX "{name}" RENAME TO "legacy_{name}"'))
+            sequence = conn.execute(text("SELECT pg_get_serial_sequence(:table, 'id')"), {"table": LEGACY_TABLE}).scalar()
+            if sequence:
+                conn.execute(text(f"ALTER SEQUENCE {sequence} RENAME TO {LEGACY_TABLE}_id_seq"))
+            
+            # 创建分区表，覆盖原表数据的全部月份
+            UsageRecord.__table__.create(conn)
+            oldest = conn.execute(text(
+                f"SELECT min(COALESCE(created_at, updated_at, now())) FROM {LEGACY_TABLE}"
+            )).scalar()
+            now = datetime.now(timezone.utc)
+            UsagePartitionManager.ensure_partitions(conn, now)
+            if oldest is not None:
+                oldest = oldest.astimezone(timezone.utc)
+                year, month = oldest.year, oldest.month
+                while (year, month) < (now.year, now.month):
+                    UsagePartitionManager.create_partition(conn, year, month)
+                    year, month = add_months(year, month, 1)
+            
+            # 复制数据（created_at为空的旧记录按updated_at归入分区）
+            columns = ", ".join(column.name for column in UsageRecord.__table__.columns if column.name != "created_at")
+            copied = conn.execute(text(f"""
+                INSERT INTO {PARENT_TABLE} ({columns}, created_at)
+                SELECT {columns}, COALESCE(created_at, updated_at, now()) FROM {LEGACY_TABLE}
+            """)).rowcount
+            conn.execute(text(
+                f"SELECT setval(pg_get_serial_sequence('{PARENT_TABLE}', 'id'), "
+                f"COALESCE((SELECT max(id) FROM {PARENT_TABLE}), 0) + 1, false)"
+            ))
+            conn.execute(text(f"DROP TABLE {LEGACY_TABLE}"))
+            logger.info(f"{PARENT_TABLE} partitioned successfully, {copied} records copied")
+    except Exception as e:
+        logger.error(f"Failed to partition {PARENT_TABLE}: {e}")
+        raise
+    
+    # 归档超过保留期的分区
+    UsagePartitionManager.run_maintenance()
+
+if __name__ == "__main__":
+    partition_usage_records()
@@ -0,0 +1,28 @@
+"""
+测试公共配置
+"""
+import os
+import pytest
+
+# 测试环境不写日志文件
+os.environ.setdefault("LOG_FILE_PATH", "")
+
+
+@pytest.fixture
+def fake_redis(monkeypatch):
+    """用 fakeredis（含Lua）替换共享的异步Redis客户端，并清除已注册的脚本"""
+    import fakeredis
+    from app.services import circuit_breaker, concurrency_limiter, quota_counter, rate_limiter
+    
+    client = fakeredis.FakeAsyncRedis(decode_responses=True)
+    monkeypatch.setattr(rate_limiter, "async_redis_client", client)
+    monkeypatch.setattr(rate_limiter.RedisHealth, "_available", True)
+    for cls, names in (
+        (rate_limiter.RateLimiter, ("_script", "_settle_script", "_adjust_script")),
+        (circuit_breaker.CircuitBreaker, ("_script",)),
+        (concurrency_limiter.ConcurrencyLimiter, ("_script",)),
+    ):
+        for name in names:
+            monkeypatch.setattr(cls, name, None)
+    monkeypatch.setattr(quota_counter.QuotaCounter, "_scripts", {})
+    return client
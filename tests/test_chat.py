@@ -0,0 +1,126 @@
+"""
+Chat Completions 处理流程测试（上游、用量记录和密钥状态用桩替换）
+"""
+import asyncio
+import pytest
+from app.api import chat
+from app.services.rate_limiter import TokenReservation
+
+
+class UpstreamKey:
+    id = 1
+
+
+class Attempt:
+    upstream_key = UpstreamKey()
+
+
+class Reservation(TokenReservation):
+    """记录结算值的预占"""
+    
+    def __init__(self, estimated_tokens: int):
+        super().__init__("k", estimated_tokens)
+        self.settled_with = []
+    
+    async def settle(self, actual_tokens: int):
+        if not self.settled:
+            self.settled_with.append(actual_tokens)
+        self.settled = True
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    """替换用量记录和上游密钥状态，返回调用记录"""
+    calls = {"usage": [], "failure": [], "success": []}
+    
+    async def record_usage(**kwargs):
+        calls["usage"].append(kwargs)
+    
+    async def record_failure(key_id, error_type, retry_after=None):
+        calls["failure"].append(error_type)
+    
+    async def record_success(key_id, tokens):
+        calls["success"].append(tokens)
+    
+    monkeypatch.setattr(chat.UsageTracker, "record_usage", staticmethod(record_usage))
+    monkeypatch.setattr(chat.KeyPoolService, "record_failure", staticmethod(record_failure))
+    monkeypatch.setattr(chat.KeyPoolService, "record_success", staticmethod(record_success))
+    return calls
+
+
+def _upstream_result(monkeypatch, event: dict):
+    async def collect_upstream_result(attempt, request_data, start_time):
+        return event
+    monkeypatch.setattr(chat, "collect_upstream_result", collect_upstream_result)
+
+
+def test_non_streaming_without_usage_settles_local_count(monkeypatch, calls):
+    """上游未返回usage时按prompt估算值和输出文本的本地计数结算，不保留预估值"""
+    _upstream_result(monkeypatch, {
+        "type": "complete",
+        "data": {"choices": [{"message": {"role": "assistant", "content": "hello world"}}]}
+    })
+    reservation = Reservation(1000)
+    result = asyncio.run(chat.handle_non_streaming(
+        Attempt(), {}, 1, 1, "gpt-4o", None, None, None, 0.0, reservation, 12
+    ))
+    assert result["choices"][0]["message"]["content"] == "hello world"
+    usage = calls["usage"][0]
+    assert usage["prompt_tokens"] == 12
+    assert usage["completion_tokens"] > 0
+    assert reservation.settled_with == [usage["total_tokens"]]
+    assert calls["success"] == [usage["total_tokens"]]
+
+
+def _stream_events(monkeypatch, *events):
+    async def iter_upstream_events(attempt, request_data, start_time, **kwargs):
+        for event in events:
+            yield event
+    monkeypatch.setattr(chat, "iter_upstream_events", iter_upstream_events)
+
+
+class Permit:
+    released = False
+    
+    async def release(self):
+        self.released = True
+
+
+def _run_stream(reservation: Reservation) -> list:
+    async def run():
+        return [chunk async for chunk in chat.stream_chat_completions(
+            Attempt(), {}, 1, 1, "gpt-4o", None, None, None, 0.0, reservation, Permit(), 12
+        )]
+    return asyncio.run(run())
+
+
+@pytest.mark.parametrize("status_code, counted", [(400, False), (429, True), (503, True)])
+def test_stream_error_only_counts_retryable_failures(monkeypatch, calls, status_code, counted):
+    """请求本身的错误（4xx）不计入上游密钥失败，避免客户端的无效请求触发熔断"""
+    _stream_events(monkeypatch, {"type": "error", "status_code": status_code, "error": "bad"})
+    reservation = Reservation(1000)
+    _run_stream(reservation)
+    assert calls["failure"] == (["upstream_error"] if counted else [])
+    assert calls["usage"][0]["response_status"] == status_code
+    assert reservation.settled_with == [0]
+
+
+def test_stream_reads_and_strips_injected_usage(monkeypatch, calls):
+    """解析模式：usage为null的事件正常转发，网关注入的usage事件读取后不转发"""
+    _stream_events(
+        monkeypatch,
+        {"type": "data", "data": {"choices": [{"delta": {"content": "Hi"}}], "usage": None}},
+        {"type": "data", "data": {"choices": [], "usage": {"prompt_tokens": 5, "completion_tokens": 1, "total_tokens": 6}}},
+        {"type": "done"},
+    )
+    reservation = Reservation(1000)
+    
+    async def run():
+        return [chunk async for chunk in chat.stream_chat_completions(
+            Attempt(), {}, 1, 1, "gpt-4o", None, None, None, 0.0, reservation, Permit(), 12, True
+        )]
+    chunks = asyncio.run(run())
+    assert len(chunks) == 2 and '"Hi"' in chunks[0] and chunks[1] == "data: [DONE]\n\n"
+    assert calls["usage"][0]["total_tokens"] == 6
+    assert reservation.settled_with == [6]
+    assert calls["success"] == [6]
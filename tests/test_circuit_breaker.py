@@ -0,0 +1,80 @@
+"""
+熔断器测试（fakeredis执行Lua脚本）
+"""
+import asyncio
+import time
+import pytest
+from app.config import settings
+from app.services.circuit_breaker import CircuitBreaker
+
+
+@pytest.fixture
+def clock(monkeypatch, fake_redis):
+    monkeypatch.setattr(settings, "CIRCUIT_BREAKER_FAILURE_THRESHOLD", 2)
+    monkeypatch.setattr(settings, "CIRCUIT_BREAKER_COOLDOWN_SECONDS", 10)
+    monkeypatch.setattr(settings, "CIRCUIT_BREAKER_RECOVERY_THRESHOLD", 3)
+    monkeypatch.setattr(settings, "CIRCUIT_BREAKER_HALF_OPEN_MAX_REQUESTS", 2)
+    now = [1000.0]
+    monkeypatch.setattr(time, "time", lambda: now[0])
+    return now
+
+
+async def _state(fake_redis):
+    return await fake_redis.hget(CircuitBreaker._get_key(1), "state")
+
+
+async def _open(clock):
+    for _ in range(2):
+        await CircuitBreaker.record_failure(1)
+    assert not await CircuitBreaker.allow_request(1)
+    clock[0] += 10
+
+
+def test_half_open_admits_limited_probes_per_window(clock, fake_redis):
+    """half_open每个探测窗口只放行有限的探测请求，窗口超时后重新放行"""
+    async def run():
+        await _open(clock)
+        assert await CircuitBreaker.allow_request(1)
+        assert await _state(fake_redis) == "half_open"
+        assert await CircuitBreaker.allow_request(1)
+        assert not await CircuitBreaker.allow_request(1)
+
+        clock[0] += 10
+        assert await CircuitBreaker.allow_request(1)
+        assert await fake_redis.hget(CircuitBreaker._get_key(1), "probes") == "1"
+    asyncio.run(run())
+
+
+def test_successes_accumulate_across_probe_windows(clock, fake_redis):
+    """恢复阈值大于单个窗口的探测数时，成功数跨窗口累计后关闭熔断"""
+    async def run():
+        await _open(clock)
+        for _ in range(2):
+            assert await CircuitBreaker.allow_request(1)
+            await CircuitBreaker.record_success(1)
+        assert not await CircuitBreaker.allow_request(1)
+        assert await _state(fake_redis) == "half_open"
+
+        clock[0] += 10
+        assert await CircuitBreaker.allow_request(1)
+        await CircuitBreaker.record_success(1)
+        assert await _state(fake_redis) is None
+        assert await CircuitBreaker.allow_request(1)
+    asyncio.run(run())
+
+
+def test_probe_failure_reopens(clock, fake_redis):
+    """任一探测失败即重新打开熔断，并清零已累计的成功数"""
+    async def run():
+        await _open(clock)
+        assert await CircuitBreaker.allow_request(1)
+        await CircuitBreaker.record_success(1)
+        assert await CircuitBreaker.allow_request(1)
+        await CircuitBreaker.record_failure(1)
+        assert await _state(fake_redis) == "open"
+        assert not await CircuitBreaker.allow_request(1)
+
+        clock[0] += 10
+        assert await CircuitBreaker.allow_request(1)
+        assert await fake_redis.hget(CircuitBreaker._get_key(1), "successes") == "0"
+    asyncio.run(run())
@@ -0,0 +1,49 @@
+"""
+并发限制测试（fakeredis执行Lua脚本）
+"""
+import asyncio
+from app.api.chat import finish_stream
+from app.services.concurrency_limiter import ConcurrencyLimiter
+from app.services.rate_limiter import RateLimiter, TokenReservation
+
+
+def test_acquire_rejects_at_limit_and_release_is_idempotent(fake_redis):
+    """超出API Key并发数时拒绝；重复释放只归还一次"""
+    async def run():
+        first, _ = await ConcurrencyLimiter.acquire(1, 1, key_limit=2, user_limit=0)
+        second, _ = await ConcurrencyLimiter.acquire(1, 1, key_limit=2, user_limit=0)
+        rejected, info = await ConcurrencyLimiter.acquire(1, 1, key_limit=2, user_limit=0)
+        assert first and second and rejected is None
+        assert info == {"scope": "key", "limit": 2, "in_flight": 2}
+        
+        await first.release()
+        await first.release()
+        assert await fake_redis.zcard(ConcurrencyLimiter._get_key("key", 1)) == 1
+        third, _ = await ConcurrencyLimiter.acquire(1, 1, key_limit=2, user_limit=0)
+        assert third is not None
+        assert await fake_redis.zcard(ConcurrencyLimiter._get_key("key", 1)) == 2
+        for permit in (second, third):
+            await permit.release()
+    asyncio.run(run())
+
+
+def test_finish_stream_cancels_when_generator_never_ran(fake_redis):
+    """客户端在流开始前断开：响应的后台任务撤销预占（含RPM请求数）并释放许可"""
+    totals_key = RateLimiter._get_key("key", "k", "totals")
+    
+    async def run():
+        permit, _ = await ConcurrencyLimiter.acquire(2, 2, key_limit=1, user_limit=0)
+        reservation = TokenReservation("k", 100)
+        await RateLimiter.check_rate_limit("k", 10, 1000, 100, request_id=reservation.request_id)
+        await finish_stream(reservation, permit)
+        assert await fake_redis.hgetall(totals_key) == {"requests": "0", "tokens": "0"}
+        assert permit.released
+        assert await fake_redis.zcard(ConcurrencyLimiter._get_key("key", 2)) == 0
+        
+        # 生成器已按实际用量结算时不再生效
+        reservation = TokenReservation("k", 100)
+        await RateLimiter.check_rate_limit("k", 10, 1000, 100, request_id=reservation.request_id)
+        await reservation.settle(80)
+        await finish_stream(reservation, permit)
+        assert await fake_redis.hgetall(totals_key) == {"requests": "1", "tokens": "80"}
+    asyncio.run(run())
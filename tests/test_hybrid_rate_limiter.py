@@ -0,0 +1,94 @@
+"""
+两级限流测试（fakeredis执行Lua脚本）
+"""
+import asyncio
+import pytest
+from app.config import settings
+from app.services.rate_limiter import HybridRateLimiter, RateLimiter
+
+
+@pytest.fixture
+def hybrid(monkeypatch, fake_redis):
+    monkeypatch.setattr(settings, "RATE_LIMIT_HYBRID_ENABLED", True)
+    monkeypatch.setattr(settings, "RATE_LIMIT_HYBRID_MIN_RPM", 1)
+    monkeypatch.setattr(settings, "RATE_LIMIT_LEASE_FRACTION", 0.1)
+    monkeypatch.setattr(HybridRateLimiter, "_buckets", {})
+    monkeypatch.setattr(HybridRateLimiter, "_carried", {})
+    return fake_redis
+
+
+async def _totals(fake_redis):
+    totals = await fake_redis.hgetall(RateLimiter._get_key("key", "k", "totals"))
+    return int(totals.get("requests", 0)), int(totals.get("tokens", 0))
+
+
+async def _log_size(fake_redis):
+    return await fake_redis.zcard(RateLimiter._get_key("key", "k", "log"))
+
+
+def test_lease_settles_actual_usage(hybrid):
+    """租约内的修正只改本地用量，归还时按实际用量结算"""
+    async def run():
+        allowed, info = await HybridRateLimiter.check_rate_limit("k", 100, 10000, 100)
+        assert allowed
+        assert await _totals(hybrid) == (10, 1000)
+
+        await HybridRateLimiter.reconcile_tokens("k", "r1", 100, 40, lease=info["lease"])
+        assert await _totals(hybrid) == (10, 1000)
+
+        await HybridRateLimiter.stop()
+        assert await _totals(hybrid) == (1, 40)
+        assert HybridRateLimiter._buckets == {}
+    asyncio.run(run())
+
+
+def test_late_correction_folds_into_next_lease(hybrid):
+    """租约续租后才结束的请求不访问Redis，差额并入下一次租约结算"""
+    async def run():
+        _, info = await HybridRateLimiter.check_rate_limit("k", 100, 10000, 100)
+        old_lease = info["lease"]
+        HybridRateLimiter._buckets[("key", "k")].expires_at = 0.0
+        allowed, info = await HybridRateLimiter.check_rate_limit("k", 100, 10000, 100)
+        assert allowed and info["lease"] != old_lease
+        log_size = await _log_size(hybrid)
+
+        await HybridRateLimiter.reconcile_tokens("k", "r1", 100, 30, lease=old_lease)
+        assert await _log_size(hybrid) == log_size
+        assert HybridRateLimiter._carried == {("key", "k"): -70}
+
+        await HybridRateLimiter.stop()
+        assert await _totals(hybrid) == (2, 130)
+        assert HybridRateLimiter._carried == {}
+    asyncio.run(run())
+
+
+def test_expired_lease_flushes_carried_correction(hybrid):
+    """租约归还后才结束的请求，差额在下一次回收时批量写入"""
+    async def run():
+        _, info = await HybridRateLimiter.check_rate_limit("k", 100, 10000, 100)
+        HybridRateLimiter._buckets[("key", "k")].expires_at = 0.0
+        await HybridRateLimiter._release_expired()
+        assert await _totals(hybrid) == (1, 100)
+
+        await HybridRateLimiter.reconcile_tokens("k", "r1", 100, 250, lease=info["lease"])
+        await HybridRateLimiter.reconcile_tokens("k", "r2", 100, 90, lease=info["lease"])
+        assert await _totals(hybrid) == (1, 100)
+
+        await HybridRateLimiter._release_expired()
+        assert await _totals(hybrid) == (1, 240)
+        assert await _log_size(hybrid) == 2
+        assert HybridRateLimiter._carried == {}
+    asyncio.run(run())
+
+
+def test_cancel_returns_request_to_current_lease(hybrid):
+    """请求未发往上游即撤销时，请求数和token都归还到当前租约"""
+    async def run():
+        _, info = await HybridRateLimiter.check_rate_limit("k", 100, 10000, 100)
+        await HybridRateLimiter.reconcile_tokens("k", "r1", 100, 0, lease=info["lease"], used_requests=0)
+        bucket = HybridRateLimiter._buckets[("key", "k")]
+        assert (bucket.used_requests, bucket.used_tokens) == (0, 0)
+
+        await HybridRateLimiter.stop()
+        assert await _totals(hybrid) == (0, 0)
+    asyncio.run(run())
@@ -0,0 +1,62 @@
+"""
+月度配额计数测试（fakeredis执行Lua脚本）
+"""
+import asyncio
+import contextlib
+from types import SimpleNamespace
+import pytest
+from app.services.quota_counter import QuotaCounter
+from app.services.usage_tracker import UsageTracker
+
+
+@pytest.fixture
+def monthly_usage(monkeypatch, fake_redis):
+    """usage_monthly中的当月用量（初始化计数器时读取）"""
+    usage = {"total_tokens": 0}
+
+    async def get_monthly_usage(db, user_id, year, month):
+        return SimpleNamespace(total_tokens=usage["total_tokens"])
+
+    monkeypatch.setattr(UsageTracker, "get_monthly_usage", staticmethod(get_monthly_usage))
+    monkeypatch.setattr("app.models.base.AsyncSessionLocal", contextlib.nullcontext)
+    return usage
+
+
+USER = SimpleNamespace(id=1, monthly_quota_tokens=1000)
+
+
+async def _used(fake_redis, reservation):
+    return int(await fake_redis.hget(reservation.key, "used"))
+
+
+def test_reserve_and_settle_same_generation(monthly_usage, fake_redis):
+    """同一代次内按差额结算；超出配额时拒绝且不占用"""
+    monthly_usage["total_tokens"] = 300
+
+    async def run():
+        first, error = await QuotaCounter.reserve(USER, 400)
+        assert error is None and await _used(fake_redis, first) == 700
+        rejected, error = await QuotaCounter.reserve(USER, 400)
+        assert rejected is None and error == "Monthly quota exceeded. Used: 700/1000"
+
+        await first.settle(150)
+        await first.settle(400)
+        assert await _used(fake_redis, first) == 450
+    asyncio.run(run())
+
+
+def test_settle_after_reseed_counts_only_actual(monthly_usage, fake_redis):
+    """计数器过期后重新初始化（新代次不含之前的预占），旧预占只计入实际用量"""
+    async def run():
+        stale, _ = await QuotaCounter.reserve(USER, 400)
+        await fake_redis.delete(stale.key)
+        monthly_usage["total_tokens"] = 100
+        fresh, _ = await QuotaCounter.reserve(USER, 200)
+        assert fresh.generation != stale.generation
+        assert await _used(fake_redis, fresh) == 300
+
+        await stale.settle(50)
+        assert await _used(fake_redis, fresh) == 350
+        await fresh.settle(0)
+        assert await _used(fake_redis, fresh) == 150
+    asyncio.run(run())
@@ -0,0 +1,107 @@
+"""
+限流器测试（fakeredis执行Lua脚本）
+"""
+import asyncio
+import time
+import redis
+from app.services.rate_limiter import LocalRateLimiter, RateLimiter, RedisHealth, TokenReservation
+
+
+async def _fill_log(fake_redis, count: int, age_ms: int):
+    """在窗口中写入count条各占1个请求、1个token的记录，最早一条距今age_ms毫秒"""
+    now_ms = int(time.time() * 1000)
+    await fake_redis.zadd(
+        RateLimiter._get_key("key", "k", "log"),
+        {f"r{i}:1:1": now_ms - age_ms + i for i in range(count)}
+    )
+    await fake_redis.hset(RateLimiter._get_key("key", "k", "totals"), mapping={"requests": count, "tokens": count})
+
+
+def test_admits_until_limit_then_rejects(fake_redis):
+    """RPM和TPM一起计数，超出时拒绝且不占用额度"""
+    async def run():
+        for _ in range(3):
+            allowed, _ = await RateLimiter.check_rate_limit("k", 3, 1000, 100)
+            assert allowed
+        allowed, info = await RateLimiter.check_rate_limit("k", 3, 1000, 100)
+        assert not allowed
+        assert (info["current_requests"], info["current_tokens"]) == (3, 300)
+
+        allowed, info = await RateLimiter.check_rate_limit("k", 10, 350, 100)
+        assert not allowed
+        assert (info["current_requests"], info["current_tokens"]) == (3, 300)
+    asyncio.run(run())
+
+
+def test_settle_zero_keeps_request_cancel_refunds_it(fake_redis):
+    """settle(0)只归还token（请求已发往上游，仍计入RPM），cancel()连同请求数一起归还"""
+    totals_key = RateLimiter._get_key("key", "k", "totals")
+
+    async def run():
+        failed = TokenReservation("k", 100)
+        rejected = TokenReservation("k", 100)
+        for reservation in (failed, rejected):
+            allowed, _ = await RateLimiter.check_rate_limit("k", 10, 1000, 100, request_id=reservation.request_id)
+            assert allowed
+        await failed.settle(0)
+        await rejected.cancel()
+        await rejected.settle(100)
+        assert await fake_redis.hgetall(totals_key) == {"requests": "1", "tokens": "0"}
+    asyncio.run(run())
+
+
+def test_local_limiter_cancel_removes_record(monkeypatch):
+    """Redis不可用时，撤销的请求从进程内窗口移除"""
+    monkeypatch.setattr(LocalRateLimiter, "_windows", {})
+    LocalRateLimiter.check_rate_limit("k", 100, 10000, 50, request_id="r1")
+    LocalRateLimiter.reconcile_tokens("k", "r1", 0, used_requests=0)
+    window = LocalRateLimiter._windows[("key", "k")]
+    assert (window.requests, window.tokens, len(window.records)) == (0, 0, 0)
+
+
+def test_rejection_wait_until_oldest_records_expire(fake_redis):
+    """拒绝时的等待时间为需要移出的最早记录离开窗口的时间"""
+    async def run():
+        await _fill_log(fake_redis, 100, age_ms=59000)
+        allowed, info = await RateLimiter.check_rate_limit("k", 100, 10000, 1)
+        assert not allowed
+        assert info["reset_time"] == 1
+    asyncio.run(run())
+
+
+def test_rejection_wait_scan_is_capped(fake_redis):
+    """需要移出的记录超过扫描上限时按整个窗口返回，不遍历整个窗口"""
+    async def run():
+        await _fill_log(fake_redis, 100, age_ms=59000)
+        allowed, info = await RateLimiter.check_rate_limit("k", 30, 10000, 1)
+        assert not allowed
+        assert info["reset_time"] == 60
+    asyncio.run(run())
+
+
+def test_pool_exhaustion_is_not_an_outage(monkeypatch):
+    """连接池用尽不切换到进程内限流，连接失败才切换"""
+    monkeypatch.setattr(RedisHealth, "_available", True)
+    monkeypatch.setattr(RedisHealth, "_probe_task", None)
+    RedisHealth.record_error(redis.exceptions.ConnectionError("No connection available."))
+    assert RedisHealth.is_available()
+
+    async def run():
+        RedisHealth.record_error(redis.exceptions.ConnectionError("Connection refused"))
+        assert not RedisHealth.is_available()
+        await RedisHealth.stop()
+    asyncio.run(run())
+
+
+def test_local_limiter_prunes_idle_windows(monkeypatch):
+    """Redis不可用期间，空闲标识的进程内窗口会被清理"""
+    monkeypatch.setattr(LocalRateLimiter, "_windows", {})
+    monkeypatch.setattr(LocalRateLimiter, "_pruned_at", 0.0)
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now - 120)
+    for i in range(10):
+        LocalRateLimiter.check_rate_limit(f"k{i}", 100, 10000, 1)
+    monkeypatch.setattr(time, "time", lambda: now)
+    allowed, info = LocalRateLimiter.check_rate_limit("active", 100, 10000, 1)
+    assert allowed and info["degraded"]
+    assert list(LocalRateLimiter._windows) == [("key", "active")]
@@ -0,0 +1,36 @@
+"""
+Token计数测试
+"""
+import sys
+import types
+import pytest
+from app.config import settings
+from app.services.token_counter import TokenCounter
+
+
+@pytest.fixture
+def fake_tiktoken(monkeypatch):
+    """替换tiktoken，记录加载了哪些编码"""
+    loaded = []
+    module = types.ModuleType("tiktoken")
+    module.get_encoding = lambda name: loaded.append(name) or object()
+    monkeypatch.setitem(sys.modules, "tiktoken", module)
+    monkeypatch.setattr(TokenCounter, "_encodings", {})
+    monkeypatch.delenv("TIKTOKEN_CACHE_DIR", raising=False)
+    return loaded
+
+
+def test_load_without_vocab_dir_never_downloads(monkeypatch, fake_tiktoken):
+    """未配置本地词表目录时不调用tiktoken（否则会联网下载），按字符估算"""
+    monkeypatch.setattr(settings, "TOKENIZER_VOCAB_DIR", "")
+    TokenCounter.load()
+    assert fake_tiktoken == []
+    assert TokenCounter.count_completion("abcdefgh", "gpt-4o") == 2
+
+
+def test_load_skips_missing_vocab_files(monkeypatch, tmp_path, fake_tiktoken):
+    """只加载目录中存在的词表，缺失的编码按字符估算"""
+    monkeypatch.setattr(settings, "TOKENIZER_VOCAB_DIR", str(tmp_path))
+    open(TokenCounter.vocab_path("cl100k_base"), "wb").close()
+    TokenCounter.load()
+    assert fake_tiktoken == ["cl100k_base"]
@@ -0,0 +1,89 @@
+"""
+上游客户端测试
+"""
+import asyncio
+import httpx
+from app.services.upstream_client import StreamCompletionAccumulator, UpstreamClient
+
+
+async def _stream_body(*chunks: bytes):
+    for chunk in chunks:
+        yield chunk
+
+
+def _collect_events(handler, **kwargs) -> list:
+    """用 MockTransport 调用上游并收集全部事件"""
+    async def run():
+        client = UpstreamClient("https://upstream.test/v1", "sk-test")
+        client.client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        try:
+            return [event async for event in client.chat_completions("gpt-4o", [], **kwargs)]
+        finally:
+            await client.client.aclose()
+    return asyncio.run(run())
+
+
+def test_streamed_error_body_yields_error_event():
+    """流式返回的429错误体在流关闭前读取，产生error事件（而不是抛出StreamClosed）"""
+    def handler(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(
+            429,
+            headers={"retry-after": "7"},
+            content=_stream_body(b'{"error": {"message": ', b'"rate limited"}}')
+        )
+    
+    for kwargs in ({"stream": True}, {"stream": True, "passthrough": True}, {"stream": False}):
+        events = _collect_events(handler, **kwargs)
+        assert events == [{
+            "type": "error",
+            "status_code": 429,
+            "error": '{"error": {"message": "rate limited"}}',
+            "retry_after": 7.0
+        }]
+
+
+def test_streamed_server_error_is_retryable():
+    """5xx错误同样产生带状态码的error事件"""
+    def handler(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(503, content=_stream_body(b"upstream ", b"unavailable"))
+    
+    events = _collect_events(handler, stream=True)
+    assert len(events) == 1
+    assert events[0]["type"] == "error"
+    assert events[0]["status_code"] == 503
+    assert events[0]["error"] == "upstream unavailable"
+
+
+def test_completion_accumulator_parses_passthrough_bytes():
+    """透传字节在事件中间断开时仍能还原输出文本（用于上游缺少usage时本地计数）"""
+    accumulator = StreamCompletionAccumulator()
+    accumulator.feed_raw(b'data: {"choices": [{"delta": {"role": "assistant", "content": "Hel')
+    accumulator.feed_raw(b'lo"}}]}\n\ndata: {"choices": [{"delta": {"content": ", \\u4e16\\u754c"}}]}\r\n\n')
+    accumulator.feed_raw(b'data: {"choices": [{"delta": {}, "finish_reason": "stop"}]}\n\ndata: [DONE]\n\n')
+    assert accumulator.text() == "Hello, 世界"
+    
+    accumulator = StreamCompletionAccumulator()
+    accumulator.feed_event({"choices": [{"delta": {"content": "Hi"}}]})
+    accumulator.feed_event({"choices": [], "usage": {"total_tokens": 3}})
+    assert accumulator.text() == "Hi"
+
+
+def test_passthrough_strips_injected_usage_event():
+    """网关注入的usage事件读取后不转发，其余字节原样透传"""
+    usage_event = b'data: {"id": "c", "choices": [], "usage": {"prompt_tokens": 5, "completion_tokens": 2, "total_tokens": 7}}\n\n'
+    chunks = (
+        b'data: {"id": "c", "choices": [{"delta": {"content": "Hi"}}], "usage": null}\n\n',
+        usage_event[:40],
+        usage_event[40:] + b"data: [DONE]\n\n",
+    )
+    
+    def handler(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(200, content=_stream_body(*chunks))
+    
+    events = _collect_events(handler, stream=True, passthrough=True, strip_usage=True)
+    forwarded = b"".join(event["data"] for event in events if event["type"] == "raw")
+    assert forwarded == chunks[0] + b"data: [DONE]\n\n"
+    assert events[-1] == {"type": "end", "usage": {"prompt_tokens": 5, "completion_tokens": 2, "total_tokens": 7}}
+    
+    events = _collect_events(handler, stream=True, passthrough=True)
+    assert b"".join(event["data"] for event in events if event["type"] == "raw") == b"".join(chunks)
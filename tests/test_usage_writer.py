@@ -0,0 +1,35 @@
+"""
+用量写入器溢出文件测试
+"""
+import threading
+from datetime import datetime, timezone
+from app.config import settings
+from app.services.usage_writer import UsageWriter
+
+
+def test_concurrent_spills_do_not_interleave(monkeypatch, tmp_path):
+    """多个写入方同时追加大批次时，每条记录都完整，重放时全部取出"""
+    monkeypatch.setattr(settings, "USAGE_SPILL_PATH", str(tmp_path / "spill" / "usage.jsonl"))
+    now = datetime.now(timezone.utc)
+    
+    def spill(writer: int):
+        UsageWriter._spill([
+            {"user_id": writer, "seq": i, "error_message": "x" * 2000, "created_at": now}
+            for i in range(200)
+        ])
+    
+    threads = [threading.Thread(target=spill, args=(writer,)) for writer in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    
+    records = UsageWriter._take_spill()
+    assert len(records) == 8 * 200
+    assert {(r["user_id"], r["seq"]) for r in records} == {(w, i) for w in range(8) for i in range(200)}
+    
+    # 改名后的新溢出写入新文件，不会混入正在重放的文件
+    spill(99)
+    assert len(UsageWriter._take_spill()) == 8 * 200
+    UsageWriter._finish_replay()
+    assert len(UsageWriter._take_spill()) == 200